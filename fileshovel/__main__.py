@@ -1,39 +1,117 @@
 #!/usr/bin/env python3
+import importlib
 import logging
+import sys
+from threading import Event, Thread
 
+from fileshovel.backfill import backfill_files
+from fileshovel.indexer import CsvIndexer
+from fileshovel.lineio import SharedFileWatcher
+from fileshovel.metrics import metrics, reader_collector, start_metrics
 from fileshovel.pgsql import PgLineInserter
 from fileshovel.options import FileShovelOptions
+from fileshovel.profiling import start_profiler
 
 log = logging.getLogger("fileshovel.main")
 
+COMMANDS = {
+	"benchmark": "fileshovel.benchmark",
+	"extract": "fileshovel.extract",
+	"lookup": "fileshovel.lookup",
+}
+
+
+def shovel_file(args: FileShovelOptions, index: PgLineInserter, csv_file: str,
+		file_watcher: SharedFileWatcher = None):
+	offset, inode = index.get_last_checkpoint(csv_file)
+	reader = args.get_csv_file_reader(last_offset=offset, csv_file=csv_file, file_watcher=file_watcher,
+			last_inode=inode)
+	indexer = CsvIndexer(args, csv_file) if args.index_update else None
+	collector = reader_collector(csv_file, reader, index.committed_offsets)
+	metrics.add_collector(collector)
+
+	try:
+		for line, current_line, current_line_offset in reader:
+			if reader.line_num % args.pg_rows_per_commit == 0:
+				log.info("add %d row now at %d rows of %s", args.pg_rows_per_commit, reader.line_num, csv_file)
+			if indexer:
+				indexer.follow_row(line, current_line, current_line_offset, reader.csv_file.inode)
+			index.add_row(line, current_line, current_line_offset, csv_file, reader.csv_file.inode)
+	finally:
+		metrics.remove_collector(collector)
+		if indexer:
+			indexer.close()
+
+	log.info("done at %d rows of %s", reader.line_num, csv_file)
+
+
+def shovel_files(args: FileShovelOptions, index: PgLineInserter):
+	"""Follow every CSV file from its own thread sharing one inotify instance and the SQL threads."""
+	file_watcher = args.get_file_watcher()
+	failed = Event()
+
+	def run(csv_file: str):
+		try:
+			shovel_file(args, index, csv_file, file_watcher)
+		except Exception:
+			log.exception("failed to shovel %s", csv_file)
+			failed.set()
+
+	threads = [Thread(name="reader:%s" % x, target=run, args=(x,), daemon=True) for x in args.csv_files]
+
+	for t in threads:
+		t.start()
+
+	for t in threads:
+		while t.is_alive() and not failed.is_set():
+			t.join(1)
+
+	if failed.is_set():
+		raise RuntimeError("a CSV reader thread died.")
+
 
 def main():
+	if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+		command = importlib.import_module(COMMANDS[sys.argv[1]])
+		return command.main(sys.argv[2:])
+
 	args = FileShovelOptions()
-	log_level = {
-		0: logging.CRITICAL,
-		1: logging.ERROR,
-		2: logging.WARN,
-		3: logging.INFO,
-		4: logging.DEBUG,
-	}.get(args.verbose)
-	logging.basicConfig(level=log_level)
+	args.setup_logging()
+	profiler = start_profiler(args)
+	start_metrics(args)
+
+	try:
+		return shovel(args)
+	finally:
+		if profiler:
+			profiler.stop()
+
+
+def shovel(args: FileShovelOptions):
+	if args.engine == "asyncio":
+		from fileshovel import aioengine
+		try:
+			return aioengine.main(args)
+		except KeyboardInterrupt:
+			return
+
 	index = PgLineInserter(args)
-	offset = index.get_last_offset_from_database()
-	reader = args.get_csv_file_reader(last_offset=offset)
 
 	try:
-		for line, current_line, current_line_offset in reader:
-			if reader.reader.line_num % args.pg_rows_per_commit == 0:
-				log.info("add %d row now at %d rows", args.pg_rows_per_commit, reader.reader.line_num)
-			index.add_row(line, current_line, current_line_offset)
+		# files are backfilled one after the other, each of them using every backfill process
+		if args.backfill_processes > 1:
+			backfill_files(args, index)
+
+		if len(args.csv_files) > 1:
+			shovel_files(args, index)
+		else:
+			shovel_file(args, index, args.csv_file)
 
 	except KeyboardInterrupt:
 		pass
 	finally:
 		index.done()
 
-	log.info("done at %d rows", reader.reader.line_num)
-
 
 if __name__ == "__main__":
-	main()
+	sys.exit(main())
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.sql import SQL, Literal
+
+from fileshovel import profiling
+from fileshovel.backfill import backfill_files
+from fileshovel.batch import FlushPolicy, estimate_row_size
+from fileshovel.indexer import CsvIndexer
+from fileshovel.lineio import AsyncFileWatcher
+from fileshovel.metrics import metrics, reader_collector
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgpool import is_retryable
+from fileshovel.pgsql import CHECKPOINT_FORWARD, PgLineInserter
+from fileshovel.pgtypes import convert_row, get_converter
+
+log = logging.getLogger("fileshovel.aioengine")
+
+FILE_EVENT_TIMEOUT = 60
+
+
+async def wait_connection(pg_connection):
+	"""Wait for the current operation of an asynchronous psycopg2 connection without blocking the event loop."""
+	loop = asyncio.get_running_loop()
+
+	while True:
+		state = pg_connection.poll()
+
+		if state == psycopg2.extensions.POLL_OK:
+			return
+
+		ready = loop.create_future()
+		fd = pg_connection.fileno()
+
+		if state == psycopg2.extensions.POLL_READ:
+			add_watcher, remove_watcher = loop.add_reader, loop.remove_reader
+		elif state == psycopg2.extensions.POLL_WRITE:
+			add_watcher, remove_watcher = loop.add_writer, loop.remove_writer
+		else:
+			raise psycopg2.OperationalError("unexpected poll state %r" % state)
+
+		add_watcher(fd, lambda: ready.done() or ready.set_result(None))
+		try:
+			await ready
+		finally:
+			remove_watcher(fd)
+
+
+class AsyncPgLineInserter(PgLineInserter):
+
+	def __init__(self, options: FileShovelOptions):
+		"""PgLineInserter whose batches are sent by coroutines over asynchronous connections.
+
+		Asynchronous connections are in autocommit mode, each batch is sent as a single
+		BEGIN ... COMMIT string so it costs one round trip.
+		"""
+		super().__init__(options)
+
+		if self.typed_rows:
+			pg_connection = self.connect_database()
+			try:
+				self.get_column_types(pg_connection, check=True)
+			finally:
+				pg_connection.close()
+
+	def start_sql_threads(self, how_many: int):
+		return iter(())
+
+	def _collect_metrics(self):
+		return ()
+
+	async def connect_database_async(self):
+		pg_connection = psycopg2.connect(self._options.pg_connection_string, async_=True)
+		try:
+			await wait_connection(pg_connection)
+		except psycopg2.Error:
+			pg_connection.close()
+			raise
+		return pg_connection
+
+	@staticmethod
+	async def execute(pg_connection, sql: str):
+		pg_connection.cursor().execute(sql)
+		await wait_connection(pg_connection)
+
+	async def retry_async(self, operation: Callable[[], Awaitable], description: str):
+		"""Return the result of operation awaited again with exponential backoff while it fails with a retryable
+		error, for up to --pg-retry-timeout seconds, like retry does without blocking the event loop."""
+		backoff = self.new_backoff()
+		timeout = self._options.pg_retry_timeout
+		started = time.monotonic()
+
+		while True:
+			try:
+				return await operation()
+			except psycopg2.Error as e:
+				if not is_retryable(e):
+					raise
+				if timeout and time.monotonic() - started >= timeout:
+					log.error("%s failed for %.0fs, giving up", description, time.monotonic() - started)
+					raise
+				delay = backoff.next()
+				metrics.inc("fileshovel_pg_retries_total", error=type(e).__name__)
+				log.warning("%s failed, retrying in %.1fs: %s", description, delay, e)
+				await asyncio.sleep(delay)
+
+	async def open_connection_async(self):
+		"""Return a new asynchronous connection with the session settings of batches."""
+		synchronous_commit = self._options.pg_synchronous_commit
+		log.info("connecting")
+		pg_connection = await self.connect_database_async()
+
+		try:
+			if synchronous_commit:
+				await self.execute(pg_connection, SQL("SET synchronous_commit TO {0}").format(
+					Literal(synchronous_commit)).as_string(pg_connection))
+		except psycopg2.Error:
+			pg_connection.close()
+			raise
+
+		log.info("connected")
+		return pg_connection
+
+	async def execute_batch(self, pg_connection, sql: str):
+		"""Execute the statements of a batch, on a new connection after a retryable error.
+
+		Returns the connection the batch ran on, a batch is a single transaction so it is sent again as a whole.
+		"""
+		async def execute_once():
+			nonlocal pg_connection
+			if pg_connection.closed:
+				pg_connection = await self.open_connection_async()
+			try:
+				await self.execute(pg_connection, sql)
+			except psycopg2.Error:
+				pg_connection.close()
+				raise
+
+		await self.retry_async(execute_once, "inserting a batch")
+		return pg_connection
+
+	def _compose_checkpoints(self, checkpoints: dict) -> List[SQL]:
+		return [SQL(
+			"INSERT INTO {0} (server_name, csv_file, csv_offset, csv_line, csv_inode, csv_sequence) "
+			"VALUES ({1}, {2}, {3}, {4}, {5}, {6}) "
+			"ON CONFLICT (server_name, csv_file) DO UPDATE SET "
+			"csv_offset = EXCLUDED.csv_offset, csv_line = EXCLUDED.csv_line, csv_inode = EXCLUDED.csv_inode, "
+			"csv_sequence = EXCLUDED.csv_sequence, updated_at = now() " + CHECKPOINT_FORWARD
+		).format(
+			self.checkpoint_table,
+			Literal(self.server_name_value),
+			Literal(self.get_file_identity(csv_file)),
+			Literal(current_line_offset),
+			Literal(current_line),
+			Literal(inode),
+			Literal(sequence),
+		) for csv_file, (current_line, current_line_offset, inode, sequence) in checkpoints.items()]
+
+	async def insert_rows(self, row_queue: asyncio.Queue):
+		"""Insert rows from row_queue until None is received, like _insert_rows does from a thread."""
+		insert_format = SQL("INSERT INTO {0} ({1}) VALUES {2} ON CONFLICT DO NOTHING")
+		synchronous_commit = self._options.pg_synchronous_commit
+		asynchronous_commit = synchronous_commit == "off"
+		durable_interval = self._options.pg_durable_commit_interval
+		last_durable_commit = time.monotonic()
+		policy = FlushPolicy(self._options.pg_rows_per_commit,
+				self._options.pg_max_batch_bytes, self._options.pg_max_batch_delay)
+		count_bytes = policy.max_bytes > 0
+		converters = None
+		ending = False
+		values = []
+		marks = []
+		batch_offsets = {}
+
+		if self.typed_rows:
+			converters = [get_converter(x, self._options.csv_date_format) for x in self._column_types]
+
+		prepare_row = self._prepare_row
+		convert = convert_row
+		timer = profiling.stage_timer
+
+		if timer:
+			prepare_row = timer.wrap(prepare_row, "prepare")
+			convert = timer.wrap(convert, "prepare")
+
+		pg_connection = await self.retry_async(self.open_connection_async, "connecting")
+
+		try:
+			while True:
+				try:
+					item = row_queue.get_nowait()
+				except asyncio.QueueEmpty:
+					try:
+						item = await asyncio.wait_for(row_queue.get(), policy.timeout())
+					except asyncio.TimeoutError:
+						item = False
+
+				if item is None:
+					ending = True
+				elif item is not False:
+					if item[4]:
+						marks.append(item[4])
+					batch_offsets[item[3]] = item[2]
+					row = prepare_row(item)
+
+					if converters:
+						try:
+							row = convert(row, converters)
+						except (ValueError, TypeError) as e:
+							log.warning("skipping line %d at offset %d of %s: %s",
+									item[1], item[2], self.get_file_identity(item[3]), e)
+							metrics.inc("fileshovel_rows_skipped_total")
+							row = None
+
+					if row is not None:
+						values.append(row)
+						policy.add(estimate_row_size(row) if count_bytes else 0)
+
+				reason = policy.flush_reason(row_queue.empty(), ending)
+
+				if reason:
+					batch_age = policy.age
+					started = time.monotonic()
+					durable = not asynchronous_commit or ending or \
+							started - last_durable_commit >= durable_interval
+					with profiling.stage("compose"):
+						statements = [SQL("BEGIN")]
+						if asynchronous_commit and durable:
+							statements.append(SQL("SET LOCAL synchronous_commit TO on"))
+						statements.append(insert_format.format(
+							self.table,
+							SQL(",").join(self.columns),
+							SQL(",").join(self._compose_row(x) for x in values),
+						))
+						if self.checkpoint_table:
+							statements.extend(self._compose_checkpoints(self.watermark.peek(marks)))
+						statements.append(SQL("COMMIT"))
+						sql = SQL(";").join(statements).as_string(pg_connection)
+					self.pre_commit()
+					executed = time.monotonic()
+					pg_connection = await self.execute_batch(pg_connection, sql)
+					if timer:
+						# other tasks run while the batch is awaited, it can't be timed as a nested stage
+						timer.add("execute", time.monotonic() - executed)
+					if self.watermark:
+						self.watermark.commit(marks)
+					marks.clear()
+					self.post_commit()
+					committed = time.monotonic()
+					if durable:
+						last_durable_commit = committed
+					# the batch and its commit are a single round trip
+					self._record_batch(reason, len(values), batch_offsets, committed - started, 0.0)
+					batch_offsets.clear()
+					log.debug("flushed %d rows, %d bytes on %s after %.3fs, committed in %.3fs%s",
+							len(values), policy.bytes, reason, batch_age, committed - started,
+							"" if durable else " asynchronously")
+					values.clear()
+					policy.reset()
+					if self._options.wait_time:
+						await asyncio.sleep(self._options.wait_time)
+
+				if ending:
+					break
+
+		finally:
+			pg_connection.close()
+
+
+async def wait_for_change(changed: Optional[asyncio.Event], poll_interval: int):
+	"""Wait for an inotify event on the file, or poll_interval seconds without inotify."""
+	if changed is None:
+		await asyncio.sleep(poll_interval)
+		return
+
+	try:
+		await asyncio.wait_for(changed.wait(), FILE_EVENT_TIMEOUT)
+	except asyncio.TimeoutError:
+		pass
+
+	changed.clear()
+
+
+async def follow_file(options: FileShovelOptions, inserter: PgLineInserter, csv_file: str, last_offset: int,
+		row_queue: asyncio.Queue, file_watcher: AsyncFileWatcher = None, last_inode: int = None):
+	"""Read csv_file from last_offset into row_queue, waiting for changes on the event loop at the end of it."""
+	reader = options.get_csv_file_reader(last_offset=last_offset, csv_file=csv_file, nonblocking=True,
+			last_inode=last_inode)
+	changed = file_watcher.add_watch(csv_file) if file_watcher else None
+	indexer = CsvIndexer(options, csv_file) if options.index_update else None
+	collector = reader_collector(csv_file, reader, inserter.committed_offsets)
+	metrics.add_collector(collector)
+
+	try:
+		for row in reader:
+			if row is None:
+				await wait_for_change(changed, options.poll_interval)
+				continue
+
+			line, current_line, current_line_offset = row
+			if reader.line_num % options.pg_rows_per_commit == 0:
+				log.info("add %d row now at %d rows of %s", options.pg_rows_per_commit, reader.line_num, csv_file)
+			if indexer:
+				indexer.follow_row(line, current_line, current_line_offset, reader.csv_file.inode)
+			await row_queue.put(inserter.make_item(line, current_line, current_line_offset, csv_file,
+					reader.csv_file.inode))
+	finally:
+		metrics.remove_collector(collector)
+		reader.csv_file.close()
+		if indexer:
+			indexer.close()
+
+	log.info("done at %d rows of %s", reader.line_num, csv_file)
+
+
+async def shovel_files(options: FileShovelOptions):
+	"""Follow every CSV file and insert their rows from coroutines of a single event loop."""
+	loop = asyncio.get_running_loop()
+	inserter = AsyncPgLineInserter(options)
+	checkpoints = {}
+
+	# backfilling and resuming happen once before following, they may block the loop
+	if options.backfill_processes > 1:
+		backfill_files(options, inserter)
+	for csv_file in options.csv_files:
+		checkpoints[csv_file] = inserter.get_last_checkpoint(csv_file)
+
+	row_queue = asyncio.Queue(maxsize=options.pg_rows_per_commit)
+	metrics.add_collector(lambda: [("fileshovel_queue_rows", {}, row_queue.qsize())])
+	file_watcher = AsyncFileWatcher(loop) if options.watch == "inotify" else None
+	writers = [loop.create_task(inserter.insert_rows(row_queue)) for _ in range(max(options.pg_threads, 1))]
+	readers = [
+		loop.create_task(follow_file(options, inserter, x, checkpoints[x][0], row_queue, file_watcher,
+				checkpoints[x][1]))
+		for x in options.csv_files
+	]
+	tasks = readers + writers
+
+	try:
+		while readers:
+			done, _ = await asyncio.wait(readers + writers, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				task.result()
+				if task in writers:
+					raise RuntimeError("SQL writer stopped.")
+				readers.remove(task)
+
+		for _ in writers:
+			await row_queue.put(None)
+		await asyncio.gather(*writers)
+		inserter.save_watermarks()
+
+	finally:
+		for task in tasks:
+			task.cancel()
+		if file_watcher:
+			file_watcher.close()
+
+
+def main(options: FileShovelOptions):
+	asyncio.run(shovel_files(options))
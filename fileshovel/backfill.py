@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import logging
+import multiprocessing
+import os
+from multiprocessing.pool import Pool
+from typing import BinaryIO, List, Optional, Tuple
+
+from fileshovel.compressed import get_compression
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgsql import PgLineInserter
+
+log = logging.getLogger("fileshovel.backfill")
+
+MIN_RANGE_SIZE = 1 << 20
+RANGES_PER_PROCESS = 4
+
+
+def split_ranges(filename: str, offset: int, parts: int, min_size: int = MIN_RANGE_SIZE) -> List[Tuple[int, int]]:
+	"""Split the records following the one at offset into (start, end) byte ranges aligned on records.
+
+	The record at offset is the last one already inserted, like when resuming.
+	Quotes are counted from offset so a quoted field spanning many lines never crosses a range boundary.
+	"""
+	with open(filename, "rb") as csv_file:
+		size = os.fstat(csv_file.fileno()).st_size
+
+		csv_file.seek(offset)
+		quotes = skip_record(csv_file, 0) if offset > 0 else 0
+		start = csv_file.tell()
+
+		parts = max(min(parts, (size - start) // min_size), 1)
+		boundaries = [start]
+
+		for i in range(1, parts):
+			quotes += count_quotes(csv_file, start + (size - start) * i // parts)
+			quotes = skip_record(csv_file, quotes)
+			boundary = csv_file.tell()
+			if boundaries[-1] < boundary < size:
+				boundaries.append(boundary)
+
+	boundaries.append(size)
+	return [(x, y) for x, y in zip(boundaries, boundaries[1:]) if x < y]
+
+
+def count_quotes(csv_file: BinaryIO, end: int, block_size: int = MIN_RANGE_SIZE) -> int:
+	"""Count the quotes from the position of csv_file up to end."""
+	quotes = 0
+	position = csv_file.tell()
+
+	while position < end:
+		block = csv_file.read(min(block_size, end - position))
+		if not block:
+			break
+		quotes += block.count(b'"')
+		position += len(block)
+
+	return quotes
+
+
+def skip_record(csv_file: BinaryIO, quotes: int) -> int:
+	"""Read up to the end of the line ending the current record, after an even count of quotes.
+
+	Returns the count of quotes including the ones read.
+	"""
+	while True:
+		line = csv_file.readline()
+		quotes += line.count(b'"')
+		if not line or quotes % 2 == 0:
+			return quotes
+
+
+def count_lines(filename: str, start: int, end: int, block_size: int = MIN_RANGE_SIZE) -> int:
+	"""Count the newlines between start and end."""
+	lines = 0
+
+	with open(filename, "rb") as csv_file:
+		csv_file.seek(start)
+		while start < end:
+			block = csv_file.read(min(block_size, end - start))
+			if not block:
+				break
+			lines += block.count(b"\n")
+			start += len(block)
+
+	return lines
+
+
+def backfill_range(options_class: type, argv: List[str], csv_file: str, start: int, end: int,
+		first_line: int) -> Tuple[int, Optional[Tuple[int, int]]]:
+	"""Insert the lines starting from start up to end from a worker process with its own connections.
+
+	Returns how many rows were inserted and the line and offset of the last one.
+	"""
+	options = options_class(argv)
+	options.setup_logging()
+	inserter = PgLineInserter(options, write_checkpoints=False)
+	# resuming skips the line at the offset, start from the newline ending the previous line instead
+	reader = options.get_csv_file_reader(last_offset=max(start - 1, 0), csv_file=csv_file, watch=False)
+	rows = 0
+	last_row = None
+
+	log.info("inserting bytes %d to %d of %s", start, end, csv_file)
+
+	try:
+		for line, current_line, current_line_offset in reader:
+			if current_line_offset >= end:
+				break
+			current_line += first_line
+			inserter.add_row(line, current_line, current_line_offset, csv_file)
+			last_row = (current_line, current_line_offset)
+			rows += 1
+	finally:
+		reader.csv_file.close()
+		inserter.done()
+
+	return rows, last_row
+
+
+def backfill_files(options: FileShovelOptions, inserter: PgLineInserter):
+	"""Backfill each followed file in turn, sharing one pool of --backfill-processes worker processes."""
+	context = multiprocessing.get_context("spawn")
+	with context.Pool(options.backfill_processes) as pool:
+		for csv_file in options.csv_files:
+			backfill_file(options, inserter, csv_file, pool)
+
+
+def backfill_file(options: FileShovelOptions, inserter: PgLineInserter, csv_file: str, pool: Pool):
+	"""Insert what is already in csv_file from the processes of pool, then store a checkpoint to follow it from there.
+
+	Ranges complete out of order, the checkpoint is only written once all of them are inserted.
+	"""
+	if get_compression(csv_file):
+		log.info("not backfilling %s in parallel, it is compressed", csv_file)
+		return
+
+	processes = options.backfill_processes
+	offset = inserter.get_last_offset_from_database(csv_file)
+	ranges = split_ranges(csv_file, offset, processes * RANGES_PER_PROCESS)
+
+	if len(ranges) < 2:
+		log.info("not enough data to backfill %s in parallel", csv_file)
+		return
+
+	first_lines = [0] * len(ranges)
+	if options.pg_csv_line_column:
+		line_counts = pool.starmap(count_lines, [(csv_file, x, y) for x, y in ranges])
+
+		# lines are numbered from the resume point, without the skipped header
+		first_line = -options.csv_skip_lines if offset == 0 else 0
+		for i, line_count in enumerate(line_counts):
+			first_lines[i] = max(first_line, 0)
+			first_line += line_count
+
+	log.info("backfilling %d bytes of %s in %d ranges using %d processes",
+			ranges[-1][1] - ranges[0][0], csv_file, len(ranges), processes)
+
+	results = pool.starmap(backfill_range, [
+		(type(options), options.argv, csv_file, x, y, first_line)
+		for (x, y), first_line in zip(ranges, first_lines)
+	])
+
+	last_rows = [x for _, x in results if x is not None]
+	log.info("backfilled %d rows of %s", sum(x for x, _ in results), csv_file)
+
+	if last_rows:
+		current_line, current_line_offset = max(last_rows, key=lambda x: x[1])
+		inserter.save_checkpoint(csv_file, current_line, current_line_offset, os.stat(csv_file).st_ino)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import time
+from typing import Optional
+
+
+class FlushPolicy:
+	"""Decide when a batch of rows must be committed, whichever of max_rows, max_bytes or max_delay comes first.
+
+	A max_bytes of 0 disables the size bound. A max_delay of 0 flushes as soon as the queue is empty,
+	otherwise rows are held until the first row of the batch is max_delay seconds old."""
+
+	def __init__(self, max_rows: int, max_bytes: int = 0, max_delay: float = 0.0):
+		self.max_rows = max_rows
+		self.max_bytes = max_bytes
+		self.max_delay = max_delay
+		self.rows = 0
+		self.bytes = 0
+		self.started = None
+
+	def add(self, size: int = 0):
+		if self.rows == 0:
+			self.started = time.monotonic()
+		self.rows += 1
+		self.bytes += size
+
+	def reset(self):
+		self.rows = 0
+		self.bytes = 0
+		self.started = None
+
+	@property
+	def age(self) -> float:
+		return 0.0 if self.started is None else time.monotonic() - self.started
+
+	def timeout(self) -> Optional[float]:
+		"""Seconds to wait for the next row before the batch is due, None to wait forever."""
+		if self.rows == 0 or self.max_delay <= 0:
+			return None
+		else:
+			return max(0.0, self.max_delay - self.age)
+
+	def flush_reason(self, queue_empty: bool, ending: bool = False) -> Optional[str]:
+		"""Return why the batch must be flushed now, None to keep filling it."""
+		if self.rows == 0:
+			return None
+		elif ending:
+			return "end"
+		elif self.rows >= self.max_rows:
+			return "rows"
+		elif 0 < self.max_bytes <= self.bytes:
+			return "bytes"
+		elif self.max_delay <= 0:
+			return "idle" if queue_empty else None
+		elif self.age >= self.max_delay:
+			return "delay"
+		else:
+			return None
+
+
+def estimate_row_size(row: list) -> int:
+	"""Approximate the bytes a row takes on the wire, text fields by length and others as 8 bytes."""
+	return sum(len(x) if isinstance(x, str) else 8 for x in row if x is not None) + len(row)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from fileshovel.cdrgen import QUOTING, cdr_columns, generate_cdr_file
+from fileshovel.options import FileShovelOptions
+
+log = logging.getLogger("fileshovel.benchmark")
+
+STAGES = ("lineio", "csvreader", "prepare_row", "indexer", "ingest")
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(prog="fileshovel benchmark")
+	parser.add_argument("--rows", type=int, default=100000,
+						help="rows of the generated CDR file")
+	parser.add_argument("--size", type=int, default=0,
+						help="generate at least this many bytes, whichever of --rows and --size is larger")
+	parser.add_argument("--quoting", type=str, default="all", choices=tuple(QUOTING),
+						help="quoting of the generated fields, FreeSWITCH quotes all of them by default")
+	parser.add_argument("--extra-columns", type=int, default=0,
+						help="columns added to the 15 CDR columns to make rows wider")
+	parser.add_argument("--seed", type=int, default=0,
+						help="seed of the generator, the same seed gives the same file")
+	parser.add_argument("--repeat", type=int, default=3,
+						help="run each stage this many times and keep the fastest")
+	parser.add_argument("--stage", dest="stages", action="append", choices=STAGES,
+						help="stage to run, can be repeated, default is every stage but ingest without a connection")
+	parser.add_argument("--output", type=str, default=None,
+						help="append one JSON object per stage to this file instead of stdout")
+	parser.add_argument("--directory", type=str, default=None,
+						help="directory of the generated files, default is a temporary directory")
+	parser.add_argument("--pg-connection-string", type=str, default=None,
+						help="run the ingest stage against this database, --pg-table is dropped and recreated")
+	parser.add_argument("--pg-table", type=str, default="fileshovel_benchmark")
+	parser.add_argument("--pg-insert-mode", type=str, default="insert", choices=("insert", "copy"))
+	parser.add_argument("--pg-threads", type=int, default=1)
+	parser.add_argument("--verbose", "-v", action="count", default=0)
+	return parser.parse_args(argv)
+
+
+def shovel_options(args: argparse.Namespace, csv_file: str, *extra_args: str) -> FileShovelOptions:
+	return FileShovelOptions([
+		"--date-column", "start_stamp",
+		"--uuid-column", "uuid",
+		"--pg-table", args.pg_table,
+		"--pg-csv-offset-column", "csv_offset",
+		"--watch", "no",
+		"--index-file", csv_file + ".index",
+		*extra_args,
+		csv_file,
+	])
+
+
+def best_of(repeat: int, run: Callable[[], int]) -> Dict:
+	"""Run a stage repeat times, return the fastest time and the rows it handled."""
+	times = []
+	rows = 0
+
+	for _ in range(repeat):
+		started = time.perf_counter()
+		rows = run()
+		times.append(time.perf_counter() - started)
+
+	return {"rows": rows, "seconds": min(times), "all_seconds": times}
+
+
+def bench_lineio(options: FileShovelOptions) -> int:
+	csv_file = options.get_csv_file(watch=False)
+	try:
+		return sum(1 for _ in csv_file)
+	finally:
+		csv_file.close()
+
+
+def bench_csvreader(options: FileShovelOptions) -> int:
+	reader = options.get_csv_file_reader(watch=False)
+	try:
+		return sum(1 for _ in reader)
+	finally:
+		reader.csv_file.close()
+
+
+def bench_prepare_row(options: FileShovelOptions) -> Callable[[], int]:
+	from fileshovel.pgsql import PgLineInserter
+	inserter = PgLineInserter(options)
+	reader = options.get_csv_file_reader(watch=False)
+	rows = [x for x in reader]
+	reader.csv_file.close()
+
+	def run() -> int:
+		prepare_row = inserter._prepare_row
+		for line, current_line, current_line_offset in rows:
+			prepare_row((list(line), current_line, current_line_offset, None, None))
+		return len(rows)
+
+	return run
+
+
+def bench_indexer(options: FileShovelOptions) -> int:
+	from fileshovel.indexer import CsvIndexer
+	indexer = CsvIndexer(options, build=False)
+	try:
+		return len(indexer.build_new_index())
+	finally:
+		indexer.close()
+
+
+def create_benchmark_table(args: argparse.Namespace, extra_columns: int):
+	import psycopg2
+	from psycopg2.sql import Identifier, SQL
+
+	pg_connection = psycopg2.connect(args.pg_connection_string)
+	try:
+		with pg_connection:
+			cursor = pg_connection.cursor()
+			table = Identifier(args.pg_table)
+			cursor.execute(SQL("DROP TABLE IF EXISTS {0}").format(table))
+			cursor.execute(SQL("CREATE TABLE {0} ({1}, csv_offset bigint PRIMARY KEY)").format(
+				table,
+				SQL(",").join(Identifier(x) + SQL(" text") for x in cdr_columns(extra_columns)),
+			))
+	finally:
+		pg_connection.close()
+
+
+def bench_ingest(args: argparse.Namespace, csv_file: str) -> int:
+	from fileshovel.pgsql import PgLineInserter
+
+	create_benchmark_table(args, args.extra_columns)
+	options = shovel_options(args, csv_file,
+			"--pg-connection-string", args.pg_connection_string,
+			"--pg-insert-mode", args.pg_insert_mode,
+			"--pg-threads", str(args.pg_threads),
+			"--csv-null-text", "")
+	inserter = PgLineInserter(options)
+	reader = options.get_csv_file_reader(watch=False)
+	rows = 0
+
+	try:
+		for line, current_line, current_line_offset in reader:
+			inserter.add_row(line, current_line, current_line_offset)
+			rows += 1
+	finally:
+		reader.csv_file.close()
+		inserter.done()
+
+	return rows
+
+
+def run_benchmarks(args: argparse.Namespace, directory: str) -> List[Dict]:
+	csv_file = os.path.join(directory, "cdr_%d_%s_%d.csv" % (args.seed, args.quoting, args.extra_columns))
+	started = time.perf_counter()
+	generated_rows = generate_cdr_file(csv_file, args.rows, args.size, args.quoting, args.extra_columns, args.seed)
+	log.info("generated %d rows in %s in %.3fs", generated_rows, csv_file, time.perf_counter() - started)
+	size = os.path.getsize(csv_file)
+	options = shovel_options(args, csv_file, "--pg-threads", "0")
+	stages = args.stages or [x for x in STAGES if x != "ingest" or args.pg_connection_string]
+	results = []
+
+	for stage in stages:
+		log.info("running %s", stage)
+
+		if stage == "lineio":
+			result = best_of(args.repeat, lambda: bench_lineio(options))
+		elif stage == "csvreader":
+			result = best_of(args.repeat, lambda: bench_csvreader(options))
+		elif stage == "prepare_row":
+			result = best_of(args.repeat, bench_prepare_row(options))
+		elif stage == "indexer":
+			result = best_of(args.repeat, lambda: bench_indexer(options))
+		elif args.pg_connection_string:
+			result = best_of(args.repeat, lambda: bench_ingest(args, csv_file))
+		else:
+			log.error("the ingest stage requires --pg-connection-string")
+			continue
+
+		result.update({
+			"benchmark": stage,
+			"bytes": size,
+			"rows_per_second": result["rows"] / result["seconds"] if result["seconds"] else None,
+			"mib_per_second": size / result["seconds"] / (1 << 20) if result["seconds"] else None,
+			"generator": {
+				"rows": generated_rows,
+				"quoting": args.quoting,
+				"extra_columns": args.extra_columns,
+				"seed": args.seed,
+			},
+			"repeat": args.repeat,
+			"python": platform.python_version(),
+			"implementation": platform.python_implementation(),
+			"machine": platform.machine(),
+			"date": datetime.now(timezone.utc).isoformat(),
+		})
+		results.append(result)
+
+	return results
+
+
+def main(argv: List[str] = None):
+	args = parse_args(argv)
+	logging.basicConfig(level=logging.WARNING - 10 * min(args.verbose, 3))
+	directory = args.directory or tempfile.mkdtemp(prefix="fileshovel-benchmark-")
+
+	try:
+		results = run_benchmarks(args, directory)
+	finally:
+		if args.directory is None:
+			shutil.rmtree(directory, ignore_errors=True)
+
+	output = open(args.output, "a") if args.output else sys.stdout
+	try:
+		for result in results:
+			output.write(json.dumps(result, sort_keys=True) + "\n")
+	finally:
+		if args.output:
+			output.close()
+
+	return 0
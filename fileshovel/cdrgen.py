@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import csv
+import random
+from datetime import datetime, timedelta
+from typing import List, TextIO
+from uuid import UUID
+
+CDR_COLUMNS = [
+	"caller_id_name",
+	"caller_id_number",
+	"destination_number",
+	"context",
+	"start_stamp",
+	"answer_stamp",
+	"end_stamp",
+	"duration",
+	"billsec",
+	"hangup_cause",
+	"uuid",
+	"bleg_uuid",
+	"accountcode",
+	"read_codec",
+	"write_codec",
+]
+ANSWERED_CAUSES = ["NORMAL_CLEARING"] * 9 + ["NORMAL_UNSPECIFIED"]
+UNANSWERED_CAUSES = ["NO_ANSWER", "USER_BUSY", "ORIGINATOR_CANCEL", "CALL_REJECTED"]
+CODECS = ["PCMU", "PCMA", "G722", "OPUS"]
+CONTEXTS = ["default", "public", "features"]
+NAMES = ["Alice Tremblay", "Bob Gagnon", "Roy, Carole", "Diane \"Dee\" Côté", "Outbound Call", "UNKNOWN"]
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+QUOTING = {
+	"none": csv.QUOTE_NONE,
+	"minimal": csv.QUOTE_MINIMAL,
+	"all": csv.QUOTE_ALL,
+}
+
+
+def cdr_columns(extra_columns: int = 0) -> List[str]:
+	return CDR_COLUMNS + ["variable_%d" % x for x in range(extra_columns)]
+
+
+class CdrGenerator:
+
+	def __init__(self, seed: int = 0, extra_columns: int = 0, start: datetime = datetime(2020, 1, 1)):
+		"""Deterministic FreeSWITCH style CDR rows, calls start in order every few seconds from start."""
+		self.random = random.Random(seed)
+		self.extra_columns = extra_columns
+		self.now = start
+
+	def _uuid(self) -> str:
+		return str(UUID(int=self.random.getrandbits(128), version=4))
+
+	def row(self, quoting: str = "all") -> List[str]:
+		r = self.random
+		self.now += timedelta(seconds=r.randint(0, 5))
+		answered = r.random() < 0.8
+		ring = r.randint(0, 30)
+		billsec = r.randint(1, 3600) if answered else 0
+		answer = self.now + timedelta(seconds=ring) if answered else None
+		end = self.now + timedelta(seconds=ring + billsec)
+		name = r.choice(NAMES)
+
+		if quoting == "none":
+			# without quoting, fields can't hold the delimiter or quotes
+			name = name.replace(",", "").replace("\"", "")
+
+		row = [
+			name,
+			"1%010d" % r.randrange(10 ** 10),
+			"%d" % r.randint(1000, 9999),
+			r.choice(CONTEXTS),
+			self.now.strftime(DATE_FORMAT),
+			answer.strftime(DATE_FORMAT) if answer else "",
+			end.strftime(DATE_FORMAT),
+			str(ring + billsec),
+			str(billsec),
+			r.choice(ANSWERED_CAUSES if answered else UNANSWERED_CAUSES),
+			self._uuid(),
+			self._uuid() if answered else "",
+			"%d" % r.randint(100, 999),
+			r.choice(CODECS),
+			r.choice(CODECS),
+		]
+		row.extend("%08x" % r.getrandbits(32) for _ in range(self.extra_columns))
+		return row
+
+	def write(self, output: TextIO, rows: int = 0, size: int = 0, quoting: str = "all", header=True) -> int:
+		"""Write at least rows rows and about size bytes, return how many rows were written."""
+		writer = csv.writer(output, quoting=QUOTING[quoting], lineterminator="\n", escapechar="\\")
+		written = 0
+
+		if header:
+			writer.writerow(cdr_columns(self.extra_columns))
+
+		while written < rows:
+			writer.writerow(self.row(quoting))
+			written += 1
+
+		# telling the position of a text file is slow, check the size every few rows
+		while output.tell() < size:
+			for _ in range(100):
+				writer.writerow(self.row(quoting))
+			written += 100
+
+		return written
+
+
+def generate_cdr_file(filename: str, rows: int = 0, size: int = 0, quoting: str = "all", extra_columns: int = 0,
+		seed: int = 0, header=True) -> int:
+	"""Write a synthetic CDR CSV file, return how many rows it holds."""
+	with open(filename, "w", encoding="utf-8", newline="") as output:
+		return CdrGenerator(seed, extra_columns).write(output, rows, size, quoting, header)
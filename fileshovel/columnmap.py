@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import linecache
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Sequence
+
+Transform = Callable[[tuple], list]
+
+
+class MappedColumn(NamedTuple):
+	name: str
+	source: Optional[int] = None
+	value: Optional[str] = None
+	trim: bool = False
+	null_tokens: FrozenSet[str] = frozenset()
+
+
+class ColumnMap:
+
+	def __init__(self, columns: Sequence[MappedColumn]):
+		"""Columns of the table in order, each taken from a field of the CSV row or a constant.
+
+		Fields of the row not used by any column are dropped.
+		"""
+		self.columns = list(columns)
+
+	@classmethod
+	def from_columns(cls, csv_columns: Sequence[str], null_text: str = None) -> "ColumnMap":
+		"""Map every CSV column to the table column of the same name, like without a map."""
+		null_tokens = frozenset() if null_text is None else frozenset((null_text,))
+		return cls([MappedColumn(x, i, null_tokens=null_tokens) for i, x in enumerate(csv_columns)])
+
+	@classmethod
+	def from_config(cls, config: dict, csv_columns: Sequence[str], null_text: str = None) -> "ColumnMap":
+		"""Read a map from a parsed YAML document like:
+
+			null: ["", "NULL"]
+			trim: false
+			columns:
+			  - uuid
+			  - {name: caller, source: caller_id_number, trim: true}
+			  - {name: billsec, null: ["0"]}
+			  - {name: site, value: montreal}
+
+		A string keeps a CSV column as is. null and trim at the top are the defaults of every column, null
+		defaults to --csv-null-text.
+		"""
+		default_null = config.get("null", None if null_text is None else [null_text]) or []
+		default_trim = bool(config.get("trim", False))
+		columns = []
+
+		if not config.get("columns"):
+			raise ValueError("the column map must list columns")
+
+		for column in config["columns"]:
+			if isinstance(column, str):
+				column = {"name": column}
+			elif not isinstance(column, dict) or "name" not in column:
+				raise ValueError("column %r of the column map needs a name" % (column,))
+
+			name = str(column["name"])
+			null_tokens = column.get("null", default_null)
+			null_tokens = frozenset(str(x) for x in ([null_tokens] if isinstance(null_tokens, str) else null_tokens))
+
+			if "value" in column:
+				value = column["value"]
+				columns.append(MappedColumn(name, value=None if value is None else str(value)))
+				continue
+
+			source = str(column.get("source", name))
+
+			if source not in csv_columns:
+				raise ValueError("source column %s of %s is not a CSV column" % (source, name))
+
+			columns.append(MappedColumn(
+				name,
+				csv_columns.index(source),
+				trim=bool(column.get("trim", default_trim)),
+				null_tokens=null_tokens,
+			))
+
+		names = [x.name for x in columns]
+		duplicates = sorted(set(x for x in names if names.count(x) > 1))
+
+		if duplicates:
+			raise ValueError("columns %s are mapped more than once" % ", ".join(duplicates))
+
+		return cls(columns)
+
+	@classmethod
+	def load(cls, filename: str, csv_columns: Sequence[str], null_text: str = None) -> "ColumnMap":
+		from ruamel.yaml import YAML
+		with open(filename, "r") as map_file:
+			config = YAML(typ="safe").load(map_file)
+
+		if not isinstance(config, dict):
+			raise ValueError("%s must hold a YAML mapping" % filename)
+
+		return cls.from_config(config, csv_columns, null_text)
+
+	@property
+	def names(self) -> List[str]:
+		return [x.name for x in self.columns]
+
+	@property
+	def width(self) -> int:
+		"""Fields a CSV row needs to hold every source column."""
+		return max((x.source + 1 for x in self.columns if x.source is not None), default=0)
+
+	def _source(self, extras: Sequence[str], width: int) -> str:
+		lines = [
+			"def transform(item):",
+			"\tline, current_line, current_line_offset, csv_file, _ = item",
+		]
+
+		if width == self.width:
+			lines.append("\tif len(line) < %d:" % width)
+			lines.append("\t\treturn short_row(item)")
+
+		values = []
+
+		for i, column in enumerate(self.columns):
+			if column.source is None:
+				values.append("value_%d" % i)
+			elif column.source >= width:
+				values.append("None")
+			else:
+				field = "line[%d]" % column.source
+				if column.trim:
+					field += ".strip()"
+				if column.null_tokens:
+					lines.append("\tfield_%d = %s" % (i, field))
+					field = "None if field_%d in null_%d else field_%d" % (i, i, i)
+				values.append(field)
+
+		lines.append("\treturn [")
+		lines.extend("\t\t%s," % x for x in values + list(extras))
+		lines.append("\t]")
+		return "\n".join(lines) + "\n"
+
+	def compile(self, extras: Sequence[str] = (), namespace: Dict[str, object] = None,
+			add_missing_columns=False, name="column map") -> Transform:
+		"""Return one function turning a queued row item into the values of the mapped columns.
+
+		The function is generated for this map, constants and null tokens are bound to it and each field
+		is read with a constant index. extras are expressions of current_line, current_line_offset,
+		csv_file and names of namespace appended to every row.
+
+		Rows shorter than width raise IndexError, unless add_missing_columns, then missing fields are
+		None from a function generated for their length.
+		"""
+		width = self.width
+		short_rows = {}
+		table_width = len(self.columns) + len(extras)
+		scope = dict(namespace or {})
+
+		for i, column in enumerate(self.columns):
+			scope["value_%d" % i] = column.value
+			scope["null_%d" % i] = column.null_tokens
+
+		def generate(row_width: int) -> Transform:
+			filename = "<%s of %d fields>" % (name, row_width)
+			source = self._source(extras, row_width)
+			function_scope = dict(scope, short_row=short_row)
+			exec(compile(source, filename, "exec"), function_scope)
+			# show the generated lines in tracebacks
+			linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+			return function_scope["transform"]
+
+		def short_row(item: tuple) -> list:
+			row_width = len(item[0])
+
+			if not add_missing_columns:
+				raise IndexError("Row has %d columns while table has %d." % (row_width, table_width))
+
+			transform = short_rows.get(row_width)
+
+			if transform is None:
+				transform = short_rows[row_width] = generate(row_width)
+
+			return transform(item)
+
+		return generate(width)
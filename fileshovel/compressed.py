@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import gzip
+import io
+import logging
+import lzma
+import os
+from typing import IO, Optional, Tuple
+
+log = logging.getLogger("fileshovel.compressed")
+
+MAGIC_BYTES = (
+	(b"\x1f\x8b", "gzip"),
+	(b"\xfd7zXZ\x00", "xz"),
+	(b"\x28\xb5\x2f\xfd", "zstd"),
+)
+MAGIC_LENGTH = max(len(x) for x, _ in MAGIC_BYTES)
+SEEK_INDEX_SUFFIX = ".seekidx"
+SEEK_POINT_SPACING = 4 << 20
+BUFFER_SIZE = 1 << 20
+
+
+def detect_compression(header: bytes) -> Optional[str]:
+	"""Return the compression of a file from its first bytes, None for a plain file."""
+	for magic, compression in MAGIC_BYTES:
+		if header.startswith(magic):
+			return compression
+
+
+def get_compression(filename: str) -> Optional[str]:
+	with open(filename, "rb") as compressed_file:
+		return detect_compression(compressed_file.read(MAGIC_LENGTH))
+
+
+class ZstdReader(io.RawIOBase):
+
+	def __init__(self, filename: str):
+		"""Decompressed stream of a zstd file, seeking backward restarts from the beginning."""
+		super().__init__()
+		self.filename = filename
+		self._reader = None
+		self._open()
+
+	def _open(self):
+		import zstandard
+		if self._reader:
+			self._reader.close()
+		self._reader = zstandard.ZstdDecompressor().stream_reader(open(self.filename, "rb"),
+				read_across_frames=True, closefd=True)
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def readinto(self, buffer) -> int:
+		return self._reader.readinto(buffer)
+
+	def tell(self) -> int:
+		return self._reader.tell()
+
+	def seek(self, offset: int, whence=io.SEEK_SET) -> int:
+		if whence == io.SEEK_CUR:
+			offset += self.tell()
+		elif whence != io.SEEK_SET:
+			raise io.UnsupportedOperation("zstd streams can only seek from the beginning or current position")
+
+		if offset < self.tell():
+			self._open()
+
+		return self._reader.seek(offset)
+
+	def close(self):
+		if self._reader:
+			self._reader.close()
+		super().close()
+
+
+def count_seek_points(gzip_file) -> int:
+	return sum(1 for _ in gzip_file.seek_points())
+
+
+class GzipSeekIndex:
+
+	def __init__(self, filename: str):
+		"""Sidecar file holding the seek points of a gzip file, so seeking doesn't decompress from the start.
+
+		Points are added while reading and saved when closing if the index grew.
+		"""
+		self.filename = filename
+		self.index_file = filename + SEEK_INDEX_SUFFIX
+		self.points = 0
+
+	def is_fresh(self) -> bool:
+		try:
+			return os.path.getmtime(self.index_file) >= os.path.getmtime(self.filename)
+		except FileNotFoundError:
+			return False
+
+	def open(self) -> IO[bytes]:
+		from indexed_gzip import IndexedGzipFile
+		index_file = self.index_file if self.is_fresh() else None
+		# every read inflates from the previous seek point, the default buffer of 4 points amortizes it
+		gzip_file = IndexedGzipFile(self.filename, spacing=SEEK_POINT_SPACING, index_file=index_file)
+		self.points = count_seek_points(gzip_file) if index_file else 0
+		log.debug("opened %s with %d seek points", self.filename, self.points)
+		return gzip_file
+
+	def save(self, gzip_file):
+		"""Write the seek points of gzip_file atomically if more were found since it was opened."""
+		if gzip_file.closed:
+			return
+
+		points = count_seek_points(gzip_file)
+
+		if points <= self.points:
+			return
+
+		temp_filename = self.index_file + ".tmp"
+
+		try:
+			gzip_file.export_index(temp_filename)
+			os.replace(temp_filename, self.index_file)
+		except OSError as e:
+			log.warning("unable to save the seek points of %s: %s", self.filename, e)
+			return
+
+		log.info("saved %d seek points of %s to %s", points, self.filename, self.index_file)
+		self.points = points
+
+
+def open_compressed(filename: str, compression: str) -> Tuple[IO[bytes], Optional[GzipSeekIndex]]:
+	"""Open the decompressed stream of filename, offsets are in uncompressed bytes.
+
+	gzip files get seek points when indexed_gzip is installed, the returned index must be saved before
+	closing the file to keep them. xz files and gzip files without seek points are decompressed from the
+	start when seeking backward.
+	"""
+	if compression == "gzip":
+		seek_index = GzipSeekIndex(filename)
+		try:
+			return seek_index.open(), seek_index
+		except ImportError:
+			log.info("indexed_gzip isn't installed, seeking in %s decompresses it from the start", filename)
+			return gzip.open(filename, "rb"), None
+	elif compression == "xz":
+		return lzma.open(filename, "rb"), None
+	elif compression == "zstd":
+		return io.BufferedReader(ZstdReader(filename), buffer_size=BUFFER_SIZE), None
+	else:
+		raise ValueError("unknown compression %s" % compression)
+
+
+def open_file(filename: str) -> IO[bytes]:
+	"""Open filename for reading in binary mode, decompressed if it is compressed."""
+	compression = get_compression(filename)
+
+	if compression:
+		return open_compressed(filename, compression)[0]
+
+	return open(filename, "rb")
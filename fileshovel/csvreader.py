@@ -1,25 +1,146 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
 import csv
-from typing import Iterable, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+from fileshovel import profiling
+from fileshovel.linefilter import ColumnFilter, compile_row_filter
 from fileshovel.lineio import TellableLineIO
 
 
+class LineFeed:
+	"""Lines of a file handed to 'csv.reader' one record at a time.
+
+	The line set by the caller is returned first, then the lines of the file
+	when the record spans more lines.
+	"""
+
+	__slots__ = ("line", "lines")
+
+	def __init__(self, lines: Iterator[str]):
+		self.line = None
+		self.lines = lines
+
+	def __iter__(self):
+		return self
+
+	def __next__(self) -> str:
+		line = self.line
+		if line is None:
+			return next(self.lines)
+		self.line = None
+		return line
+
+
 class CsvReader:
 
-	def __init__(self, csv_file: TellableLineIO, last_offset=0, *args, **kwargs):
-		"""Wrapper around 'csv.reader' to iterate over line and offset."""
+	def __init__(self, csv_file: TellableLineIO, last_offset=0, *args, select_columns: List[int] = None,
+			column_filters: List[ColumnFilter] = None, last_inode: int = None, **kwargs):
+		"""Wrapper around 'csv.reader' to iterate over line and offset.
+
+		Lines are split directly on the delimiter, only records holding a quote
+		go through 'csv.reader' with every line they span. When select_columns is
+		set, only these columns are returned, in this order. Rows not matching
+		every (index, value, equal) of column_filters are dropped before.
+		When last_inode is set, last_offset is an offset of the file with this
+		inode, which may have been rotated.
+
+		When csv_file is nonblocking, None is yielded each time it runs out of
+		lines and quoted records are only parsed once all their lines are read.
+		"""
 		self.csv_file = csv_file
+		self.select_columns = select_columns
+		self.column_filters = column_filters or []
+		self.rows_filtered = 0
+		self.delimiter = kwargs.get("delimiter", ",")
+		self.line_num = 0
+		self._reader_args = args
+		self._reader_kwargs = kwargs
+		self.reader = None
 
-		if last_offset > 0:
+		# the file is read from the start when the offset doesn't belong to it anymore
+		if last_offset > 0 and self.csv_file.seek(last_offset, inode=last_inode) > 0:
 			self.csv_file.skip_lines = 0
-			self.csv_file.seek(last_offset)
 
-		self.reader = csv.reader(csv_file, *args, **kwargs)
+		# other dialect options change quoting rules, let csv.reader handle every line
+		self.fast_split = not args and set(kwargs) <= {"delimiter"} and len(self.delimiter) == 1
+
+	def _split_lines(self, lines: Iterator[str], maxsplit: int) -> Iterator[List[str]]:
+		delimiter = self.delimiter
+		feed = LineFeed(lines)
+		reader = self.reader = csv.reader(feed, *self._reader_args, **self._reader_kwargs)
+
+		for line in lines:
+			if '"' in line:
+				# splitting quoted lines in Python is slower than the csv module, it takes the lines of this record
+				feed.line = line
+				yield next(reader, [])
+				continue
 
-	def __iter__(self) -> Iterable[Tuple[str, int, int]]:
+			line = line.rstrip("\r\n")
+			yield line.split(delimiter, maxsplit) if line else []
+
+	def _split_records(self, lines: Iterator[Optional[str]], maxsplit: int) -> Iterator[Optional[List[str]]]:
+		"""Split lines which may be interrupted by None, a record spans lines until its quotes are balanced."""
+		delimiter = self.delimiter
+		quote_char = self._reader_kwargs.get("quotechar", '"')
+		fast_split = self.fast_split
+		record = []
+		quotes = 0
+
+		for line in lines:
+			if line is None:
+				yield None
+			elif record or not fast_split or quote_char in line:
+				record.append(line)
+				quotes += line.count(quote_char)
+				if quotes % 2 == 0:
+					yield next(csv.reader(record, *self._reader_args, **self._reader_kwargs), [])
+					record.clear()
+					quotes = 0
+			else:
+				line = line.rstrip("\r\n")
+				yield line.split(delimiter, maxsplit) if line else []
+
+	def __iter__(self) -> Iterable[Optional[Tuple[List[str], int, int]]]:
 		csv_file = self.csv_file
+		select_columns = self.select_columns
+		row_filter = compile_row_filter(self.column_filters)
+		split_columns = select_columns and select_columns + [x[0] for x in self.column_filters]
+		maxsplit = max(split_columns) + 1 if split_columns else -1
+
+		lines = iter(csv_file)
+		timer = profiling.stage_timer
+
+		if timer:
+			lines = timer.timed(lines, "read")
+
+		if csv_file.nonblocking:
+			rows = self._split_records(lines, maxsplit)
+		elif self.fast_split:
+			# fields after the last selected column are never split
+			rows = self._split_lines(lines, maxsplit)
+		else:
+			rows = self.reader = csv.reader(lines, *self._reader_args, **self._reader_kwargs)
+
+		if timer:
+			rows = timer.timed(rows, "parse")
+
+		for row in rows:
+			if row is None:
+				yield None
+				continue
+
+			if row_filter is not None and not row_filter(row):
+				self.rows_filtered += 1
+				continue
+
+			self.line_num += 1
+
+			if select_columns:
+				try:
+					row = [row[x] for x in select_columns]
+				except IndexError:
+					row = [row[x] for x in select_columns if x < len(row)]
 
-		for line in self.reader:
-			yield line, csv_file.current_line, csv_file.current_line_offset
+			yield row, csv_file.current_line, csv_file.current_line_offset
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import argparse
+import csv
+import logging
+import sys
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from fileshovel.indexer import CsvIndex, CsvIndexer
+from fileshovel.options import FileShovelOptions
+
+log = logging.getLogger("fileshovel.extract")
+
+
+class ExtractOptions(FileShovelOptions):
+	PROG = "fileshovel extract"
+
+	def add_arguments(self, parser: argparse.ArgumentParser):
+		parser.add_argument("--from", dest="extract_from", type=str, required=True,
+							help=ExtractOptions.extract_from.__doc__)
+		parser.add_argument("--to", dest="extract_to", type=str, required=True,
+							help=ExtractOptions.extract_to.__doc__)
+		parser.add_argument("--output", dest="extract_output", type=str, default="csv", choices=("csv", "pgsql"),
+							help=ExtractOptions.extract_output.__doc__)
+
+	@property
+	def extract_from(self) -> datetime:
+		"""first date to extract, using --csv-date-format"""
+		return datetime.strptime(self.args.extract_from, self.csv_date_format)
+
+	@property
+	def extract_to(self) -> datetime:
+		"""last date to extract, using --csv-date-format"""
+		return datetime.strptime(self.args.extract_to, self.csv_date_format)
+
+	@property
+	def extract_output(self) -> str:
+		"""write extracted rows to stdout as CSV or insert them in --pg-table --output=csv|pgsql"""
+		return self.args.extract_output
+
+
+def find_extract_span(index: CsvIndex, start: datetime, end: datetime) -> Optional[Tuple[int, int]]:
+	"""Return the offsets of the first and last lines which may hold rows dated from start to end.
+
+	The neighbouring entries are included so rows between two sampled index
+	entries, or slightly out of order, aren't missed.
+	"""
+	entries = list(index.find_range(start, end))
+	before = index.find_offset_before(start)
+	after = index.find_offset_after(end)
+
+	if not entries and before is None:
+		return None
+
+	offsets = [x.offset for x in entries + [before, after] if x is not None]
+	return min(offsets), (max(offsets) if after is not None else None)
+
+
+def extract_rows(options: FileShovelOptions, start: datetime, end: datetime,
+		indexer: CsvIndexer) -> Iterable[Tuple[List[str], int, int]]:
+	span = find_extract_span(indexer.index, start, end)
+
+	if span is None:
+		log.info("no row between %s and %s", start, end)
+		return
+
+	start_offset, end_offset = span
+	date_column = options.date_column
+	date_format = options.csv_date_format
+	log.info("extracting from offset %d to %s", start_offset, end_offset if end_offset is not None else "end of file")
+
+	# resuming skips the line at the offset, start from the newline ending the previous line instead
+	reader = options.get_csv_file_reader(last_offset=max(start_offset - 1, 0), watch=False)
+	# lines of the reader are counted from the one it skipped
+	first_line = indexer.get_line_at(start_offset) - 1 if start_offset > 0 else 0
+
+	for line, current_line, current_line_offset in reader:
+		current_line += first_line
+
+		if end_offset is not None and current_line_offset > end_offset:
+			break
+
+		try:
+			dt = datetime.strptime(line[date_column], date_format)
+		except (IndexError, ValueError) as e:
+			log.warning("ignoring line %d at offset %d: %s", current_line, current_line_offset, e)
+			continue
+
+		if start <= dt <= end:
+			yield line, current_line, current_line_offset
+
+
+def main(argv: List[str] = None):
+	args = ExtractOptions(argv)
+	args.setup_logging()
+	# the index belongs to the follower of the file, rows it didn't index yet are only indexed in memory
+	indexer = CsvIndexer(args, read_only=True)
+
+	try:
+		rows = extract_rows(args, args.extract_from, args.extract_to, indexer)
+
+		if args.extract_output == "pgsql":
+			from fileshovel.pgsql import PgLineInserter
+			# the checkpoints and the spool belong to the follower of the file
+			inserter = PgLineInserter(args, write_checkpoints=False)
+			try:
+				for line, current_line, current_line_offset in rows:
+					inserter.add_row(line, current_line, current_line_offset)
+			finally:
+				inserter.done()
+		else:
+			writer = csv.writer(sys.stdout, delimiter=args.csv_delimiter, lineterminator="\n")
+			for line, _, _ in rows:
+				writer.writerow(line)
+
+	finally:
+		indexer.close()
@@ -1,27 +1,51 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import glob
+import json
 import logging
+import mmap
 import os
-import pickle
-from datetime import datetime
-from typing import List
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from heapq import merge
+from typing import Iterator, List, Optional, Tuple
 from uuid import UUID
 
-from options import FileShovelOptions
+from fileshovel import compressed
+from fileshovel.options import FileShovelOptions
 
 log = logging.getLogger("fileshovel.indexer")
 
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+NO_UUID = bytes(16)
+
+
+def datetime_to_timestamp(dt: datetime) -> int:
+	"""Microseconds since epoch, aware datetimes are converted to UTC and naive ones are kept as is."""
+	if dt.tzinfo is not None:
+		dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+	return (dt - EPOCH) // ONE_MICROSECOND
+
+
+def timestamp_to_datetime(timestamp: int) -> datetime:
+	return EPOCH + timedelta(microseconds=timestamp)
+
 
 class CsvIndexOffset:
 	def __init__(self, line: int, offset: int, date: datetime, uuid: UUID = None):
 		self.line = line
 		self.offset = offset
 		self.date = date
-		self._uuid = uuid.bytes
+		self.uuid = uuid
 
 	@property
 	def uuid(self):
-		return UUID(bytes=self._uuid)
+		if self._uuid:
+			return UUID(bytes=self._uuid)
 
 	@uuid.setter
 	def uuid(self, uuid: UUID):
@@ -30,59 +54,534 @@ class CsvIndexOffset:
 		else:
 			self._uuid = None
 
+	def __repr__(self):
+		return "CsvIndexOffset(line=%d, offset=%d, date=%s)" % (self.line, self.offset, self.date)
+
 
 class CsvIndex:
-	CURRENT_VERSION = 3
+	"""Entries sorted by date stored as fixed-width arrays, memory-mapped when loaded from disk.
+
+	File layout, little endian: header, JSON metadata padded to 8 bytes, then the
+	date (int64 microseconds), line (int64), offset (int64) and uuid (16 bytes) arrays.
+	Entries added to a memory-mapped index are kept in an in-memory tail until saved.
+	"""
+	CURRENT_VERSION = 4
+	MAGIC = b"FSHVLIDX"
+	HEADER = struct.Struct("<8sIIQ")
 
 	def __init__(self, columns: List[str], date_column: int, date_format: str):
 		self.version = CsvIndex.CURRENT_VERSION
 		self.columns = columns
 		self.date_column = date_column
 		self.date_format = date_format
-		self.date_index = {}
-		self.uuid_index = {}
+		self._dates = array("q")
+		self._lines = array("q")
+		self._offsets = array("q")
+		self._uuids = bytearray()
+		self._uuid_start = 0
+		self._sorted = True
+		self._mmap = None
+		self._tail = None
+		self.resume_offset = None
+		self.resume_line = None
+		self.inode = None
+
+	def __len__(self) -> int:
+		return len(self._dates) + (len(self._tail) if self._tail else 0)
+
+	@property
+	def metadata(self) -> dict:
+		return {
+			"columns": self.columns,
+			"date_column": self.date_column,
+			"date_format": self.date_format,
+			"resume_offset": self.resume_offset,
+			"resume_line": self.resume_line,
+			"inode": self.inode,
+		}
+
+	def _parts(self) -> List["CsvIndex"]:
+		return [self, self._tail] if self._tail else [self]
 
 	def is_compatible(self, other_index) -> bool:
 		if isinstance(other_index, CsvIndex):
 			return self.version == other_index.version and \
 					len(self.columns) == len(other_index.columns) and \
 					self.date_column == other_index.date_column and \
-					self.date_format == other_index.date_format and \
-					isinstance(next(iter(other_index.date_index.values())), CsvIndexOffset)
+					self.date_format == other_index.date_format
 		return False
 
+	def _get_uuid(self, position: int) -> bytes:
+		start = self._uuid_start + position * 16
+		return self._uuids[start:start + 16]
+
+	def _make_writable(self):
+		if self._mmap is not None:
+			dates = array("q", self._dates)
+			lines = array("q", self._lines)
+			offsets = array("q", self._offsets)
+			uuids = bytearray(self._uuids[self._uuid_start:self._uuid_start + len(dates) * 16])
+			self._unmap()
+			self._dates, self._lines, self._offsets, self._uuids = dates, lines, offsets, uuids
+
+		if self._tail:
+			tail = self._tail
+			self._tail = None
+			if tail._dates and self._dates and tail._dates[0] < self._dates[-1]:
+				self._sorted = False
+			self._sorted = self._sorted and tail._sorted
+			self._dates.extend(tail._dates)
+			self._lines.extend(tail._lines)
+			self._offsets.extend(tail._offsets)
+			self._uuids += tail._uuids
+
 	def add_index(self, line: int, offset_index: int, dt: datetime, uuid: UUID = None) -> CsvIndexOffset:
-		offset_index = CsvIndexOffset(line, offset_index, dt, uuid)
-		self.date_index[dt] = offset_index
-		if uuid:
-			self.uuid_index[uuid] = offset_index
-		return offset_index
+		self.resume_offset = offset_index
+		self.resume_line = line
+
+		if self._mmap is not None:
+			if self._tail is None:
+				self._tail = CsvIndex(self.columns, self.date_column, self.date_format)
+			return self._tail.add_index(line, offset_index, dt, uuid)
+
+		timestamp = datetime_to_timestamp(dt)
+
+		if self._dates and timestamp < self._dates[-1]:
+			self._sorted = False
+
+		self._dates.append(timestamp)
+		self._lines.append(line)
+		self._offsets.append(offset_index)
+		self._uuids += uuid.bytes if uuid else NO_UUID
+		return CsvIndexOffset(line, offset_index, dt, uuid)
+
+	def get_entry(self, position: int) -> CsvIndexOffset:
+		uuid = bytes(self._get_uuid(position))
+		return CsvIndexOffset(
+			self._lines[position],
+			self._offsets[position],
+			timestamp_to_datetime(self._dates[position]),
+			UUID(bytes=uuid) if uuid != NO_UUID else None,
+		)
 
-	def find_offset_from_datetime(self, dt: datetime) -> CsvIndexOffset:
-		return self.date_index[dt]
+	def sort(self):
+		if not self._sorted:
+			self._make_writable()
+			order = sorted(range(len(self._dates)), key=self._dates.__getitem__)
+			uuids = self._uuids
+			self._dates = array("q", (self._dates[x] for x in order))
+			self._lines = array("q", (self._lines[x] for x in order))
+			self._offsets = array("q", (self._offsets[x] for x in order))
+			self._uuids = bytearray(b"".join(uuids[x * 16:x * 16 + 16] for x in order))
+			self._sorted = True
+
+	def find_offset_from_datetime(self, dt: datetime, exact=True) -> CsvIndexOffset:
+		"""Find the first entry at dt, or the nearest one if exact is False."""
+		entries = []
+
+		for index in self._parts():
+			try:
+				entries.append(index._find_offset_from_datetime(dt, exact))
+			except KeyError:
+				pass
+
+		if not entries:
+			raise KeyError(dt)
+
+		return min(entries, key=lambda x: abs(x.date - dt))
+
+	def _find_offset_from_datetime(self, dt: datetime, exact: bool) -> CsvIndexOffset:
+		self.sort()
+		timestamp = datetime_to_timestamp(dt)
+		position = bisect_left(self._dates, timestamp)
+
+		if exact:
+			if position == len(self._dates) or self._dates[position] != timestamp:
+				raise KeyError(dt)
+		else:
+			if not self._dates:
+				raise KeyError(dt)
+			if position == len(self._dates) or \
+					(position > 0 and timestamp - self._dates[position - 1] < self._dates[position] - timestamp):
+				position -= 1
+
+		return self.get_entry(position)
+
+	def find_offset_before(self, dt: datetime) -> Optional[CsvIndexOffset]:
+		"""Find the last entry dated before dt."""
+		entries = [x._find_offset_beside(dt, before=True) for x in self._parts()]
+		return max((x for x in entries if x), key=lambda x: x.date, default=None)
+
+	def find_offset_after(self, dt: datetime) -> Optional[CsvIndexOffset]:
+		"""Find the first entry dated after dt."""
+		entries = [x._find_offset_beside(dt, before=False) for x in self._parts()]
+		return min((x for x in entries if x), key=lambda x: x.date, default=None)
+
+	def _find_offset_beside(self, dt: datetime, before: bool) -> Optional[CsvIndexOffset]:
+		self.sort()
+		timestamp = datetime_to_timestamp(dt)
+
+		if before:
+			position = bisect_left(self._dates, timestamp) - 1
+		else:
+			position = bisect_right(self._dates, timestamp)
+
+		if 0 <= position < len(self._dates):
+			return self.get_entry(position)
+
+	def find_range(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[CsvIndexOffset]:
+		"""Iterate over the entries dated from start to end inclusively, ordered by date."""
+		if self._tail:
+			return merge(*(x._find_range(start, end) for x in self._parts()), key=lambda x: x.date)
+		else:
+			return self._find_range(start, end)
+
+	def _find_range(self, start: Optional[datetime], end: Optional[datetime]) -> Iterator[CsvIndexOffset]:
+		self.sort()
+		first = bisect_left(self._dates, datetime_to_timestamp(start)) if start else 0
+		last = bisect_right(self._dates, datetime_to_timestamp(end)) if end else len(self._dates)
+
+		for position in range(first, last):
+			yield self.get_entry(position)
 
 	def find_offset_from_uuid(self, uuid: UUID) -> CsvIndexOffset:
-		return self.uuid_index[uuid]
+		for index in self._parts():
+			try:
+				return index._find_offset_from_uuid(uuid)
+			except KeyError:
+				pass
+
+		raise KeyError(uuid)
+
+	def _find_offset_from_uuid(self, uuid: UUID) -> CsvIndexOffset:
+		uuids = self._uuids
+		start = self._uuid_start
+		end = start + len(self._dates) * 16
+		position = uuids.find(uuid.bytes, start, end)
+
+		while position != -1:
+			if (position - start) % 16 == 0:
+				return self.get_entry((position - start) // 16)
+			position = uuids.find(uuid.bytes, position + 1, end)
+
+		raise KeyError(uuid)
+
+	def save(self, filename: str):
+		"""Write the index atomically next to filename."""
+		self._make_writable()
+		self.sort()
+		metadata = json.dumps(self.metadata).encode("utf-8")
+		metadata += b"\0" * (-len(metadata) % 8)
+		temp_filename = filename + ".tmp"
+
+		with open(temp_filename, "wb") as index_file:
+			index_file.write(self.HEADER.pack(self.MAGIC, self.version, len(metadata), len(self._dates)))
+			index_file.write(metadata)
+			for values in (self._dates, self._lines, self._offsets):
+				index_file.write(values)
+			index_file.write(self._uuids[self._uuid_start:self._uuid_start + len(self._dates) * 16])
+			index_file.flush()
+			os.fsync(index_file.fileno())
+
+		os.replace(temp_filename, filename)
+
+	@classmethod
+	def load(cls, filename: str) -> "CsvIndex":
+		if sys.byteorder != "little":
+			raise ValueError("index files can only be read on little endian hosts")
+
+		with open(filename, "rb") as index_file:
+			index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		try:
+			magic, version, metadata_length, count = cls.HEADER.unpack_from(index_map)
+			if magic != cls.MAGIC:
+				raise ValueError("%s is not an index file" % filename)
+			if version != cls.CURRENT_VERSION:
+				raise ValueError("index version %d isn't supported" % version)
+
+			start = cls.HEADER.size + metadata_length
+			if len(index_map) < start + count * 40:
+				raise ValueError("index file is truncated")
+
+			metadata = json.loads(index_map[cls.HEADER.size:start].rstrip(b"\0").decode("utf-8"))
+			index = cls(metadata["columns"], metadata["date_column"], metadata["date_format"])
+			index.resume_offset = metadata.get("resume_offset")
+			index.resume_line = metadata.get("resume_line")
+			index.inode = metadata.get("inode")
+			with memoryview(index_map) as view:
+				index._dates = view[start:start + count * 8].cast("q")
+				index._lines = view[start + count * 8:start + count * 16].cast("q")
+				index._offsets = view[start + count * 16:start + count * 24].cast("q")
+			index._uuids = index_map
+			index._uuid_start = start + count * 24
+			index._mmap = index_map
+		except Exception:
+			index_map.close()
+			raise
+
+		return index
+
+	def _unmap(self):
+		for view in (self._dates, self._lines, self._offsets):
+			view.release()
+		index_map = self._mmap
+		self._dates, self._lines, self._offsets, self._uuids = array("q"), array("q"), array("q"), bytearray()
+		self._uuid_start = 0
+		self._mmap = None
+		index_map.close()
+
+	def close(self):
+		if self._mmap is not None:
+			self._unmap()
+		self._tail = None
+
+
+class CsvUuidIndex:
+	"""Memory-mapped open addressing hash table from uuid to line and offset.
+
+	File layout, little endian: header then a power of two number of slots,
+	each slot being the uuid (16 bytes), line (int64) and offset (int64),
+	empty slots having a null uuid. Collisions use linear probing.
+	"""
+	CURRENT_VERSION = 1
+	MAGIC = b"FSHVLUID"
+	HEADER = struct.Struct("<8sI4xQQq")
+	SLOT = struct.Struct("<16sqq")
+	LOAD_FACTOR = 0.7
+
+	def __init__(self, index_map: mmap.mmap, capacity: int, count: int, resume_offset: Optional[int]):
+		self._mmap = index_map
+		self.capacity = capacity
+		self.count = count
+		self.resume_offset = resume_offset
+
+	def __len__(self) -> int:
+		return self.count
+
+	@staticmethod
+	def _hash(uuid: bytes) -> int:
+		return int.from_bytes(uuid[:8], "little") ^ int.from_bytes(uuid[8:], "little")
+
+	def _find_slot(self, uuid: bytes) -> Tuple[int, bytes]:
+		"""Return the position of the slot holding uuid, or of the empty slot where it belongs."""
+		mask = self.capacity - 1
+		slot = self._hash(uuid) & mask
+		start = self.HEADER.size
+		slot_size = self.SLOT.size
+		index_map = self._mmap
+
+		while True:
+			position = start + slot * slot_size
+			slot_uuid = index_map[position:position + 16]
+			if slot_uuid == uuid or slot_uuid == NO_UUID:
+				return position, slot_uuid
+			slot = (slot + 1) & mask
+
+	def find(self, uuid: UUID) -> Optional[Tuple[int, int]]:
+		"""Return the line and offset of uuid."""
+		position, slot_uuid = self._find_slot(uuid.bytes)
+		if slot_uuid != NO_UUID:
+			_, line, offset = self.SLOT.unpack_from(self._mmap, position)
+			return line, offset
+
+	@staticmethod
+	def _entries(index: CsvIndex) -> List[int]:
+		return [x for x in range(len(index._dates)) if index._get_uuid(x) != NO_UUID]
+
+	def _insert(self, index: CsvIndex, entries: List[int]):
+		for position in entries:
+			uuid = bytes(index._get_uuid(position))
+			slot_position, slot_uuid = self._find_slot(uuid)
+			if slot_uuid == NO_UUID:
+				self.count += 1
+			self.SLOT.pack_into(self._mmap, slot_position, uuid, index._lines[position], index._offsets[position])
+
+	def _write_header(self):
+		resume_offset = -1 if self.resume_offset is None else self.resume_offset
+		self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self.CURRENT_VERSION, self.capacity, self.count, resume_offset)
+		self._mmap.flush()
+
+	@classmethod
+	def build(cls, filename: str, index: CsvIndex):
+		"""Write the hash table of every uuid of index atomically."""
+		entries = cls._entries(index)
+		capacity = 1
+		while capacity * cls.LOAD_FACTOR <= len(entries):
+			capacity *= 2
+
+		temp_filename = filename + ".tmp"
+		with open(temp_filename, "w+b") as uuid_file:
+			uuid_file.truncate(cls.HEADER.size + capacity * cls.SLOT.size)
+			uuid_index = cls(mmap.mmap(uuid_file.fileno(), 0), capacity, 0, index.resume_offset)
+
+			try:
+				uuid_index._insert(index, entries)
+				uuid_index._write_header()
+			finally:
+				uuid_index.close()
+
+			os.fsync(uuid_file.fileno())
+
+		os.replace(temp_filename, filename)
+
+	@classmethod
+	def extend(cls, filename: str, index: CsvIndex, resume_offset: Optional[int]) -> bool:
+		"""Add the uuids of index to the hash table file in place, False when it is too full to hold them.
+
+		The header is written last, a crash in between leaves a resume offset the index doesn't match.
+		"""
+		uuid_index = cls.load(filename, writable=True)
+
+		try:
+			entries = cls._entries(index)
+			if (uuid_index.count + len(entries)) >= uuid_index.capacity * cls.LOAD_FACTOR:
+				return False
+
+			uuid_index._insert(index, entries)
+			uuid_index.resume_offset = resume_offset
+			uuid_index._write_header()
+			return True
+		finally:
+			uuid_index.close()
+
+	@classmethod
+	def load(cls, filename: str, writable=False) -> "CsvUuidIndex":
+		with open(filename, "r+b" if writable else "rb") as uuid_file:
+			index_map = mmap.mmap(uuid_file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+		try:
+			magic, version, capacity, count, resume_offset = cls.HEADER.unpack_from(index_map)
+			if magic != cls.MAGIC or version != cls.CURRENT_VERSION:
+				raise ValueError("%s is not a uuid index file" % filename)
+			if len(index_map) < cls.HEADER.size + capacity * cls.SLOT.size:
+				raise ValueError("uuid index file is truncated")
+		except Exception:
+			index_map.close()
+			raise
+
+		return cls(index_map, capacity, count, None if resume_offset == -1 else resume_offset)
+
+	def close(self):
+		self._mmap.close()
+
+
+class CsvIndexLog:
+	"""Append-only file of index entries written while following, merged into the index when it is saved."""
+	MAGIC = b"FSHVLLOG"
+	RECORD = struct.Struct("<qqq16s")
+
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.count = 0
+		self._file = None
+
+	def read(self, read_only=False) -> Iterator[Tuple[int, int, int, bytes]]:
+		"""Iterate over complete records and drop a record truncated by a crash.
+
+		With read_only, an incomplete record is left as is, the process owning the log may be writing it."""
+		if not os.path.isfile(self.filename):
+			return
+
+		record_size = self.RECORD.size
+
+		with open(self.filename, "rb" if read_only else "r+b") as log_file:
+			if log_file.read(len(self.MAGIC)) != self.MAGIC:
+				if not read_only:
+					log.warning("ignoring invalid index log %s", self.filename)
+				return
+
+			while True:
+				record = log_file.read(record_size)
+				if len(record) < record_size:
+					if record and not read_only:
+						log.warning("dropping incomplete record at the end of %s", self.filename)
+						log_file.truncate(log_file.tell() - len(record))
+					break
+				self.count += 1
+				yield self.RECORD.unpack(record)
+
+	def append(self, timestamp: int, line: int, offset: int, uuid: bytes):
+		if self._file is None:
+			self._file = open(self.filename, "ab")
+			if self._file.tell() == 0:
+				self._file.write(self.MAGIC)
+		self._file.write(self.RECORD.pack(timestamp, line, offset, uuid))
+		self.count += 1
+
+	def flush(self, sync=False):
+		if self._file:
+			self._file.flush()
+			if sync:
+				os.fsync(self._file.fileno())
+
+	def clear(self):
+		self.close()
+		if os.path.isfile(self.filename):
+			os.remove(self.filename)
+		self.count = 0
+
+	def close(self):
+		if self._file:
+			self._file.close()
+			self._file = None
 
 
 class CsvIndexer:
+	FLUSH_EVERY = 1000
+
+	def __init__(self, options: FileShovelOptions, csv_file: str = None, build=True, read_only=False):
+		"""Load the index of csv_file, bring it up to date with the file unless build is False.
 
-	def __init__(self, options: FileShovelOptions):
+		With read_only, the files of the index are only read and rows indexed since it was saved are kept in
+		memory, the follower updating the index owns them.
+		"""
 		self._options = options
-		if os.path.isfile(self._options.index_file) and os.stat(self._options.index_file).st_size > 0:
-			self.index = self.load()
+		self.read_only = read_only
+		self.csv_file = csv_file or options.csv_file
+		self.index_file = options.get_index_file(self.csv_file)
+		self.index = None
+		self.uuid_index = None
+		self.uuid_index_file = self.index_file + ".uuid"
+		self.index_log = CsvIndexLog(self.index_file + ".log")
+		self.date_column = options.date_column
+		self.uuid_column = options.uuid_column
+		self.date_format = options.csv_date_format
+		self.every_nth = options.csv_index_every_nth_line or 0
+		# rows of a reader following the file are numbered from this line, known once a row of the file is read
+		self._line_base = None
+		self._last_offset = None
+		self._rotated_inodes = set()
+
+		if os.path.isfile(self.index_file) and os.stat(self.index_file).st_size > 0:
+			try:
+				self.index = self.load()
+			except ValueError:
+				log.info("rebuilding index %s", self.index_file)
+
+		if self.index is None:
+			self.index = self.create_index()
+			self.index.inode = self.get_inode()
+			if not read_only:
+				self.index_log.clear()
+				self.save()
 		else:
-			self.index = self.build_new_index()
-			self.save()
+			self.load_uuid_index()
+			self.replay_log()
+			if not self.is_indexing_file():
+				self.start_index(self.get_inode(), retire=True)
+
+		if build:
+			self.update()
+			if self.index_log.count > 0 and not read_only:
+				self.save()
 
 	def load(self) -> CsvIndex:
 		try:
-			with open(self._options.index_file, 'rb') as index_file:
-				index = pickle.load(index_file)
-			if not isinstance(index, CsvIndex):
-				raise TypeError("invalid type in pickle file: %s" % type(index))
+			index = CsvIndex.load(self.index_file)
 
 			if not self.create_index().is_compatible(index):
+				index.close()
 				raise ValueError("index format on disk isn't compatible with options")
 		except Exception as e:
 			log.warning("index is corrupt or empty: %s", e)
@@ -90,9 +589,188 @@ class CsvIndexer:
 
 		return index
 
+	def get_inode(self) -> Optional[int]:
+		try:
+			return os.stat(self.csv_file).st_ino
+		except FileNotFoundError:
+			return None
+
+	def is_indexing_file(self) -> bool:
+		"""Tell if the index is the one of the file, which may have been replaced or truncated since it was saved."""
+		inode = self.get_inode()
+
+		if self.index.inode is None:
+			# indexes saved without their inode are assumed to be the ones of the file
+			self.index.inode = inode
+		elif self.index.inode != inode:
+			log.info("%s has been replaced since it was indexed", self.csv_file)
+			return False
+
+		resume_offset = self.index.resume_offset
+		if resume_offset is not None and inode is not None and not compressed.get_compression(self.csv_file) and \
+				resume_offset > os.path.getsize(self.csv_file):
+			log.info("%s has been truncated since it was indexed", self.csv_file)
+			return False
+
+		return True
+
+	def find_rotated_file(self, inode: int) -> Optional[str]:
+		"""Return the rotated file with inode, found with --csv-rotated-suffix."""
+		if not self._options.csv_rotated_suffix:
+			return None
+
+		for filename in glob.glob(glob.escape(self.csv_file) + self._options.csv_rotated_suffix):
+			if os.path.isfile(filename) and os.stat(filename).st_ino == inode:
+				return filename
+
+	def start_index(self, inode: Optional[int], retire=False):
+		"""Replace the index by an empty one of the file with inode.
+
+		With retire, the index is kept as the index of its rotated file when there is one, it is removed otherwise.
+		Read-only indexers only replace it in memory.
+		"""
+		rotated_file = None
+
+		if retire and not self.read_only and self.index.inode is not None:
+			rotated_file = self.find_rotated_file(self.index.inode)
+			if rotated_file:
+				self.save()
+
+		self.index.close()
+		if self.uuid_index is not None:
+			self.uuid_index.close()
+			self.uuid_index = None
+
+		self.index = self.create_index()
+		self.index.inode = inode
+		self._line_base = None
+		self._last_offset = None
+
+		if self.read_only:
+			return
+
+		for filename in (self.index_file, self.uuid_index_file):
+			if rotated_file:
+				log.info("keeping %s as the index of %s", filename, rotated_file)
+				os.replace(filename, filename.replace(self.index_file, self._options.get_index_file(rotated_file), 1))
+			elif os.path.isfile(filename):
+				os.remove(filename)
+
+		self.index_log.clear()
+		self.save()
+
+	def load_uuid_index(self):
+		"""Open the uuid hash table if it matches the index, otherwise rebuild it.
+
+		Read-only indexers search the index itself instead of rebuilding it."""
+		if self.uuid_column is None:
+			return
+
+		try:
+			self.uuid_index = CsvUuidIndex.load(self.uuid_index_file)
+			if self.uuid_index.resume_offset != self.index.resume_offset:
+				self.uuid_index.close()
+				self.uuid_index = None
+		except (OSError, ValueError) as e:
+			log.info("uuid index %s isn't usable: %s", self.uuid_index_file, e)
+
+		if self.uuid_index is None and not self.read_only:
+			CsvUuidIndex.build(self.uuid_index_file, self.index)
+			self.uuid_index = CsvUuidIndex.load(self.uuid_index_file)
+
+	def replay_log(self):
+		"""Add the entries of the log which aren't in the saved index yet."""
+		resume_offset = self.index.resume_offset
+
+		for timestamp, line, offset, uuid in self.index_log.read(self.read_only):
+			if resume_offset is None or offset > resume_offset:
+				self.index.add_index(line, offset, timestamp_to_datetime(timestamp),
+						UUID(bytes=uuid) if uuid != NO_UUID else None)
+
 	def save(self):
-		with open(self._options.index_file, 'wb') as index_file:
-			pickle.dump(self.index, index_file)
+		"""Merge the log into the index file and start a new log."""
+		# entries added since the index was loaded, None when it was built in memory
+		if self.index._mmap is not None:
+			added = self.index._tail or self.create_index()
+		else:
+			added = None
+
+		self.index_log.close()
+		self.index.save(self.index_file)
+		self.index_log.clear()
+		self.index.close()
+		self.index = CsvIndex.load(self.index_file)
+
+		if self.uuid_index is not None:
+			self.uuid_index.close()
+			self.uuid_index = None
+			try:
+				if added is not None and not CsvUuidIndex.extend(self.uuid_index_file, added, self.index.resume_offset):
+					log.debug("uuid index %s is full, rebuilding it", self.uuid_index_file)
+			except (OSError, ValueError) as e:
+				log.info("uuid index %s isn't usable: %s", self.uuid_index_file, e)
+		self.load_uuid_index()
+
+	def close(self):
+		if self.index_log.count > 0 and not self.read_only:
+			self.save()
+		self.index.close()
+		if self.uuid_index is not None:
+			self.uuid_index.close()
+
+	def find_offset_from_uuid(self, uuid: UUID) -> Tuple[int, int]:
+		"""Return the line and offset of uuid using the hash table, then the entries not saved yet."""
+		if self.uuid_index is not None:
+			found = self.uuid_index.find(uuid)
+			if found:
+				return found
+
+			if self.index._tail is None:
+				raise KeyError(uuid)
+			entry = self.index._tail.find_offset_from_uuid(uuid)
+		else:
+			entry = self.index.find_offset_from_uuid(uuid)
+
+		return entry.line, entry.offset
+
+	def count_lines(self, start: int, end: int) -> int:
+		"""Count the line feeds of the file from offset start to end."""
+		count = 0
+
+		with compressed.open_file(self.csv_file) as csv_file:
+			csv_file.seek(start)
+			remaining = end - start
+			while remaining > 0:
+				block = csv_file.read(min(remaining, 1 << 20))
+				if not block:
+					break
+				count += block.count(b"\n")
+				remaining -= len(block)
+
+		return count
+
+	def get_line_at(self, offset: int) -> int:
+		"""Return the line number of the row at offset, which line numbers of a reader resumed from it are added to.
+
+		It is counted from the last indexed row, or from the start of the file when nothing is indexed yet.
+		"""
+		if offset == 0:
+			return 0
+
+		resume_offset = self.index.resume_offset
+
+		if resume_offset is None or self.index.resume_line is None:
+			return self.count_lines(0, offset) - self._options.csv_skip_lines + 1
+		elif offset >= resume_offset:
+			return self.index.resume_line + self.count_lines(resume_offset, offset)
+		else:
+			return self.index.resume_line - self.count_lines(offset, resume_offset)
+
+	def read_row(self, offset: int) -> bytes:
+		"""Return the raw CSV line starting at offset."""
+		with compressed.open_file(self.csv_file) as csv_file:
+			csv_file.seek(offset)
+			return csv_file.readline()
 
 	def create_index(self) -> CsvIndex:
 		return CsvIndex(
@@ -101,22 +779,88 @@ class CsvIndexer:
 			self._options.csv_date_format,
 		)
 
-	def build_new_index(self) -> CsvIndex:
-		index = self.create_index()
-		reader = self._options.get_csv_file_reader()
-		date_column = self._options.date_column
-		uuid_column = self._options.uuid_column
-		date_format = self._options.csv_date_format
+	def add_row(self, line: List[str], current_line: int, current_line_offset: int) -> Optional[CsvIndexOffset]:
+		"""Index a row read while following the file, rows already indexed are ignored.
+
+		With --csv-index-every-nth-line, only rows whose line number is a multiple of it are indexed, readers
+		always read every row."""
+		resume_offset = self.index.resume_offset
+		if resume_offset is not None and current_line_offset <= resume_offset:
+			return None
+		if self.every_nth and current_line % self.every_nth != 0:
+			return None
+
+		try:
+			dt = datetime.strptime(line[self.date_column], self.date_format)
+			uuid = UUID(line[self.uuid_column]) if self.uuid_column is not None else None
+		except (IndexError, ValueError) as e:
+			log.warning("not indexing line %d at offset %d: %s", current_line, current_line_offset, e)
+			return None
+
+		entry = self.index.add_index(current_line, current_line_offset, dt, uuid)
+
+		if self.read_only:
+			return entry
+
+		self.index_log.append(datetime_to_timestamp(dt), current_line, current_line_offset,
+				uuid.bytes if uuid else NO_UUID)
+
+		if self.index_log.count % self.FLUSH_EVERY == 0:
+			self.index_log.flush()
+
+		# saving rewrites the whole index, keep it amortized by waiting for the log to be as big
+		if self.index_log.count > max(len(self.index) // 2, 100000):
+			self.save()
 
-		for line in range(self._options.csv_skip_lines):
-			next(reader)
+		return entry
 
+	def follow_row(self, line: List[str], current_line: int, current_line_offset: int,
+			inode: int) -> Optional[CsvIndexOffset]:
+		"""Index a row of a reader following the file, current_line being counted by the reader.
+
+		Rows of rotated files read before the file are left out, the index starts again when the reader moves
+		to the file replacing the indexed one or when the file is truncated.
+		"""
+		if inode != self.index.inode:
+			if inode in self._rotated_inodes:
+				return None
+			if inode != self.get_inode():
+				self._rotated_inodes.add(inode)
+				return None
+			self.start_index(inode, retire=True)
+		elif self._last_offset is not None and current_line_offset < self._last_offset:
+			log.info("%s has been truncated, indexing it again", self.csv_file)
+			self.start_index(inode)
+
+		self._last_offset = current_line_offset
+
+		if self._line_base is None:
+			line_at = self.get_line_at(current_line_offset) if current_line_offset else 1 - self._options.csv_skip_lines
+			self._line_base = line_at - current_line
+
+		return self.add_row(line, self._line_base + current_line, current_line_offset)
+
+	def update(self):
+		"""Index the rows appended to the file since the last indexed offset."""
+		resume_offset = self.index.resume_offset or 0
+		first_line = self.get_line_at(resume_offset)
+		reader = self._options.get_csv_file_reader(
+			last_offset=resume_offset,
+			csv_file=self.csv_file,
+			watch=False,
+		)
+		log.info("indexing %s from offset %d", self.csv_file, resume_offset)
+
+		# lines of the reader are counted from where it resumed
 		for line, current_line, current_line_offset in reader:
-			index.add_index(
-				current_line,
-				current_line_offset,
-				datetime.strptime(line[date_column], date_format),
-				UUID(line[uuid_column]) if uuid_column else None,
-			)
+			self.add_row(line, first_line + current_line, current_line_offset)
 
-		return index
+		self.index_log.flush(sync=True)
+
+	def build_new_index(self) -> CsvIndex:
+		self.index.close()
+		self.index = self.create_index()
+		self.index_log.clear()
+		self.update()
+		self.save()
+		return self.index
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import re
+from typing import Callable, List, Optional, Pattern, Sequence, Tuple, Union
+
+LineFilter = Callable[[bytes], object]
+RowFilter = Callable[[List[str]], bool]
+ColumnFilter = Tuple[int, str, bool]
+
+
+def _search_any(patterns: Sequence[bytes]) -> Optional[Callable]:
+	if not patterns:
+		return None
+	return re.compile(b"|".join(b"(?:%s)" % x for x in patterns)).search
+
+
+def compile_line_filter(include: Sequence[bytes] = (), exclude: Sequence[bytes] = (),
+		required: Sequence[bytes] = ()) -> Optional[LineFilter]:
+	"""Return a function telling if a raw line is kept, or None when every line is kept.
+
+	A line is kept when it matches one of the include regexes, none of the exclude regexes and holds
+	every required substring. A single condition is the search method of its regex, called from C.
+	"""
+	conditions = [(x, True) for x in [_search_any(include)] + [_search_any([re.escape(x)]) for x in required] if x]
+	exclude_search = _search_any(exclude)
+
+	if exclude_search:
+		conditions.append((exclude_search, False))
+
+	if not conditions:
+		return None
+
+	if len(conditions) == 1 and conditions[0][1]:
+		return conditions[0][0]
+
+	conditions = tuple(conditions)
+
+	def keep(line: bytes) -> bool:
+		for search, wanted in conditions:
+			if (search(line) is None) is wanted:
+				return False
+		return True
+
+	return keep
+
+
+def compile_row_filter(column_filters: Sequence[ColumnFilter]) -> Optional[RowFilter]:
+	"""Return a function telling if a parsed row is kept, None without filters.
+
+	Each filter is (index, value, equal), a missing field equals no value.
+	"""
+	if not column_filters:
+		return None
+
+	column_filters = tuple(column_filters)
+
+	def keep(row: List[str]) -> bool:
+		width = len(row)
+		for index, value, equal in column_filters:
+			if ((row[index] if index < width else None) == value) is not equal:
+				return False
+		return True
+
+	return keep
+
+
+def required_substrings(column_filters: Sequence[ColumnFilter], encoding: str, delimiter: str,
+		quote_char: str = '"') -> List[bytes]:
+	"""Return the bytes a raw line must hold for the equality filters to match, checked before parsing.
+
+	Values the CSV format may escape or split are left to the row filter.
+	"""
+	required = []
+
+	for _, value, equal in column_filters:
+		if equal and value and not any(x in value for x in (delimiter, quote_char, "\r", "\n")):
+			required.append(value.encode(encoding))
+
+	return required
+
+
+def _shift_template(template: bytes, offset: int) -> bytes:
+	"""Renumber the group references of a replacement template by offset."""
+	def shift(match):
+		number = match.group(1) or match.group(2)
+		if number is None:
+			return match.group(0)
+		return b"\\g<%d>" % (int(number) + offset)
+
+	return re.sub(rb"\\(?:(\d+)|g<(\d+)>|.)", shift, template, flags=re.DOTALL)
+
+
+def compile_rewrite_rules(rules: Sequence[Tuple[bytes, bytes]]) -> Tuple[Optional[Pattern],
+		Optional[Union[bytes, Callable]]]:
+	"""Return the regex and replacement applying ordered rewrite rules in one pass over a line.
+
+	With many rules, each is an alternative of one regex, the first rule matching at a position wins
+	and its replacement template is expanded with its own group numbers.
+	"""
+	if not rules:
+		return None, None
+
+	if len(rules) == 1:
+		return re.compile(rules[0][0]), rules[0][1]
+
+	alternatives = []
+	templates = {}
+	offset = 0
+
+	for i, (search, replace) in enumerate(rules):
+		name = "rule%d" % i
+		alternatives.append(b"(?P<%s>%s)" % (name.encode(), search))
+		# the group of the rule comes before its own groups
+		offset += 1
+		templates[name] = replace if b"\\" not in replace else _shift_template(replace, offset)
+		offset += re.compile(search).groups
+
+	literal = {k: v for k, v in templates.items() if b"\\" not in v}
+
+	def replace_match(match) -> bytes:
+		name = match.lastgroup
+		template = literal.get(name)
+		return template if template is not None else match.expand(templates[name])
+
+	return re.compile(b"|".join(alternatives)), replace_match
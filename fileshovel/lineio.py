@@ -1,18 +1,29 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import asyncio
+import glob
 import io
 import logging
 import os
 import re
 import time
 from enum import Enum
-from typing import Iterable, Optional, List, IO
+from queue import Queue, Empty
+from threading import Lock, Thread
+from typing import Callable, Iterable, Optional, List, IO, Tuple
 
 import pyinotify
 from pyinotify import WatchManager, Notifier, Event
 
+from fileshovel import profiling
+from fileshovel.compressed import GzipSeekIndex, MAGIC_LENGTH, detect_compression, get_compression, \
+		open_compressed, SEEK_INDEX_SUFFIX
+
 log = logging.getLogger("fileshovel.lineio")
 
+# seconds to wait for a rotated file to be replaced once it is drained
+ROTATED_FILE_TIMEOUT = 300.0
+
 
 class FileEventNotifier(Notifier):
 
@@ -27,6 +38,98 @@ class FileEventNotifier(Notifier):
 		return events
 
 
+class FileWatch:
+
+	def __init__(self, filename: str):
+		"""Events of one file dispatched by a SharedFileWatcher, usable like a FileEventNotifier."""
+		self.filename = filename
+		self.wd = None
+		self.events = Queue()
+
+	def get_events(self, timeout) -> List[Event]:
+		try:
+			events = [self.events.get(timeout=timeout / 1000)]
+		except Empty:
+			return []
+
+		while True:
+			try:
+				events.append(self.events.get_nowait())
+			except Empty:
+				return events
+
+
+class SharedFileWatcher:
+
+	def __init__(self):
+		"""Single inotify instance dispatching events to every followed file."""
+		self._watch_manager = WatchManager()
+		self._notifier = FileEventNotifier(self._watch_manager)
+		self._notifier.coalesce_events(True)
+		self._watches = {}
+		self._lock = Lock()
+		self._thread = Thread(name="file_watcher", target=self._dispatch_events, daemon=True)
+		self._thread.start()
+
+	def add_watch(self, filename: str, mask: int) -> FileWatch:
+		watch = FileWatch(filename)
+
+		with self._lock:
+			watch.wd = self._watch_manager.add_watch(filename, mask=mask)[filename]
+			self._watches[watch.wd] = watch
+
+		return watch
+
+	def remove_watch(self, watch: FileWatch):
+		with self._lock:
+			if self._watches.pop(watch.wd, None):
+				self._watch_manager.rm_watch(watch.wd, quiet=True)
+
+	def _dispatch_events(self):
+		while True:
+			for event in self._notifier.get_events(timeout=1000):
+				with self._lock:
+					watch = self._watches.get(event.wd)
+
+				if watch:
+					watch.events.put(event)
+
+
+class AsyncFileWatcher:
+	WATCH_MASK = pyinotify.IN_MODIFY | \
+			pyinotify.IN_ATTRIB | \
+			pyinotify.IN_CREATE | \
+			pyinotify.IN_DELETE | \
+			pyinotify.IN_MOVED_FROM | \
+			pyinotify.IN_MOVED_TO
+
+	def __init__(self, loop: asyncio.AbstractEventLoop):
+		"""Single inotify instance read from an asyncio event loop, waking coroutines waiting on a file.
+
+		Parent directories are watched so a file replaced by rotation keeps being watched by name.
+		"""
+		self._watch_manager = WatchManager()
+		self._notifier = FileEventNotifier(self._watch_manager)
+		self._changes = {}
+		self._loop = loop
+		loop.add_reader(self._watch_manager.get_fd(), self._dispatch_events)
+
+	def add_watch(self, filename: str) -> asyncio.Event:
+		directory, name = os.path.split(os.path.abspath(filename))
+		wd = self._watch_manager.add_watch(directory, mask=self.WATCH_MASK)[directory]
+		return self._changes.setdefault((wd, name), asyncio.Event())
+
+	def close(self):
+		self._loop.remove_reader(self._watch_manager.get_fd())
+		self._notifier.stop()
+
+	def _dispatch_events(self):
+		for event in self._notifier.get_events(timeout=0):
+			changed = self._changes.get((event.wd, event.name))
+			if changed:
+				changed.set()
+
+
 class TellableLineIOEvent(Enum):
 	NOTHING = 0
 	MODIFY = 1
@@ -34,9 +137,14 @@ class TellableLineIOEvent(Enum):
 
 
 class TellableLineIO(io.TextIOBase):
+	WATCH_MASK = pyinotify.IN_MODIFY | \
+			pyinotify.IN_ATTRIB | \
+			pyinotify.IN_MOVE_SELF | \
+			pyinotify.IN_DELETE_SELF
 
 	def __init__(self, filename, mode, encoding, skip_lines=0, every_nth=0, watch=False, use_inotify=False,
-			regex_search=None, regex_replace: bytes = None):
+			regex_search=None, regex_replace: bytes = None, file_watcher: SharedFileWatcher = None,
+			rotated_glob: str = None, nonblocking=False, line_filter: Callable[[bytes], object] = None):
 		if 'b' not in mode:
 			mode += 'b'
 
@@ -55,30 +163,178 @@ class TellableLineIO(io.TextIOBase):
 		self.watch = watch
 		self._file = None
 		self._file_iter = None
+		self._seek_index: Optional[GzipSeekIndex] = None
+		self.compression = None
+		self._inode = None
 		self.open_file()
-		self._use_inotify = use_inotify
+
+		if self.compression and watch:
+			log.info("not watching %s, compressed files are read once", filename)
+			self.watch = False
+
+		self._use_inotify = use_inotify and not self.compression
+		self.file_watcher = file_watcher
 		self.regex_search = regex_search
 		self.regex_replace = regex_replace
+		self.rotated_glob = rotated_glob
+		self.nonblocking = nonblocking
+		self.line_filter = line_filter
+		self.lines_filtered = 0
+		self._rotated = False
+		self._rotated_files: List[str] = []
 		self.current_line = 0
 		self.current_line_offset = 0
+		self.bytes_read = 0
 
 	def open_file(self):
-		if self._file:
+		self._open(self.filename)
+
+	def _open(self, filename: str):
+		"""Replace the file being read by filename, decompressed if it is compressed."""
+		self._close_file()
+		self._file = open(filename, self.mode)
+		self._inode = None
+		self.compression = detect_compression(self._file.read(MAGIC_LENGTH))
+		self._file.seek(0)
+
+		if self.compression:
+			log.info("reading %s compressed with %s", filename, self.compression)
+			self._inode = os.fstat(self._file.fileno()).st_ino
 			self._file.close()
-		self._file = open(self.filename, self.mode)
+			self._file, self._seek_index = open_compressed(filename, self.compression)
+
 		self._file_iter = iter(self._file)
 
+	def _close_file(self):
+		if self._seek_index:
+			self._seek_index.save(self._file)
+			self._seek_index = None
+		if self._file:
+			self._file.close()
+
+	def close(self):
+		self._close_file()
+		super().close()
+
+	@property
+	def inode(self) -> int:
+		"""Inode of the file being read, renaming the file to rotate it keeps it."""
+		if self._inode is None:
+			self._inode = os.fstat(self._file.fileno()).st_ino
+		return self._inode
+
 	def get_size(self) -> int:
 		if self._file:
 			return os.fstat(self._file.fileno()).st_size
 
-	def seek(self, offset, whence=io.SEEK_SET) -> int:
+	def seek(self, offset, whence=io.SEEK_SET, inode: int = None) -> int:
+		"""Seek to offset, of the file with inode when it is set, rotated siblings are drained before the file.
+
+		Returns 0 without seeking when offset belongs to a file which isn't there anymore, or past the end of the
+		file when inode isn't known and no rotated sibling is long enough.
+		"""
 		log.debug("seeking to %d", offset)
-		if offset <= self.get_size():
+
+		if inode is not None and inode != self.inode:
+			rotated_files = self.find_rotated_files(inode) if self.rotated_glob else []
+			if not rotated_files:
+				log.warning("offset %d belongs to a file which isn't %s nor one of its rotated files, reading it "
+						"from the start", offset, self.filename)
+				return 0
+			log.info("resuming from rotated file %s before reading %s", rotated_files[0], self.filename)
+			self._open_rotated_files(rotated_files)
+			return self._file.seek(offset, whence)
+
+		# the size of a compressed file isn't its uncompressed size
+		if self.compression or offset <= self.get_size():
 			ret = self._file.seek(offset, whence)
 			return ret
-		else:
-			return 0
+		elif self.rotated_glob and inode is None:
+			rotated_file = self.find_rotated_file(offset)
+			if rotated_file:
+				log.info("resuming from rotated file %s before reading %s", rotated_file, self.filename)
+				self._open_rotated_files([rotated_file])
+				return self._file.seek(offset, whence)
+
+		return 0
+
+	def _get_rotated_files(self) -> List[str]:
+		"""Return the rotated siblings, oldest first."""
+		rotated_files = [
+			x for x in glob.glob(self.rotated_glob)
+			if os.path.isfile(x) and not os.path.samefile(x, self.filename) and not x.endswith(SEEK_INDEX_SUFFIX)
+		]
+		return sorted(rotated_files, key=os.path.getmtime)
+
+	def find_rotated_file(self, offset: int) -> Optional[str]:
+		"""Return the most recently rotated sibling if it still has lines after offset.
+
+		A compressed sibling is assumed to have them, its uncompressed size is unknown until it is read.
+		"""
+		rotated_files = self._get_rotated_files()
+
+		if rotated_files:
+			rotated_file = rotated_files[-1]
+			if os.path.getsize(rotated_file) > offset or get_compression(rotated_file):
+				return rotated_file
+
+	def find_rotated_files(self, inode: int) -> List[str]:
+		"""Return the rotated sibling with inode and the ones rotated after it which are left to read, oldest first."""
+		rotated_files = self._get_rotated_files()
+		inodes = [os.stat(x).st_ino for x in rotated_files]
+
+		if inode in inodes:
+			return rotated_files[inodes.index(inode):]
+		return []
+
+	def _open_rotated_files(self, rotated_files: List[str]):
+		"""Read rotated_files in order before the file itself."""
+		self._open(rotated_files[0])
+		self._rotated_files = rotated_files[1:]
+		self._rotated = True
+
+	def is_rotated(self) -> bool:
+		"""Tell if the filename now points to another file than the one being read."""
+		try:
+			return os.stat(self.filename).st_ino != os.fstat(self._file.fileno()).st_ino
+		except FileNotFoundError:
+			return True
+
+	def _open_rotated_file(self, event_watcher) -> Tuple[bool, object]:
+		"""Switch to the next rotated file left to read, or to the new file once the rotated ones are drained.
+
+		Returns if a file was opened and the new event watcher, nothing is opened when the new file isn't created
+		within ROTATED_FILE_TIMEOUT seconds.
+		"""
+		while self._rotated_files:
+			rotated_file = self._rotated_files.pop(0)
+			try:
+				self._open(rotated_file)
+				log.info("rotated file has been drained, reading %s", rotated_file)
+				return True, event_watcher
+			except FileNotFoundError:
+				log.warning("rotated file %s has been removed before being read", rotated_file)
+
+		deadline = time.monotonic() + ROTATED_FILE_TIMEOUT
+
+		while not os.path.isfile(self.filename):
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				log.warning("giving up on %s, it hasn't been created %d seconds after its rotated file was drained",
+						self.filename, ROTATED_FILE_TIMEOUT)
+				return False, event_watcher
+			log.debug("waiting for %s to be created", self.filename)
+			time.sleep(min(remaining, 1))
+
+		log.info("rotated file has been drained, re-opening %s", self.filename)
+		self._rotated = False
+		self.open_file()
+
+		if event_watcher:
+			self.close_watch_manager(event_watcher)
+			event_watcher = self.setup_watch_manager()
+
+		return True, event_watcher
 
 	def tell(self) -> int:
 		return self._file.tell()
@@ -89,20 +345,27 @@ class TellableLineIO(io.TextIOBase):
 
 	def setup_watch_manager(self) -> Optional[FileEventNotifier]:
 		if self._use_inotify and os.path.isfile(self.filename):
-			mask = pyinotify.IN_MODIFY | \
-					pyinotify.IN_ATTRIB | \
-					pyinotify.IN_MOVE_SELF | \
-					pyinotify.IN_DELETE_SELF
+			if self.file_watcher:
+				return self.file_watcher.add_watch(self.filename, self.WATCH_MASK)
 
 			watch_manager = WatchManager()
-			watch_manager.add_watch(self.filename, mask=mask)
+			watch_manager.add_watch(self.filename, mask=self.WATCH_MASK)
 			notifier = FileEventNotifier(watch_manager)
 			notifier.coalesce_events(True)
 			return notifier
 
+	def close_watch_manager(self, event_watcher):
+		if isinstance(event_watcher, FileWatch):
+			self.file_watcher.remove_watch(event_watcher)
+		else:
+			event_watcher.stop()
+
 	@staticmethod
 	def _wait_for_file_event(event_watcher) -> TellableLineIOEvent:
-		for event in event_watcher.get_events(timeout=60000):
+		with profiling.stage("wait"):
+			events = event_watcher.get_events(timeout=60000)
+
+		for event in events:
 			if event.mask & pyinotify.IN_MODIFY:
 				return TellableLineIOEvent.MODIFY
 			elif event.mask & (pyinotify.IN_MOVE_SELF | pyinotify.IN_DELETE_SELF | pyinotify.IN_ATTRIB):
@@ -112,10 +375,44 @@ class TellableLineIO(io.TextIOBase):
 
 		return TellableLineIOEvent.NOTHING
 
-	def __iter__(self) -> Iterable[str]:
+	def _poll_file_event(self) -> TellableLineIOEvent:
+		"""Tell what happened to the file from its state, used when the caller waits for changes itself."""
+		if self._rotated:
+			return TellableLineIOEvent.NOTHING
+		elif self.is_rotated():
+			# the replacing file must exist, re-opening it would block otherwise
+			return TellableLineIOEvent.DELETE if os.path.isfile(self.filename) else TellableLineIOEvent.NOTHING
+		else:
+			return TellableLineIOEvent.MODIFY
+
+	def __iter__(self) -> Iterable[Optional[str]]:
+		"""Iterate over complete lines, waiting for new ones when watching.
+
+		With nonblocking, None is yielded instead of waiting each time the end of the file is reached.
+		"""
+		return self._iter_lines()
+
+	def _line_functions(self) -> Tuple[Optional[Callable], Callable, Optional[Callable]]:
+		"""Return the regex substitution, the decoding of lines and the line filter, timed when profiling."""
+		regex_sub = self.regex_search.sub if self.regex_search and self.regex_replace else None
+		decode = str
+		line_filter = self.line_filter
+		timer = profiling.stage_timer
+
+		if timer:
+			decode = timer.wrap(decode, "decode")
+			if regex_sub:
+				regex_sub = timer.wrap(regex_sub, "regex")
+			if line_filter:
+				line_filter = timer.wrap(line_filter, "filter")
+
+		return regex_sub, decode, line_filter
+
+	def _iter_lines(self) -> Iterable[str]:
 		every_nth = self.every_nth
+		encoding = self._encoding
 		current_line = 0
-		regex_search = self.regex_search
+		regex_sub, decode, line_filter = self._line_functions()
 		regex_replace = self.regex_replace
 		eof_reached = False
 		last_offset = self.tell()
@@ -129,7 +426,8 @@ class TellableLineIO(io.TextIOBase):
 
 		if last_offset > 0:
 			next(self._file_iter)
-			self.current_line_offset = self.tell()
+
+		offset = self.tell()
 
 		while True:
 
@@ -137,42 +435,63 @@ class TellableLineIO(io.TextIOBase):
 				if line[-1:] != b"\n":
 					break
 
+				line_offset = offset
+				offset += len(line)
+				self.bytes_read += len(line)
 				current_line += 1
 
 				if every_nth and current_line % every_nth != 0:
 					continue
 
-				if regex_search and regex_replace:
-					line = regex_search.sub(regex_replace, line)
+				if line_filter is not None and not line_filter(line):
+					self.lines_filtered += 1
+					continue
+
+				if regex_sub:
+					line = regex_sub(regex_replace, line)
 
 				self.current_line = current_line
-				yield str(line, self._encoding)
-				last_offset = self.current_line_offset
-				self.current_line_offset = self.tell()
+				self.current_line_offset = line_offset
+				yield decode(line, encoding)
+
+			if self._rotated:
+				if self.tell() > offset:
+					log.warning("dropping incomplete line at offset %d of rotated file", offset)
+				opened, event_watcher = self._open_rotated_file(event_watcher)
+				if not opened:
+					break
+				offset = 0
+				eof_reached = False
+				continue
 
 			if eof_reached is False:
 				eof_reached = True
 				log.info("end of file has been reached for %s", self.filename)
 
 			if self.watch and eof_reached:
-				if event_watcher:
+				if self.nonblocking:
+					yield None
+					event = self._poll_file_event()
+				elif event_watcher:
 					event = self._wait_for_file_event(event_watcher)
-					if event is TellableLineIOEvent.DELETE:
-						log.info("file has changed, need to re-open file")
-						self.open_file()
-						continue
-					elif event is TellableLineIOEvent.MODIFY:
-						if self.tell() > self.get_size():
-							log.info("file size has reduced, need to re-open file")
-							self.open_file()
-							eof_reached = False
-							continue
 				else:
 					time.sleep(int(self.watch))
+					event = TellableLineIOEvent.NOTHING
+
+				if event is TellableLineIOEvent.DELETE:
+					if self.is_rotated():
+						log.info("file has been rotated, draining it before re-opening %s", self.filename)
+						self._rotated = True
+				elif event is TellableLineIOEvent.MODIFY:
+					if self.tell() > self.get_size():
+						log.info("file size has reduced, need to re-open file")
+						self.open_file()
+						offset = 0
+						eof_reached = False
+						continue
 
-				if line:
-					self.seek(last_offset + len(line) - 1)
-					next(self._file_iter)
+				# go back to the beginning of the incomplete line, if any
+				self._file.seek(offset)
 
 			else:
 				log.debug("reached end of file and not watching, closing")
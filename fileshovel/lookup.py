@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import argparse
+import logging
+import os
+import sys
+from typing import List
+from uuid import UUID
+
+from fileshovel.indexer import CsvIndexer
+from fileshovel.options import FileShovelOptions
+
+log = logging.getLogger("fileshovel.lookup")
+
+
+class LookupOptions(FileShovelOptions):
+	PROG = "fileshovel lookup"
+
+	def add_arguments(self, parser: argparse.ArgumentParser):
+		parser.add_argument("--uuid", dest="lookup_uuids", type=UUID, action="append", required=True,
+							help=LookupOptions.lookup_uuids.__doc__)
+
+	@property
+	def lookup_uuids(self) -> List[UUID]:
+		"""uuid of the row to print, can be repeated, requires --uuid-column"""
+		return self.args.lookup_uuids
+
+
+def main(argv: List[str] = None):
+	args = LookupOptions(argv)
+	args.setup_logging()
+
+	if args.uuid_column is None:
+		log.error("--uuid-column is required to lookup rows")
+		return 1
+
+	# only index the file when there is no index, otherwise answer from what is on disk, a follower may own it
+	indexer = CsvIndexer(args, build=not os.path.isfile(args.index_file), read_only=True)
+	missing = 0
+
+	try:
+		for uuid in args.lookup_uuids:
+			try:
+				line, offset = indexer.find_offset_from_uuid(uuid)
+			except KeyError:
+				log.warning("uuid %s isn't in the index", uuid)
+				missing += 1
+				continue
+
+			log.debug("uuid %s is at line %d offset %d", uuid, line, offset)
+			sys.stdout.buffer.write(indexer.read_row(offset))
+
+		sys.stdout.flush()
+	finally:
+		indexer.close()
+
+	return 1 if missing else 0
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import logging
+import os
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterable, List, Tuple
+
+log = logging.getLogger("fileshovel.metrics")
+
+ROW_BUCKETS = (1, 10, 100, 1000, 5000, 10000, 50000)
+SECOND_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+METRICS = {
+	"fileshovel_lines_read_total": ("counter", "CSV rows read from the file."),
+	"fileshovel_bytes_read_total": ("counter", "Bytes read from the file."),
+	"fileshovel_lines_filtered_total": ("counter", "Lines dropped by filters, on raw lines or on parsed columns."),
+	"fileshovel_read_offset_bytes": ("gauge", "Offset of the last row read from the file."),
+	"fileshovel_file_size_bytes": ("gauge", "Current size of the followed file."),
+	"fileshovel_committed_offset_bytes": ("gauge", "Offset of the last committed row of the file."),
+	"fileshovel_lag_bytes": ("gauge", "File size minus the committed offset."),
+	"fileshovel_queue_rows": ("gauge", "Rows waiting for an SQL thread."),
+	"fileshovel_rows_inserted_total": ("counter", "Rows sent to the database in committed batches."),
+	"fileshovel_rows_skipped_total": ("counter", "Rows skipped because they could not be converted."),
+	"fileshovel_batches_total": ("counter", "Committed batches by flush reason."),
+	"fileshovel_batch_rows": ("histogram", "Rows per committed batch."),
+	"fileshovel_execute_seconds": ("histogram", "Time spent sending the rows of a batch."),
+	"fileshovel_commit_seconds": ("histogram", "Time spent committing a batch."),
+	"fileshovel_rows_unrouted_total": ("counter", "Rows matching no partition, inserted through --pg-table."),
+	"fileshovel_spooled_rows_total": ("counter", "Rows written to --pg-spool-dir instead of being inserted."),
+	"fileshovel_spool_batches": ("gauge", "Batches waiting in --pg-spool-dir."),
+	"fileshovel_spool_bytes": ("gauge", "Bytes of the batches waiting in --pg-spool-dir."),
+	"fileshovel_pg_retries_total": ("counter", "PostgreSQL operations retried after a retryable error, by error."),
+	"fileshovel_stage_seconds_total": ("counter", "Time spent in each pipeline stage with --profile-format=stages."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_labels(labels: Labels) -> str:
+	if not labels:
+		return ""
+	escaped = (
+		(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+		for k, v in labels
+	)
+	return "{" + ",".join("%s=\"%s\"" % x for x in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+
+	def __init__(self):
+		"""Counters and histograms updated by the shovel, plus collectors reading gauges when rendered."""
+		self._lock = Lock()
+		self._counters = {}
+		self._histograms = {}
+		self._collectors = []
+
+	def inc(self, name: str, value: float = 1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+	def observe(self, name: str, value: float, buckets: Tuple[float, ...] = SECOND_BUCKETS, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+			index = bisect_left(buckets, value)
+			if index < len(buckets):
+				histogram[1][index] += 1
+			histogram[2] += value
+			histogram[3] += 1
+
+	def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+		"""Register a function returning (name, labels, value) samples each time metrics are rendered."""
+		with self._lock:
+			self._collectors.append(collector)
+
+	def remove_collector(self, collector: Callable[[], Iterable[Sample]]):
+		with self._lock:
+			if collector in self._collectors:
+				self._collectors.remove(collector)
+
+	def _samples(self) -> Dict[str, List[Tuple[str, Labels, float]]]:
+		samples = {}
+
+		with self._lock:
+			collectors = list(self._collectors)
+
+			for (name, labels), value in self._counters.items():
+				samples.setdefault(name, []).append((name, labels, value))
+
+			for (name, labels), (buckets, counts, total, count) in self._histograms.items():
+				lines = samples.setdefault(name, [])
+				cumulative = 0
+				for bucket, bucket_count in zip(buckets, counts):
+					cumulative += bucket_count
+					lines.append((name + "_bucket", labels + (("le", _format_value(float(bucket))),), cumulative))
+				lines.append((name + "_bucket", labels + (("le", "+Inf"),), count))
+				lines.append((name + "_sum", labels, total))
+				lines.append((name + "_count", labels, count))
+
+		for collector in collectors:
+			try:
+				for name, labels, value in collector():
+					samples.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+			except Exception as e:
+				log.warning("metrics collector failed: %s", e)
+
+		return samples
+
+	def render(self) -> str:
+		"""Return every metric in the Prometheus text exposition format."""
+		lines = []
+
+		for name, samples in sorted(self._samples().items()):
+			metric_type, description = METRICS.get(name, ("untyped", name))
+			lines.append("# HELP %s %s" % (name, description))
+			lines.append("# TYPE %s %s" % (name, metric_type))
+			for sample_name, labels, value in samples:
+				lines.append("%s%s %s" % (sample_name, _format_labels(labels), _format_value(value)))
+
+		lines.append("")
+		return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+
+		body = metrics.render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, message_format, *args):
+		log.debug(message_format, *args)
+
+
+def serve_metrics(address: str, port: int) -> ThreadingHTTPServer:
+	"""Serve metrics over HTTP from a daemon thread."""
+	server = ThreadingHTTPServer((address, port), MetricsHandler)
+	server.daemon_threads = True
+	Thread(name="metrics_http", target=server.serve_forever, daemon=True).start()
+	log.info("serving metrics on http://%s:%d/metrics", address, server.server_address[1])
+	return server
+
+
+def reader_collector(csv_file: str, reader, committed_offsets: Dict[str, int]) -> Callable[[], Iterable[Sample]]:
+	"""Return a collector of the progress of a CsvReader following csv_file and its lag behind committed rows."""
+	labels = {"file": csv_file}
+
+	def collect() -> Iterable[Sample]:
+		yield "fileshovel_lines_read_total", labels, reader.line_num
+		yield "fileshovel_bytes_read_total", labels, reader.csv_file.bytes_read
+		yield "fileshovel_lines_filtered_total", dict(labels, filter="line"), reader.csv_file.lines_filtered
+		yield "fileshovel_lines_filtered_total", dict(labels, filter="column"), reader.rows_filtered
+		yield "fileshovel_read_offset_bytes", labels, reader.csv_file.current_line_offset
+
+		try:
+			size = os.path.getsize(csv_file)
+		except OSError:
+			return
+
+		yield "fileshovel_file_size_bytes", labels, size
+		committed_offset = committed_offsets.get(csv_file)
+
+		if committed_offset is not None:
+			yield "fileshovel_committed_offset_bytes", labels, committed_offset
+			yield "fileshovel_lag_bytes", labels, max(size - committed_offset, 0)
+
+	return collect
+
+
+def write_metrics_file(filename: str):
+	"""Atomically replace filename with the current metrics, for the node-exporter textfile collector."""
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w") as metrics_file:
+		metrics_file.write(metrics.render())
+	os.replace(temp_filename, filename)
+
+
+def write_metrics_file_forever(filename: str, interval: float):
+	while True:
+		try:
+			write_metrics_file(filename)
+		except OSError as e:
+			log.warning("can't write metrics to %s: %s", filename, e)
+		time.sleep(interval)
+
+
+def start_metrics(options):
+	"""Start the metrics endpoint and textfile writer enabled in options."""
+	if options.metrics_port is not None:
+		serve_metrics(options.metrics_address, options.metrics_port)
+
+	if options.metrics_textfile:
+		Thread(name="metrics_textfile", target=write_metrics_file_forever,
+				args=(options.metrics_textfile, options.metrics_interval), daemon=True).start()
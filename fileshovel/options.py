@@ -1,47 +1,73 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
 import argparse
+import glob
 import logging
 import platform
 import re
 import sys
-from typing import List, Optional, TextIO
+from typing import List, Optional, TextIO, Tuple
 
+from fileshovel.columnmap import ColumnMap
 from fileshovel.csvreader import CsvReader
-from fileshovel.lineio import TellableLineIO
+from fileshovel.linefilter import ColumnFilter, LineFilter, compile_line_filter, compile_rewrite_rules, \
+		required_substrings
+from fileshovel.lineio import TellableLineIO, SharedFileWatcher
 
 log = logging.getLogger("fileshovel.options")
 
 
 class FileShovelOptions:
-	def __init__(self):
+	PROG = "fileshovel"
+
+	def __init__(self, argv: List[str] = None):
 		self.args = argparse.Namespace()
-		self.parse_args()
+		self.argv = list(sys.argv[1:] if argv is None else argv)
+		self.parse_args(argv)
 
 		if self.dump_config:
 			self.dump_config_as_yaml(sys.stdout)
 			sys.exit(0)
 
 		self._first_row = self._get_first_row()
+		self.check_headers()
 
-	def _get_first_row(self) -> List[str]:
-		reader = self.get_csv_file_reader(for_header=True)
+	def _get_first_row(self, csv_file: str = None) -> List[str]:
+		reader = self.get_csv_file_reader(for_header=True, csv_file=csv_file)
 
 		try:
-			line = next(iter(reader))
+			line, _, _ = next(iter(reader))
 			return line
 		finally:
 			reader.csv_file.close()
 
-	def parse_args(self):
+	def check_headers(self):
+		"""Fail when a followed file doesn't have the header of the first one, its rows would go in the wrong columns.
+
+		Files without a complete line yet aren't checked.
+		"""
+		if self.args.columns:
+			return
+
+		for csv_file in self.csv_files[1:]:
+			try:
+				header = self._get_first_row(csv_file)
+			except StopIteration:
+				continue
+
+			if header != self._first_row:
+				raise ValueError("header of %s differs from the header of %s: %s instead of %s" % (
+					csv_file, self.csv_file, ",".join(header), ",".join(self._first_row)))
+
+	def parse_args(self, argv: List[str] = None):
 		parser = argparse.ArgumentParser(
-			prog="fileshovel",
+			prog=self.PROG,
 		)
 		parser.add_argument("-c", "--config", default=None, type=str,
 							help=FileShovelOptions.config.__doc__)
 
-		if "--help" not in sys.argv:
-			parser.parse_known_args(namespace=self.args)
+		if "--help" not in (sys.argv if argv is None else argv):
+			parser.parse_known_args(argv, namespace=self.args)
 
 			if self.args.config:
 				self.read_config_from_yaml()
@@ -60,6 +86,15 @@ class FileShovelOptions:
 							help=FileShovelOptions.csv_regex_search.__doc__)
 		parser.add_argument("--csv-regex-replace", type=str, default=None,
 							help=FileShovelOptions.csv_regex_replace.__doc__)
+		parser.add_argument("--csv-rewrite", type=str, nargs=2, action="append", default=[],
+							metavar=("SEARCH", "REPLACE"),
+							help=FileShovelOptions.csv_rewrite_rules.__doc__)
+		parser.add_argument("--csv-include", type=str, action="append", default=[],
+							help=FileShovelOptions.csv_include.__doc__)
+		parser.add_argument("--csv-exclude", type=str, action="append", default=[],
+							help=FileShovelOptions.csv_exclude.__doc__)
+		parser.add_argument("--csv-column-filter", type=str, action="append", default=[],
+							help=FileShovelOptions.csv_column_filters.__doc__)
 		parser.add_argument("--csv-date-format", type=str, default="%Y-%m-%d %H:%M:%S",
 							help=FileShovelOptions.csv_date_format.__doc__)
 		parser.add_argument("-d", "--csv-delimiter", type=str, default=",",
@@ -70,28 +105,130 @@ class FileShovelOptions:
 							help=FileShovelOptions.add_missing_columns.__doc__)
 		parser.add_argument("--csv-skip-lines", type=int, default=None,
 							help=FileShovelOptions.csv_skip_lines.__doc__)
+		parser.add_argument("--csv-rotated-suffix", type=str, default=None,
+							help=FileShovelOptions.csv_rotated_suffix.__doc__)
+		parser.add_argument("--csv-select-columns", type=str, default=None,
+							help=FileShovelOptions.csv_select_columns.__doc__)
 		parser.add_argument("--csv-null-text", type=str, default="null",
 							help=FileShovelOptions.csv_null_text.__doc__)
 		parser.add_argument("--pg-connection-string", type=str)
-		parser.add_argument("--pg-rows-per-commit", type=int, default=1000)
+		parser.add_argument("--pg-rows-per-commit", type=int, default=1000,
+							help=FileShovelOptions.pg_rows_per_commit.__doc__)
+		parser.add_argument("--pg-max-batch-bytes", type=int, default=0,
+							help=FileShovelOptions.pg_max_batch_bytes.__doc__)
+		parser.add_argument("--pg-max-batch-delay", type=float, default=0.0,
+							help=FileShovelOptions.pg_max_batch_delay.__doc__)
 		parser.add_argument("--pg-schema", type=str)
 		parser.add_argument("--pg-table", type=str)
 		parser.add_argument("--pg-server-name-column", type=str)
 		parser.add_argument("--pg-server-name-value", type=str)
 		parser.add_argument("--pg-csv-offset-column", type=str)
 		parser.add_argument("--pg-csv-line-column", type=str)
+		parser.add_argument("--pg-csv-file-column", type=str,
+							help=FileShovelOptions.pg_csv_file_column.__doc__)
+		parser.add_argument("--pg-checkpoint-table", type=str,
+							help=FileShovelOptions.pg_checkpoint_table.__doc__)
 		parser.add_argument("--pg-threads", type=int, default=1)
+		parser.add_argument("--pg-insert-mode", type=str, default="insert", choices=("insert", "copy"),
+							help=FileShovelOptions.pg_insert_mode.__doc__)
+		parser.add_argument("--pg-copy-format", type=str, default="text", choices=("text", "binary"),
+							help=FileShovelOptions.pg_copy_format.__doc__)
+		parser.add_argument("--pg-synchronous-commit", type=str, default=None,
+							choices=("on", "off", "local", "remote_write", "remote_apply"),
+							help=FileShovelOptions.pg_synchronous_commit.__doc__)
+		parser.add_argument("--pg-durable-commit-interval", type=float, default=10.0,
+							help=FileShovelOptions.pg_durable_commit_interval.__doc__)
+		parser.add_argument("--pg-typed-rows", default=False, action="store_true",
+							help=FileShovelOptions.pg_typed_rows.__doc__)
+		parser.add_argument("--pg-types-file", type=str, default=None,
+							help=FileShovelOptions.pg_types_file.__doc__)
+		parser.add_argument("--pg-column-map", type=str, default=None,
+							help=FileShovelOptions.pg_column_map.__doc__)
+		parser.add_argument("--pg-partition-routing", default=False, action="store_true",
+							help=FileShovelOptions.pg_partition_routing.__doc__)
+		parser.add_argument("--pg-partition-period", type=str, default="month", choices=("day", "month", "year"),
+							help=FileShovelOptions.pg_partition_period.__doc__)
+		parser.add_argument("--pg-create-partitions", type=int, default=0,
+							help=FileShovelOptions.pg_create_partitions.__doc__)
+		parser.add_argument("--pg-spool-dir", type=str, default=None,
+							help=FileShovelOptions.pg_spool_dir.__doc__)
+		parser.add_argument("--pg-spool-max-bytes", type=int, default=0,
+							help=FileShovelOptions.pg_spool_max_bytes.__doc__)
+		parser.add_argument("--pg-retry-delay", type=float, default=0.5,
+							help=FileShovelOptions.pg_retry_delay.__doc__)
+		parser.add_argument("--pg-retry-max-delay", type=float, default=30.0,
+							help=FileShovelOptions.pg_retry_max_delay.__doc__)
+		parser.add_argument("--pg-retry-timeout", type=float, default=300.0,
+							help=FileShovelOptions.pg_retry_timeout.__doc__)
+		parser.add_argument("--pg-health-check-interval", type=float, default=30.0,
+							help=FileShovelOptions.pg_health_check_interval.__doc__)
+		parser.add_argument("--engine", type=str, default="threads", choices=("threads", "asyncio"),
+							help=FileShovelOptions.engine.__doc__)
+		parser.add_argument("--backfill-processes", type=int, default=0,
+							help=FileShovelOptions.backfill_processes.__doc__)
+		parser.add_argument("--metrics-port", type=int, default=None,
+							help=FileShovelOptions.metrics_port.__doc__)
+		parser.add_argument("--metrics-address", type=str, default="127.0.0.1",
+							help=FileShovelOptions.metrics_address.__doc__)
+		parser.add_argument("--metrics-textfile", type=str, default=None,
+							help=FileShovelOptions.metrics_textfile.__doc__)
+		parser.add_argument("--metrics-interval", type=float, default=15.0,
+							help=FileShovelOptions.metrics_interval.__doc__)
+		parser.add_argument("--profile", type=str, default=None,
+							help=FileShovelOptions.profile.__doc__)
+		parser.add_argument("--profile-format", type=str, default="stages", choices=("stages", "folded", "pstats"),
+							help=FileShovelOptions.profile_format.__doc__)
+		parser.add_argument("--profile-interval", type=float, default=0.005,
+							help=FileShovelOptions.profile_interval.__doc__)
 		parser.add_argument("--dump-config", default=False, action="store_true",
 							help=FileShovelOptions.dump_config.__doc__)
 		parser.add_argument("--verbose", "-v", action="count", default=0,
 							help="Increase verbosity, add up to 5 -v.")
 		parser.add_argument("-i", "--index-file", default=None, type=str,
 							help=FileShovelOptions.index_file.__doc__)
+		parser.add_argument("--index-update", default=False, action="store_true",
+							help=FileShovelOptions.index_update.__doc__)
 		parser.add_argument("-w", "--watch", default="inotify", type=str,
 							help=FileShovelOptions.watch.__doc__)
-		parser.add_argument("csv_file", type=str,
-							help=FileShovelOptions.csv_file.__doc__)
-		parser.parse_args(namespace=self.args)
+		self.add_arguments(parser)
+		parser.add_argument("csv_file", type=str, nargs="+",
+							help=FileShovelOptions.csv_files.__doc__)
+		parser.parse_args(argv, namespace=self.args)
+
+		if len(self.csv_files) > 1 and not self.pg_csv_file_column:
+			parser.error("--pg-csv-file-column is required to follow more than one CSV file")
+
+		if self.backfill_processes > 1 and not self.pg_checkpoint_table:
+			parser.error("--pg-checkpoint-table is required to backfill using many processes")
+
+		if self.engine == "asyncio" and self.pg_insert_mode != "insert":
+			parser.error("--engine=asyncio only supports --pg-insert-mode=insert")
+
+		if self.engine == "asyncio" and self.pg_spool_dir:
+			parser.error("--pg-spool-dir is only supported with --engine=threads")
+
+		if self.engine == "asyncio" and self.pg_partition_routing:
+			parser.error("--pg-partition-routing is only supported with --engine=threads")
+
+		if self.pg_create_partitions and not self.pg_partition_routing:
+			parser.error("--pg-create-partitions requires --pg-partition-routing")
+
+		if self.args.csv_regex_search and self.args.csv_regex_replace is None:
+			parser.error("--csv-regex-replace must be set if --csv-regex-search is set")
+
+	def add_arguments(self, parser: argparse.ArgumentParser):
+		"""Add the arguments of a sub-command."""
+		pass
+
+	def setup_logging(self):
+		log_level = {
+			0: logging.CRITICAL,
+			1: logging.ERROR,
+			2: logging.WARN,
+			3: logging.INFO,
+			4: logging.DEBUG,
+		}.get(self.verbose)
+		logging.basicConfig(level=log_level)
 
 	@property
 	def config(self) -> str:
@@ -131,6 +268,14 @@ class FileShovelOptions:
 	@property
 	def columns(self) -> List[str]:
 		"""comma separated columns if header is missing from csv, example: col1,col2,col3..."""
+		if self.csv_select_columns:
+			return self.csv_select_columns
+		else:
+			return self.csv_columns
+
+	@property
+	def csv_columns(self) -> List[str]:
+		"""every column of the CSV file"""
 		if self.args.columns:
 			return self.args.columns.split(',')
 		else:
@@ -142,7 +287,7 @@ class FileShovelOptions:
 		if self.args.date_column is None:
 			return 0
 		else:
-			return self.columns.index(self.args.date_column) - 1
+			return self.columns.index(self.args.date_column)
 
 	@property
 	def date_column_name(self) -> str:
@@ -169,11 +314,16 @@ class FileShovelOptions:
 		"""wait for changes --wait=no|inotify|[delay in seconds]"""
 		return self.args.watch
 
+	@property
+	def poll_interval(self) -> int:
+		"""seconds between reads of a followed file without inotify, the delay of --watch"""
+		return int(self.watch) if self.watch.isdigit() else 1
+
 	@property
 	def uuid_column(self) -> Optional[int]:
 		"""column to index for uuid, default is None"""
 		if self.args.uuid_column:
-			return self.columns.index(self.args.uuid_column) - 1
+			return self.columns.index(self.args.uuid_column)
 
 	@property
 	def csv_regex_search(self):
@@ -186,6 +336,52 @@ class FileShovelOptions:
 		"""apply the specified Python regex to each lines"""
 		return self.args.csv_regex_replace
 
+	@property
+	def csv_rewrite_rules(self) -> List[Tuple[bytes, bytes]]:
+		"""rewrite lines with ordered SEARCH REPLACE regex rules applied in one pass, after --csv-regex-search"""
+		rules = [(x, y) for x, y in self.args.csv_rewrite]
+
+		if self.args.csv_regex_search:
+			rules.insert(0, (self.args.csv_regex_search, self.args.csv_regex_replace))
+
+		return [(bytes(x, self.encoding), bytes(y, self.encoding)) for x, y in rules]
+
+	@property
+	def csv_include(self) -> List[bytes]:
+		"""only keep lines matching one of these regexes, checked on raw bytes before decoding and parsing"""
+		return [bytes(x, self.encoding) for x in self.args.csv_include]
+
+	@property
+	def csv_exclude(self) -> List[bytes]:
+		"""drop lines matching one of these regexes, checked on raw bytes before decoding and parsing"""
+		return [bytes(x, self.encoding) for x in self.args.csv_exclude]
+
+	@property
+	def csv_column_filters(self) -> List[ColumnFilter]:
+		"""only keep rows where COLUMN=VALUE or COLUMN!=VALUE, lines without an equal value are dropped before parsing
+		unless --csv-rewrite is set"""
+		column_filters = []
+		csv_columns = self.csv_columns
+
+		for column_filter in self.args.csv_column_filter:
+			column, equal, value = re.match(r"([^=!]+)(!?=)(.*)", column_filter, re.DOTALL).groups()
+
+			if column not in csv_columns:
+				raise ValueError("--csv-column-filter column %s is not a CSV column" % column)
+
+			column_filters.append((csv_columns.index(column), value, equal == "="))
+
+		return column_filters
+
+	def get_line_filter(self) -> Optional[LineFilter]:
+		# raw lines are checked before being rewritten, rewritten values are only known to the row filter
+		if self.csv_rewrite_rules:
+			required = []
+		else:
+			required = required_substrings(self.csv_column_filters, self.encoding, self.csv_delimiter)
+
+		return compile_line_filter(self.csv_include, self.csv_exclude, required)
+
 	@property
 	def csv_date_format(self) -> str:
 		"""date format string according to strptime:
@@ -202,6 +398,24 @@ class FileShovelOptions:
 		"""index the CSV file storing an offset every nth lines"""
 		return self.args.csv_index_every_nth_line
 
+	@property
+	def csv_rotated_suffix(self) -> Optional[str]:
+		"""glob suffix of rotated files, example: '.*' to resume at startup from the rotated file of the checkpoint,
+		found by inode with --pg-checkpoint-table, then read the files rotated after it"""
+		return self.args.csv_rotated_suffix
+
+	@property
+	def csv_select_columns(self) -> Optional[List[str]]:
+		"""comma separated columns to keep, others are dropped while reading, example: col3,col1"""
+		if self.args.csv_select_columns:
+			return self.args.csv_select_columns.split(',')
+
+	@property
+	def csv_select_indexes(self) -> Optional[List[int]]:
+		if self.csv_select_columns:
+			csv_columns = self.csv_columns
+			return [csv_columns.index(x) for x in self.csv_select_columns]
+
 	@property
 	def csv_null_text(self) -> str:
 		"""text to show for added null fields"""
@@ -228,6 +442,16 @@ class FileShovelOptions:
 		"""how many rows to insert at a time"""
 		return self.args.pg_rows_per_commit
 
+	@property
+	def pg_max_batch_bytes(self) -> int:
+		"""commit a batch once its rows add up to this many bytes, 0 to disable"""
+		return self.args.pg_max_batch_bytes
+
+	@property
+	def pg_max_batch_delay(self) -> float:
+		"""hold rows up to this many seconds to build larger batches, 0 commits whenever no row is waiting"""
+		return self.args.pg_max_batch_delay
+
 	@property
 	def pg_schema(self) -> str:
 		"""schema to store data"""
@@ -258,40 +482,235 @@ class FileShovelOptions:
 		"""column in --pg-table to store CSV current line as int"""
 		return self.args.pg_csv_line_column
 
+	@property
+	def pg_csv_file_column(self) -> Optional[str]:
+		"""column in --pg-table to store the CSV filename, required when following many files"""
+		return self.args.pg_csv_file_column
+
+	@property
+	def pg_checkpoint_table(self) -> Optional[str]:
+		"""table in --pg-schema storing the offset of each file below which every row is committed, used to resume"""
+		return self.args.pg_checkpoint_table
+
 	@property
 	def pg_threads(self) -> int:
 		"""how many parallel SQL threads to run"""
 		return self.args.pg_threads
 
+	@property
+	def pg_insert_mode(self) -> str:
+		"""insert rows using multi-row INSERT statements or COPY through a staging table --pg-insert-mode=insert|copy"""
+		return self.args.pg_insert_mode
+
+	@property
+	def pg_copy_format(self) -> str:
+		"""COPY format when --pg-insert-mode=copy --pg-copy-format=text|binary"""
+		return self.args.pg_copy_format
+
+	@property
+	def pg_synchronous_commit(self) -> Optional[str]:
+		"""synchronous_commit of the SQL sessions, with off batches are committed without waiting for the WAL flush"""
+		return self.args.pg_synchronous_commit
+
+	@property
+	def pg_durable_commit_interval(self) -> float:
+		"""when --pg-synchronous-commit=off, wait for the WAL flush of a batch every this many seconds"""
+		return self.args.pg_durable_commit_interval
+
+	@property
+	def pg_typed_rows(self) -> bool:
+		"""convert fields to the column types of --pg-table before sending them, rows failing conversion are skipped"""
+		return self.args.pg_typed_rows
+
+	@property
+	def pg_types_file(self) -> str:
+		"""file caching the column types of --pg-table, default is INDEX_FILE.pgtypes"""
+		if self.args.pg_types_file is None:
+			return self.index_file + ".pgtypes"
+		else:
+			return self.args.pg_types_file
+
+	@property
+	def pg_column_map(self) -> Optional[str]:
+		"""YAML file renaming, dropping, reordering, trimming CSV columns and adding constant columns of --pg-table"""
+		return self.args.pg_column_map
+
+	@property
+	def pg_partition_routing(self) -> bool:
+		"""insert rows straight into the range partition of --pg-table holding their --date-column, rows matching none
+		go through --pg-table"""
+		return self.args.pg_partition_routing
+
+	@property
+	def pg_partition_period(self) -> str:
+		"""range of the partitions created by --pg-create-partitions, named like TABLE_YYYYMM for month"""
+		return self.args.pg_partition_period
+
+	@property
+	def pg_create_partitions(self) -> int:
+		"""create the partitions missing for this many periods from the current one, checked hourly, 0 to disable"""
+		return self.args.pg_create_partitions
+
+	@property
+	def pg_spool_dir(self) -> Optional[str]:
+		"""spool prepared batches to this directory while PostgreSQL is down or behind, inserted once it recovers"""
+		return self.args.pg_spool_dir
+
+	@property
+	def pg_spool_max_bytes(self) -> int:
+		"""wait for PostgreSQL instead of spooling once --pg-spool-dir holds this many bytes, 0 to disable"""
+		return self.args.pg_spool_max_bytes
+
+	@property
+	def pg_retry_delay(self) -> float:
+		"""seconds before retrying an operation failing with a retryable error, doubled on each attempt"""
+		return self.args.pg_retry_delay
+
+	@property
+	def pg_retry_max_delay(self) -> float:
+		"""maximum seconds between two attempts, also between connection attempts while batches are spooled"""
+		return self.args.pg_retry_max_delay
+
+	@property
+	def pg_retry_timeout(self) -> float:
+		"""give up on an operation still failing after this many seconds of retries, 0 to retry forever"""
+		return self.args.pg_retry_timeout
+
+	@property
+	def pg_health_check_interval(self) -> float:
+		"""check a pooled connection with SELECT 1 before using it again after this many idle seconds"""
+		return self.args.pg_health_check_interval
+
+	@property
+	def engine(self) -> str:
+		"""run readers and SQL writers as threads or in one asyncio event loop --engine=threads|asyncio"""
+		return self.args.engine
+
+	@property
+	def backfill_processes(self) -> int:
+		"""insert existing lines of each CSV file from this many processes before following it, 0 to disable"""
+		return self.args.backfill_processes
+
+	@property
+	def metrics_port(self) -> Optional[int]:
+		"""serve Prometheus metrics on this port at /metrics"""
+		return self.args.metrics_port
+
+	@property
+	def metrics_address(self) -> str:
+		"""address to serve metrics on, default is 127.0.0.1"""
+		return self.args.metrics_address
+
+	@property
+	def metrics_textfile(self) -> Optional[str]:
+		"""write Prometheus metrics to this file for the node-exporter textfile collector"""
+		return self.args.metrics_textfile
+
+	@property
+	def metrics_interval(self) -> float:
+		"""seconds between writes of --metrics-textfile"""
+		return self.args.metrics_interval
+
+	@property
+	def profile(self) -> Optional[str]:
+		"""write a profile to this file on exit and on SIGUSR1, disabled by default"""
+		return self.args.profile
+
+	@property
+	def profile_format(self) -> str:
+		"""what --profile writes: stage timings as JSON, folded stacks or pstats of every thread"""
+		return self.args.profile_format
+
+	@property
+	def profile_interval(self) -> float:
+		"""seconds between stack samples of --profile-format=folded, the other formats ignore it"""
+		return self.args.profile_interval
+
 	@property
 	def csv_file(self) -> str:
-		"""CSV filename to follow"""
-		return self.args.csv_file
+		"""first CSV filename to follow"""
+		return self.csv_files[0]
+
+	@property
+	def csv_files(self) -> List[str]:
+		"""CSV filenames or glob patterns to follow, patterns are expanded once at startup so files created later
+		aren't followed, every file must have the header of the first one unless --columns is set"""
+		csv_files = self.args.csv_file
+		if isinstance(csv_files, str):
+			csv_files = [csv_files]
+
+		filenames = []
+		for pattern in csv_files:
+			if glob.has_magic(pattern):
+				filenames.extend(x for x in sorted(glob.glob(pattern)) if x not in filenames)
+			elif pattern not in filenames:
+				filenames.append(pattern)
+
+		return filenames
 
 	@property
 	def index_file(self) -> str:
 		"""index file, default is CSV_FILE.index"""
 		if self.args.index_file is None:
-			return self.args.csv_file + ".index"
+			return self.csv_file + ".index"
 		else:
 			return self.args.index_file
 
-	def get_csv_file(self, for_header=False) -> TellableLineIO:
+	@property
+	def index_update(self) -> bool:
+		"""keep the index file of each CSV file up to date while following it"""
+		return self.args.index_update
+
+	def get_index_file(self, csv_file: str = None) -> str:
+		if csv_file is None or csv_file == self.csv_file:
+			return self.index_file
+		else:
+			return csv_file + ".index"
+
+	def get_file_watcher(self) -> Optional[SharedFileWatcher]:
+		if self.watch == "inotify":
+			return SharedFileWatcher()
+
+	def get_csv_file(self, for_header=False, csv_file: str = None,
+			file_watcher: SharedFileWatcher = None, watch: bool = None, nonblocking=False) -> TellableLineIO:
+		csv_file = csv_file or self.csv_file
+
+		if watch is None:
+			watch = self.watch not in ("no", "0", "false")
+		if watch:
+			watch = self.poll_interval
+
+		regex_search, regex_replace = compile_rewrite_rules(self.csv_rewrite_rules)
+
 		return TellableLineIO(
-			self.args.csv_file,
+			csv_file,
 			"r",
 			self.encoding,
 			self.csv_skip_lines if for_header is False else 0,
-			self.csv_index_every_nth_line,
-			watch=self.watch not in ("no", "0", "false"),
-			use_inotify=self.watch == "inotify",
-			regex_search=self.csv_regex_search,
-			regex_replace=bytes(self.csv_regex_replace, self.encoding) if self.csv_regex_replace else None,
+			watch=watch,
+			use_inotify=watch and self.watch == "inotify" and not nonblocking,
+			regex_search=regex_search,
+			regex_replace=regex_replace,
+			file_watcher=file_watcher,
+			rotated_glob=glob.escape(csv_file) + self.csv_rotated_suffix if self.csv_rotated_suffix else None,
+			nonblocking=nonblocking,
+			line_filter=self.get_line_filter() if for_header is False else None,
 		)
 
-	def get_csv_file_reader(self, for_header=False, last_offset=0):
+	def get_csv_file_reader(self, for_header=False, last_offset=0, csv_file: str = None,
+			file_watcher: SharedFileWatcher = None, watch: bool = None, nonblocking=False, last_inode: int = None):
 		return CsvReader(
-			self.get_csv_file(for_header),
+			self.get_csv_file(for_header, csv_file, file_watcher, watch, nonblocking),
 			last_offset=last_offset,
+			last_inode=last_inode,
+			select_columns=self.csv_select_indexes if for_header is False else None,
+			column_filters=self.csv_column_filters if for_header is False else None,
 			delimiter=self.csv_delimiter,
 		)
+
+	def get_column_map(self) -> ColumnMap:
+		"""Return the map of --pg-column-map, or the map of every column to the column of the same name."""
+		if self.pg_column_map:
+			return ColumnMap.load(self.pg_column_map, self.columns, self.csv_null_text)
+		else:
+			return ColumnMap.from_columns(self.columns, self.csv_null_text)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import struct
+from typing import Any, Callable, Iterable, List
+
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\0" + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack("!h", -1)
+
+_copy_text_escapes = str.maketrans({
+	"\\": "\\\\",
+	"\t": "\\t",
+	"\n": "\\n",
+	"\r": "\\r",
+})
+
+
+def encode_copy_text(rows: Iterable[List], encoding: str) -> bytes:
+	"""Encode rows as a COPY text format payload, None being written as \\N."""
+	lines = []
+
+	for row in rows:
+		lines.append("\t".join(
+			"\\N" if field is None else str(field).translate(_copy_text_escapes)
+			for field in row
+		))
+
+	lines.append("")
+	return "\n".join(lines).encode(encoding)
+
+
+def encode_copy_binary(rows: Iterable[List], encoding: str) -> bytes:
+	"""Encode rows as a COPY binary format payload where every field is sent as text."""
+	pack_count = struct.Struct("!h").pack
+	pack_length = struct.Struct("!i").pack
+	null = pack_length(-1)
+	chunks = [COPY_BINARY_HEADER]
+
+	for row in rows:
+		chunks.append(pack_count(len(row)))
+		for field in row:
+			if field is None:
+				chunks.append(null)
+			else:
+				field = str(field).encode(encoding)
+				chunks.append(pack_length(len(field)))
+				chunks.append(field)
+
+	chunks.append(COPY_BINARY_TRAILER)
+	return b"".join(chunks)
+
+
+def encode_copy_binary_typed(rows: Iterable[List], encoders: List[Callable[[Any], bytes]]) -> bytes:
+	"""Encode converted rows as a COPY binary format payload using one field encoder per column."""
+	null = struct.pack("!i", -1)
+	field_count = struct.pack("!h", len(encoders))
+	chunks = [COPY_BINARY_HEADER]
+
+	for row in rows:
+		chunks.append(field_count)
+		for field, encoder in zip(row, encoders):
+			chunks.append(null if field is None else encoder(field))
+
+	chunks.append(COPY_BINARY_TRAILER)
+	return b"".join(chunks)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import logging
+import re
+import time
+from bisect import bisect_right
+from datetime import datetime
+from threading import Lock
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from psycopg2.sql import Identifier
+
+log = logging.getLogger("fileshovel.pgpartition")
+
+PERIOD_SUFFIXES = {
+	"day": "%Y%m%d",
+	"month": "%Y%m",
+	"year": "%Y",
+}
+# reload partitions when a row matches none, at most this often
+MISS_REFRESH_SECONDS = 60.0
+# reload partitions this often anyway, creating the ones ahead as time goes by
+REFRESH_SECONDS = 3600.0
+
+_range_bound = re.compile(r"^FOR VALUES FROM \((.*)\) TO \((.*)\)$")
+_time_zone = re.compile(r"[+-]\d\d(:\d\d){0,2}$")
+_sortable_directives = ["%Y", "%m", "%d", "%H", "%M", "%S", "%f"]
+
+
+class Partition(NamedTuple):
+	name: str
+	table: Identifier
+	lower: Optional[datetime]
+	upper: Optional[datetime]
+
+
+def parse_bound(bound: str) -> Optional[datetime]:
+	"""Return the datetime of one side of a range partition bound, None for MINVALUE and MAXVALUE.
+
+	Bounds of timestamp with time zone keys are printed in the session time zone, which is also the one of the
+	inserted rows, the offset is dropped.
+	"""
+	if bound in ("MINVALUE", "MAXVALUE"):
+		return None
+
+	if not (bound.startswith("'") and bound.endswith("'")):
+		raise ValueError("unsupported partition bound %s" % bound)
+
+	value = bound[1:-1]
+
+	if " " in value:
+		value = _time_zone.sub("", value)
+
+	return datetime.fromisoformat(value)
+
+
+def parse_range_bounds(expression: str) -> Optional[Tuple[Optional[datetime], Optional[datetime]]]:
+	"""Return the lower and upper bounds of pg_get_expr(relpartbound), None for a DEFAULT partition."""
+	if expression == "DEFAULT":
+		return None
+
+	match = _range_bound.match(expression)
+
+	if match is None:
+		raise ValueError("only range partitions on one date column are supported, not %s" % expression)
+
+	return parse_bound(match.group(1)), parse_bound(match.group(2))
+
+
+def is_sortable_format(date_format: str) -> bool:
+	"""Tell if dates formatted with date_format to a given width sort like the dates themselves."""
+	directives = re.findall(r"%.", date_format)
+	return 0 < len(directives) and directives == _sortable_directives[:len(directives)]
+
+
+def period_start(value: datetime, period: str) -> datetime:
+	value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+	if period == "year":
+		return value.replace(month=1, day=1)
+	elif period == "month":
+		return value.replace(day=1)
+	else:
+		return value
+
+
+def next_period(start: datetime, period: str) -> datetime:
+	if period == "year":
+		return start.replace(year=start.year + 1)
+	elif period == "month":
+		return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+	else:
+		return datetime.fromordinal(start.toordinal() + 1)
+
+
+def missing_periods(partitions: List[Partition], period: str, count: int,
+		now: datetime = None) -> List[Tuple[datetime, datetime]]:
+	"""Return the bounds of the count periods from the current one not covered by any partition."""
+	start = period_start(now or datetime.now(), period)
+	missing = []
+
+	for _ in range(count):
+		end = next_period(start, period)
+		if not any((x.lower is None or x.lower < end) and (x.upper is None or start < x.upper) for x in partitions):
+			missing.append((start, end))
+		start = end
+
+	return missing
+
+
+class PartitionRouter:
+
+	def __init__(self, key_index: int, date_format: str, load: Callable[[], List[Partition]]):
+		"""Group prepared rows by the range partition holding the date at key_index.
+
+		Partitions are read with load and cached, they are read again when a row matches none, at most every
+		MISS_REFRESH_SECONDS. Dates are compared as strings when date_format and the bounds allow it, ignoring
+		what follows the width of date_format like fractions of seconds, parsed otherwise.
+		"""
+		self.key_index = key_index
+		self.date_format = date_format
+		self._load = load
+		self._refresh_lock = Lock()
+		self._sortable = is_sortable_format(date_format)
+		self._width = len(datetime(2000, 1, 1).strftime(date_format)) if self._sortable else 0
+		# partitions sorted by lower bound, their lower bounds, and their bounds formatted like the rows or None
+		self._cache = ((), (), None, None)
+		self._refreshed = 0.0
+		self.refresh()
+
+	@property
+	def partitions(self) -> Tuple[Partition, ...]:
+		return self._cache[0]
+
+	def refresh(self):
+		"""Read partitions again unless another thread does."""
+		if not self._refresh_lock.acquire(blocking=False):
+			return
+
+		try:
+			partitions = sorted(self._load(), key=lambda x: x.lower or datetime.min)
+			lowers = tuple(x.lower or datetime.min for x in partitions)
+			text_lowers = None
+			text_uppers = None
+
+			if self._sortable and all(self._is_exact(x.lower) and self._is_exact(x.upper) for x in partitions):
+				text_lowers = tuple("" if x.lower is None else x.lower.strftime(self.date_format) for x in partitions)
+				text_uppers = tuple(None if x.upper is None else x.upper.strftime(self.date_format) for x in partitions)
+
+			# one assignment so other threads see a consistent cache
+			self._cache = tuple(partitions), lowers, text_lowers, text_uppers
+			self._refreshed = time.monotonic()
+			log.debug("routing rows to %d partitions", len(partitions))
+		finally:
+			self._refresh_lock.release()
+
+	def _is_exact(self, bound: Optional[datetime]) -> bool:
+		"""Tell if a bound is formatted by date_format without losing anything."""
+		return bound is None or datetime.strptime(bound.strftime(self.date_format), self.date_format) == bound
+
+	def find(self, value) -> Optional[Partition]:
+		"""Return the partition holding a date field, None when it is NULL, invalid or out of every partition."""
+		if value is None:
+			return None
+
+		partitions, lowers, text_lowers, text_uppers = self._cache
+
+		if text_lowers is not None and isinstance(value, str) and len(value) >= self._width:
+			value = value[:self._width]
+			i = bisect_right(text_lowers, value) - 1
+			if i >= 0 and (text_uppers[i] is None or value < text_uppers[i]):
+				return partitions[i]
+			return None
+
+		if not isinstance(value, datetime):
+			try:
+				value = datetime.strptime(value, self.date_format)
+			except (TypeError, ValueError):
+				return None
+
+		i = bisect_right(lowers, value) - 1
+		if i >= 0 and (partitions[i].upper is None or value < partitions[i].upper):
+			return partitions[i]
+		return None
+
+	def route(self, rows: List[list]) -> List[Tuple[Optional[Partition], List[list]]]:
+		"""Return rows grouped by partition in the order each one is first seen, None for rows matching none."""
+		groups = self._group(rows)
+		age = time.monotonic() - self._refreshed
+
+		if age >= REFRESH_SECONDS or (None in groups and age >= MISS_REFRESH_SECONDS):
+			self.refresh()
+			if None in groups:
+				for name, (partition, group) in self._group(groups.pop(None)[1]).items():
+					groups.setdefault(name, (partition, []))[1].extend(group)
+
+		return list(groups.values())
+
+	def _group(self, rows: List[list]) -> dict:
+		groups = {}
+		key_index = self.key_index
+		find = self.find
+
+		for row in rows:
+			partition = find(row[key_index])
+			name = partition and partition.name
+			group = groups.get(name)
+			if group is None:
+				group = groups[name] = (partition, [])
+			group[1].append(row)
+
+		return groups
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import logging
+import random
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable
+
+import psycopg2
+
+log = logging.getLogger("fileshovel.pgpool")
+
+# connection exception, transaction rollback, insufficient resources, operator intervention, system error
+RETRYABLE_SQLSTATE_CLASSES = frozenset(("08", "40", "53", "57", "58"))
+# read only transaction after a failover, lock not available, object in use
+RETRYABLE_SQLSTATES = frozenset(("25006", "55P03", "55006"))
+
+
+def is_retryable(error: Exception) -> bool:
+	"""Tell if an operation failing with error may succeed once tried again.
+
+	Errors without SQLSTATE come from the connection itself, like a refused connection or a server gone away.
+	"""
+	if not isinstance(error, psycopg2.Error):
+		return False
+
+	if error.pgcode is None:
+		return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+	return error.pgcode[:2] in RETRYABLE_SQLSTATE_CLASSES or error.pgcode in RETRYABLE_SQLSTATES
+
+
+class Backoff:
+
+	def __init__(self, initial: float, maximum: float, factor: float = 2.0, jitter: float = 0.5):
+		"""Delays growing exponentially from initial up to maximum, each shortened by up to jitter of it at random
+		so threads retrying together spread out."""
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.jitter = jitter
+		self.attempts = 0
+
+	def next(self) -> float:
+		delay = min(self.initial * self.factor ** self.attempts, self.maximum)
+		self.attempts += 1
+		return delay * (1 - self.jitter * random.random())
+
+	def reset(self):
+		self.attempts = 0
+
+
+class SessionPool:
+
+	def __init__(self, connect: Callable[[], object], size: int, health_check_interval: float):
+		"""Idle sessions handed out to one thread at a time, a session being an object with a connection and close().
+
+		A session idle for health_check_interval seconds is checked with SELECT 1 before being handed out again,
+		up to size sessions are kept idle.
+		"""
+		self._connect = connect
+		self.size = size
+		self.health_check_interval = health_check_interval
+		self._idle = deque()
+		self._lock = Lock()
+
+	def get(self):
+		"""Return an idle session still connected, or a new one."""
+		while True:
+			with self._lock:
+				session, returned = self._idle.pop() if self._idle else (None, None)
+
+			if session is None:
+				return self._connect()
+
+			if session.connection.closed:
+				session.close()
+			elif time.monotonic() - returned >= self.health_check_interval and not self.is_healthy(session):
+				log.info("dropping a connection failing its health check")
+				session.close()
+			else:
+				return session
+
+	@staticmethod
+	def is_healthy(session) -> bool:
+		try:
+			session.connection.cursor().execute("SELECT 1")
+			session.connection.rollback()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def put(self, session):
+		"""Give back a session once its transaction is over."""
+		with self._lock:
+			if not session.connection.closed and len(self._idle) < self.size:
+				self._idle.append((session, time.monotonic()))
+				return
+
+		session.close()
+
+	def discard(self, session, error: Exception = None):
+		"""Close a session which failed, with a retryable error the idle ones are likely broken too."""
+		session.close()
+
+		if error is not None and is_retryable(error):
+			self.clear()
+
+	def clear(self):
+		with self._lock:
+			idle = list(self._idle)
+			self._idle.clear()
+
+		for session, _ in idle:
+			session.close()
@@ -1,25 +1,67 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import io
 import logging
 import time
-from queue import Queue
-from threading import Event, Thread
-from typing import List
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Callable, List, Optional, Tuple
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 from psycopg2.sql import Identifier, SQL, Literal
 
+from fileshovel import profiling
+from fileshovel.batch import FlushPolicy, estimate_row_size
+from fileshovel.columnmap import Transform
+from fileshovel.metrics import ROW_BUCKETS, metrics
 from fileshovel.options import FileShovelOptions
+from fileshovel.pgcopy import encode_copy_binary, encode_copy_binary_typed, encode_copy_text
+from fileshovel.pgpartition import PERIOD_SUFFIXES, Partition, PartitionRouter, missing_periods, parse_range_bounds
+from fileshovel.pgpool import Backoff, SessionPool, is_retryable
+from fileshovel.pgtypes import convert_row, get_binary_encoder, get_converter, get_staging_type, \
+		load_column_types, save_column_types
+from fileshovel.spool import Spool
+from fileshovel.watermark import OffsetWatermark
 
 log = logging.getLogger("fileshovel.pgsql")
 
 
+# condition of the update of a checkpoint row {0} by a newer one, checkpoints without a sequence are written by
+# backfills and previous versions before any row is followed
+CHECKPOINT_FORWARD = "WHERE {0}.csv_sequence IS NULL OR EXCLUDED.csv_sequence IS NULL " \
+		"OR {0}.csv_sequence < EXCLUDED.csv_sequence"
+
+
+class PgSession:
+
+	def __init__(self, pg_connection, cursor, asynchronous_commit: bool, merge_sql: Optional[str],
+			converters: Optional[list], encoders: Optional[list]):
+		"""Connection of an SQL thread and what was set up for it."""
+		self.connection = pg_connection
+		self.cursor = cursor
+		self.asynchronous_commit = asynchronous_commit
+		self.merge_sql = merge_sql
+		self.converters = converters
+		self.encoders = encoders
+		self.partition_merge_sqls = {}
+		self.last_durable_commit = time.monotonic()
+
+	def close(self):
+		try:
+			self.connection.close()
+		except psycopg2.Error:
+			pass
+
+
 class PgLineInserter:
 
-	def __init__(self, options: FileShovelOptions):
+	def __init__(self, options: FileShovelOptions, write_checkpoints=True):
 		self._options = options
 		self.server_name_column = options.pg_server_name_column
 		self.server_name_value = options.pg_server_name_value
+		self.file_column = options.pg_csv_file_column
 		self.offset_column = Identifier(options.pg_csv_offset_column)
 		self.extra_columns = [self.offset_column]
 		self.insert_queue = Queue(maxsize=options.pg_rows_per_commit if options.pg_threads > 0 else 0)
@@ -33,59 +75,349 @@ class PgLineInserter:
 			self.server_name_column = Identifier(self.server_name_column)
 			self.extra_columns.append(self.server_name_column)
 
-		self.columns = [Identifier(x) for x in options.columns] + self.extra_columns
+		if self.file_column:
+			self.file_column = Identifier(self.file_column)
+			self.extra_columns.append(self.file_column)
+
+		self.pool = SessionPool(lambda: self.open_session(options.pg_insert_mode == "copy"),
+				max(options.pg_threads, 1), options.pg_health_check_interval)
+		self.column_map = options.get_column_map()
+		self.columns = [Identifier(x) for x in self.column_map.names] + self.extra_columns
+		self._prepare_row = self.compile_row_transform()
+		self.column_names = [x.strings[-1] for x in self.columns]
+		self.staging_table = Identifier("fileshovel_staging")
+		self.typed_rows = options.pg_typed_rows
+		self.committed_offsets = {}
+		self._column_types = None
+		self._column_types_lock = Lock()
+
+		if self.typed_rows:
+			psycopg2.extras.register_uuid()
 
 		if options.pg_schema:
 			self.table = SQL(".").join([Identifier(options.pg_schema), Identifier(options.pg_table)])
 		else:
 			self.table = Identifier(options.pg_table)
 
-		self.last_offset = self.get_last_offset_from_database()
+		self.router = self.create_partition_router() if options.pg_partition_routing else None
+
+		if options.pg_checkpoint_table and write_checkpoints:
+			self.checkpoint_table = self.qualify_table(options.pg_checkpoint_table)
+			self.create_checkpoint_table()
+			self.watermark = OffsetWatermark()
+		else:
+			self.checkpoint_table = None
+			self.watermark = None
+
+			if write_checkpoints and options.pg_threads > 1:
+				log.warning("without --pg-checkpoint-table, rows still in flight in other SQL threads "
+						"may be skipped when resuming from the highest inserted offset")
+
+		# backfill workers insert ranges of the file again if they fail, they don't spool
+		if options.pg_spool_dir and write_checkpoints:
+			self.spool = Spool(options.pg_spool_dir, options.pg_spool_max_bytes, options.pg_rows_per_commit)
+		else:
+			self.spool = None
+
+		metrics.add_collector(self._collect_metrics)
 
 		if options.pg_threads > 0:
 			for t in self.sql_threads:
 				t.start()
 
+	def _collect_metrics(self):
+		yield "fileshovel_queue_rows", {}, self.insert_queue.qsize()
+
+		if self.spool:
+			yield "fileshovel_spool_batches", {}, self.spool.batches
+			yield "fileshovel_spool_bytes", {}, self.spool.bytes
+
+	def _record_batch(self, reason: str, rows: int, batch_offsets: dict, execute_time: float, commit_time: float):
+		"""Remember the last committed offset of each file of a batch and update metrics."""
+		self.committed_offsets.update(batch_offsets)
+		metrics.inc("fileshovel_rows_inserted_total", rows)
+		metrics.inc("fileshovel_batches_total", reason=reason)
+		metrics.observe("fileshovel_batch_rows", rows, ROW_BUCKETS)
+		metrics.observe("fileshovel_execute_seconds", execute_time)
+		metrics.observe("fileshovel_commit_seconds", commit_time)
+
 	def connect_database(self):
 		return psycopg2.connect(self._options.pg_connection_string)
 
+	def new_backoff(self) -> Backoff:
+		return Backoff(self._options.pg_retry_delay, self._options.pg_retry_max_delay)
+
+	def retry(self, operation: Callable[[], object], description: str):
+		"""Return the result of operation, called again with exponential backoff while it fails with a retryable
+		error, for up to --pg-retry-timeout seconds."""
+		backoff = self.new_backoff()
+		timeout = self._options.pg_retry_timeout
+		started = time.monotonic()
+
+		while True:
+			try:
+				return operation()
+			except psycopg2.Error as e:
+				if not is_retryable(e):
+					raise
+				if timeout and time.monotonic() - started >= timeout:
+					log.error("%s failed for %.0fs, giving up", description, time.monotonic() - started)
+					raise
+				delay = backoff.next()
+				metrics.inc("fileshovel_pg_retries_total", error=type(e).__name__)
+				log.warning("%s failed, retrying in %.1fs: %s", description, delay, e)
+				time.sleep(delay)
+
+	def run(self, operation: Callable, description: str):
+		"""Return operation(pg_connection) run in a transaction of a new connection, retried like retry does.
+
+		Operations must be idempotent, a commit failing with a connection error may have succeeded."""
+		def run_once():
+			pg_connection = self.connect_database()
+			try:
+				with pg_connection:
+					return operation(pg_connection)
+			finally:
+				pg_connection.close()
+
+		return self.retry(run_once, description)
+
+	def qualify_table(self, table: str) -> SQL:
+		if self._options.pg_schema:
+			return SQL(".").join([Identifier(self._options.pg_schema), Identifier(table)])
+		else:
+			return Identifier(table)
+
+	def get_file_identity(self, csv_file: str = None) -> str:
+		return csv_file or self._options.csv_file
+
+	def create_checkpoint_table(self):
+		def create(pg_connection):
+			cursor = pg_connection.cursor()
+			cursor.execute(SQL(
+				"CREATE TABLE IF NOT EXISTS {0} ("
+				"server_name text NOT NULL, "
+				"csv_file text NOT NULL, "
+				"csv_offset bigint NOT NULL, "
+				"csv_line bigint, "
+				"csv_inode bigint, "
+				"csv_sequence bigint, "
+				"updated_at timestamp with time zone NOT NULL DEFAULT now(), "
+				"PRIMARY KEY (server_name, csv_file))"
+			).format(self.checkpoint_table).as_string(pg_connection))
+			# tables created by previous versions
+			cursor.execute(SQL(
+				"ALTER TABLE {0} ADD COLUMN IF NOT EXISTS csv_inode bigint, ADD COLUMN IF NOT EXISTS csv_sequence bigint"
+			).format(
+				self.checkpoint_table,
+			).as_string(pg_connection))
+
+		self.run(create, "creating the checkpoint table")
+
+	def _write_checkpoints(self, cursor, checkpoints: dict):
+		"""Store the last offset of each file of a batch and the inode it belongs to, must be called in the batch
+		transaction.
+
+		A checkpoint never goes back: it is only replaced by one with a higher sequence, which was dispatched later,
+		whatever the order batches commit in and wherever offsets restart after a rotation or a truncation."""
+		for csv_file, (current_line, current_line_offset, inode, sequence) in checkpoints.items():
+			cursor.execute(SQL(
+				"INSERT INTO {0} (server_name, csv_file, csv_offset, csv_line, csv_inode, csv_sequence) "
+				"VALUES (%s, %s, %s, %s, %s, %s) "
+				"ON CONFLICT (server_name, csv_file) DO UPDATE SET "
+				"csv_offset = EXCLUDED.csv_offset, csv_line = EXCLUDED.csv_line, csv_inode = EXCLUDED.csv_inode, "
+				"csv_sequence = EXCLUDED.csv_sequence, updated_at = now() " + CHECKPOINT_FORWARD
+			).format(self.checkpoint_table), (
+				self.server_name_value,
+				self.get_file_identity(csv_file),
+				current_line_offset,
+				current_line,
+				inode,
+				sequence,
+			))
+
+	def save_checkpoint(self, csv_file: str, current_line: int, current_line_offset: int, inode: int = None,
+			sequence: int = None):
+		"""Store the offset to resume csv_file from outside of a batch, without sequence it replaces any checkpoint."""
+		checkpoints = {csv_file: (current_line, current_line_offset, inode, sequence)}
+		self.run(lambda x: self._write_checkpoints(x.cursor(), checkpoints), "saving the checkpoint of %s" % csv_file)
+
+	def create_partition_router(self) -> PartitionRouter:
+		"""Route rows by the column taken from --date-column, which must be the range partition key of the table."""
+		key_column = self.run(self._read_partition_key, "reading the partition key of %s" % self._options.pg_table)
+		date_column = self._options.date_column
+		key_index = next((i for i, x in enumerate(self.column_map.columns) if x.source == date_column), None)
+
+		if key_index is None or self.column_map.names[key_index] != key_column:
+			raise ValueError("--date-column %s must be inserted in %s, the partition key of %s" % (
+				self._options.columns[date_column], key_column, self._options.pg_table))
+
+		return PartitionRouter(key_index, self._options.csv_date_format, self.load_partitions)
+
+	def _read_partition_key(self, pg_connection) -> str:
+		cursor = pg_connection.cursor()
+		cursor.execute(
+			"SELECT a.attname FROM pg_catalog.pg_partitioned_table p "
+			"JOIN pg_catalog.pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0] "
+			"WHERE p.partrelid = %s::regclass AND p.partstrat = 'r' AND p.partnatts = 1",
+			(self.table.as_string(pg_connection),),
+		)
+		row = cursor.fetchone()
+
+		if row is None:
+			raise ValueError("%s is not partitioned by range on one column" % self._options.pg_table)
+
+		return row[0]
+
+	def load_partitions(self) -> List[Partition]:
+		"""Read the range partitions of the table, after creating the missing ones with --pg-create-partitions."""
+		return self.run(self._load_partitions, "reading the partitions of %s" % self._options.pg_table)
+
+	def _load_partitions(self, pg_connection) -> List[Partition]:
+		partitions = self._read_partitions(pg_connection)
+		missing = missing_periods(partitions, self._options.pg_partition_period, self._options.pg_create_partitions)
+
+		for lower, upper in missing:
+			self._create_partition(pg_connection, lower, upper)
+
+		return self._read_partitions(pg_connection) if missing else partitions
+
+	def _read_partitions(self, pg_connection) -> List[Partition]:
+		cursor = pg_connection.cursor()
+		cursor.execute(
+			"SELECT n.nspname, c.relname, pg_catalog.pg_get_expr(c.relpartbound, c.oid) "
+			"FROM pg_catalog.pg_inherits i "
+			"JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid "
+			"JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace "
+			"WHERE i.inhparent = %s::regclass",
+			(self.table.as_string(pg_connection),),
+		)
+		partitions = []
+
+		for schema, name, expression in cursor.fetchall():
+			bounds = parse_range_bounds(expression)
+			# rows for the DEFAULT partition go through the table
+			if bounds:
+				partitions.append(Partition("%s.%s" % (schema, name), Identifier(schema, name), *bounds))
+
+		return partitions
+
+	def _create_partition(self, pg_connection, lower, upper):
+		"""Create the partition of a period, a failure other than a lost connection only logs a warning."""
+		name = "%s_%s" % (self._options.pg_table, lower.strftime(PERIOD_SUFFIXES[self._options.pg_partition_period]))
+		cursor = pg_connection.cursor()
+		cursor.execute("SAVEPOINT fileshovel_partition")
+
+		try:
+			cursor.execute(SQL("CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM (%s) TO (%s)").format(
+				self.qualify_table(name),
+				self.table,
+			), (str(lower), str(upper)))
+		except psycopg2.Error as e:
+			if is_retryable(e):
+				raise
+			cursor.execute("ROLLBACK TO SAVEPOINT fileshovel_partition")
+			log.warning("unable to create partition %s of %s: %s", name, self._options.pg_table, e)
+			return
+
+		cursor.execute("RELEASE SAVEPOINT fileshovel_partition")
+		log.info("created partition %s from %s to %s", name, lower, upper)
+
 	def start_sql_threads(self, how_many: int) -> List[Thread]:
 		for i in range(how_many):
 			yield Thread(name="sql_thread%d" % i, target=self._insert_rows, args=(self.insert_queue,))
 
-	def get_last_offset_from_database(self) -> int:
-		with self.connect_database() as pg_connection:
-			c = pg_connection.cursor()
-
-			if self.server_name_column:
-				sql = SQL("SELECT {0} FROM {1} WHERE {2}={3} ORDER BY {4} DESC LIMIT 1").format(
-					self.offset_column,
-					self.table,
-					self.server_name_column,
-					Literal(self.server_name_value),
-					self.offset_column,
-				)
-			else:
-				sql = SQL("SELECT {0} FROM {1} ORDER BY {2} DESC LIMIT 1").format(
-					self.offset_column,
-					self.table,
-					self.offset_column,
-				)
+	def get_last_offset_from_database(self, csv_file: str = None) -> int:
+		return self.get_last_checkpoint(csv_file)[0]
 
-			sql = sql.as_string(pg_connection)
-			c.execute(sql)
+	def get_last_checkpoint(self, csv_file: str = None) -> Tuple[int, Optional[int]]:
+		"""Return the offset to resume csv_file from and the inode of the file it belongs to, when known."""
+		if self.checkpoint_table:
+			return self.run(lambda x: self._get_last_offset_from_checkpoint(x, csv_file), "reading the last offset")
+		else:
+			return self.run(lambda x: self._get_last_offset_from_table(x, csv_file), "reading the last offset"), None
+
+	def _get_last_offset_from_checkpoint(self, pg_connection, csv_file: str = None) -> Tuple[int, Optional[int]]:
+		c = pg_connection.cursor()
+		c.execute(SQL(
+			"SELECT csv_offset, csv_inode, csv_sequence FROM {0} WHERE server_name=%s AND csv_file=%s"
+		).format(
+			self.checkpoint_table,
+		).as_string(pg_connection), (
+			self.server_name_value,
+			self.get_file_identity(csv_file),
+		))
+
+		if c.rowcount == 0:
+			return 0, None
+
+		offset, inode, sequence = next(c)
+		# rows read from here are numbered after the checkpoint so they replace it
+		self.watermark.resume(csv_file, sequence or 0)
+		return offset, inode
+
+	def _get_last_offset_from_table(self, pg_connection, csv_file: str = None) -> int:
+		c = pg_connection.cursor()
+		conditions = []
 
-			if c.rowcount == 0:
-				ret = 0
-			else:
-				ret = next(c)[0]
+		if self.server_name_column:
+			conditions.append(SQL("{0}={1}").format(self.server_name_column, Literal(self.server_name_value)))
+
+		if self.file_column:
+			conditions.append(SQL("{0}={1}").format(self.file_column, Literal(self.get_file_identity(csv_file))))
+
+		if conditions:
+			sql = SQL("SELECT {0} FROM {1} WHERE {2} ORDER BY {3} DESC LIMIT 1").format(
+				self.offset_column,
+				self.table,
+				SQL(" AND ").join(conditions),
+				self.offset_column,
+			)
+		else:
+			sql = SQL("SELECT {0} FROM {1} ORDER BY {2} DESC LIMIT 1").format(
+				self.offset_column,
+				self.table,
+				self.offset_column,
+			)
+
+		sql = sql.as_string(pg_connection)
+		c.execute(sql)
+
+		if c.rowcount == 0:
+			ret = 0
+		else:
+			ret = next(c)[0]
 
-			return ret
+		return ret
 
-	def add_row(self, line: list, current_line: int, current_line_offset: int):
+	def add_row(self, line: list, current_line: int, current_line_offset: int, csv_file: str = None,
+			inode: int = None):
 		if self.sql_thread_dead.is_set():
 			raise RuntimeError("SQL thread died.")
-		self.insert_queue.put((line, current_line, current_line_offset), block=True)
+
+		item = self.make_item(line, current_line, current_line_offset, csv_file, inode)
+
+		if self.spool:
+			# SQL threads are behind, spool the row instead of waiting for them
+			try:
+				self.insert_queue.put_nowait(item)
+				return
+			except Full:
+				if self.spool.add(self._prepare_row(item), item[4], csv_file, current_line_offset):
+					metrics.inc("fileshovel_spooled_rows_total")
+					return
+
+		self.insert_queue.put(item, block=True)
+
+	def make_item(self, line: list, current_line: int, current_line_offset: int, csv_file: str = None,
+			inode: int = None) -> tuple:
+		"""Return the queued form of a row, marked in the watermark when checkpoints are written."""
+		if self.watermark:
+			mark = self.watermark.dispatch(csv_file, current_line, current_line_offset, inode)
+		else:
+			mark = None
+
+		return line, current_line, current_line_offset, csv_file, mark
 
 	def pre_commit(self):
 		pass
@@ -103,73 +435,438 @@ class PgLineInserter:
 			self.insert_queue.put(None)
 			self._insert_rows(self.insert_queue)
 
-	def _prepare_row(self, item):
-		line, current_line, current_line_offset = item
-
-		if len(line) + len(self.extra_columns) < len(self.columns):
-			if self._options.add_missing_columns:
-				while len(line) + len(self.extra_columns) < len(self.columns):
-					line.append(None)
+		self.pool.clear()
+
+		if self.spool:
+			self._drain_spool()
+			self.spool.close()
+			if self.spool.batches:
+				# PostgreSQL is still down, the next start inserts the spooled batches without their marks: the
+				# checkpoints stay at the last inserted batch and the rows after it are read again
+				return
+
+		self.save_watermarks()
+
+	def _drain_spool(self):
+		"""Replay the spooled batches with their checkpoints, retrying for up to --pg-retry-timeout seconds."""
+		backoff = self.new_backoff()
+		timeout = self._options.pg_retry_timeout
+		started = time.monotonic()
+
+		while self.spool.pending:
+			if self._replay_spool(convert_row, wait=True):
+				backoff.reset()
+			elif timeout and time.monotonic() - started >= timeout:
+				log.error("PostgreSQL is unavailable for %.0fs, leaving %d batches in spool %s",
+						time.monotonic() - started, self.spool.batches, self.spool.directory)
+				return
 			else:
-				raise IndexError("Row has %d columns while table has %d." % (len(line), len(self.columns)))
+				time.sleep(backoff.next())
+
+	def save_watermarks(self):
+		"""Store the watermark of every file, SQL threads commit in any order and the last one may have lagged."""
+		if self.watermark:
+			for csv_file, (current_line, current_line_offset, inode, sequence) in self.watermark.items():
+				self.save_checkpoint(csv_file, current_line, current_line_offset, inode, sequence)
+
+	def get_column_types(self, pg_connection, check=False) -> List[str]:
+		"""Return the SQL type of each inserted column, read from the catalog once then from --pg-types-file.
+
+		With check, the catalog is read again and the cached types are replaced if they changed, as after an
+		ALTER TABLE ... TYPE, binary COPY would otherwise keep encoding the previous types."""
+		with self._column_types_lock:
+			if self._column_types is None or check:
+				table = self.table.as_string(pg_connection)
+				cached = load_column_types(self._options.pg_types_file, table)
+				types = cached
+
+				if check or types is None or any(x not in types for x in self.column_names):
+					types = self._read_column_types(pg_connection)
+					if types != cached:
+						if cached is not None:
+							log.info("column types of %s changed, updating %s", table, self._options.pg_types_file)
+						save_column_types(self._options.pg_types_file, table, types)
+
+				self._column_types = [types[x] for x in self.column_names]
+
+			return self._column_types
+
+	def _read_column_types(self, pg_connection) -> dict:
+		cursor = pg_connection.cursor()
+		cursor.execute(
+			"SELECT attname, format_type(atttypid, atttypmod) FROM pg_catalog.pg_attribute "
+			"WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+			(self.table.as_string(pg_connection),),
+		)
+		types = dict(cursor.fetchall())
+		pg_connection.commit()
+		return types
+
+	def _set_synchronous_commit(self, pg_connection, cursor) -> bool:
+		"""Apply --pg-synchronous-commit to the session and return True when commits don't wait for the WAL flush.
+
+		Rows and checkpoints share a transaction so a lost asynchronous commit loses both and the resume offset
+		stays consistent with the table, only the durable commits bound how much is inserted again."""
+		synchronous_commit = self._options.pg_synchronous_commit
+
+		if synchronous_commit is None:
+			return False
+
+		cursor.execute("SET synchronous_commit TO %s", (synchronous_commit,))
+		pg_connection.commit()
+		return synchronous_commit == "off"
+
+	def _setup_staging_table(self, pg_connection, cursor) -> SQL:
+		"""Create the per-session staging table used by COPY and return the merge statement."""
+		column_types = self.get_column_types(pg_connection)
+
+		if self.typed_rows and self._options.pg_copy_format == "binary":
+			staging_types = [get_staging_type(x) for x in column_types]
+		else:
+			staging_types = ["text"] * len(column_types)
+
+		cursor.execute(SQL("CREATE TEMPORARY TABLE IF NOT EXISTS {0} ({1}) ON COMMIT DELETE ROWS").format(
+			self.staging_table,
+			SQL(",").join(x + SQL(" " + t) for x, t in zip(self.columns, staging_types)),
+		))
+		pg_connection.commit()
+		return self._compose_merge(pg_connection, self.table)
+
+	def _compose_merge(self, pg_connection, table) -> str:
+		"""Return the statement moving the staged rows to table."""
+		column_types = self.get_column_types(pg_connection)
+		return SQL("INSERT INTO {0} ({1}) SELECT {2} FROM {3} ON CONFLICT DO NOTHING").format(
+			table,
+			SQL(",").join(self.columns),
+			SQL(",").join(x + SQL("::" + t) for x, t in zip(self.columns, column_types)),
+			self.staging_table,
+		).as_string(pg_connection)
+
+	def _get_merge_sql(self, session: PgSession, partition: Optional[Partition]) -> str:
+		if partition is None:
+			return session.merge_sql
+
+		merge_sql = session.partition_merge_sqls.get(partition.name)
+
+		if merge_sql is None:
+			merge_sql = session.partition_merge_sqls[partition.name] = \
+					self._compose_merge(session.connection, partition.table)
+
+		return merge_sql
+
+	def _route_rows(self, rows: List[list]) -> List[Tuple[Optional[Partition], List[list]]]:
+		"""Group rows by partition with --pg-partition-routing, None is the table itself."""
+		if self.router is None:
+			return [(None, rows)]
+
+		groups = self.router.route(rows)
+
+		for partition, group in groups:
+			if partition is None:
+				metrics.inc("fileshovel_rows_unrouted_total", len(group))
+
+		return groups
+
+	def _compose_copy(self, pg_connection, values: list, encoders: list = None) -> Tuple[str, bytes]:
+		"""Return the COPY statement of the staging table and its payload."""
+		encoding = psycopg2.extensions.encodings[pg_connection.encoding]
+
+		if encoders:
+			payload = encode_copy_binary_typed(values, encoders)
+			copy_format = SQL("BINARY")
+		elif self._options.pg_copy_format == "binary":
+			payload = encode_copy_binary(values, encoding)
+			copy_format = SQL("BINARY")
+		else:
+			payload = encode_copy_text(values, encoding)
+			copy_format = SQL("TEXT")
 
-		if self._options.csv_null_text is not None:
-			for i, field in enumerate(line):
-				if field == self._options.csv_null_text:
-					line[i] = None
+		sql = SQL("COPY {0} ({1}) FROM STDIN WITH (FORMAT {2})").format(
+			self.staging_table,
+			SQL(",").join(self.columns),
+			copy_format,
+		).as_string(pg_connection)
+		return sql, payload
 
-		line.append(current_line_offset)
+	def compile_row_transform(self) -> Transform:
+		"""Compile the column map and the extra columns into the function preparing each queued row."""
+		extras = ["current_line_offset"]
+		namespace = {}
 
-		if self._options.pg_csv_offset_column:
-			line.append(current_line)
+		if self._options.pg_csv_line_column:
+			extras.append("current_line")
 
-		if self.server_name_column:
-			line.append(self.server_name_value)
+		if self.server_name_column and self.server_name_value:
+			extras.append("server_name")
+			namespace["server_name"] = self.server_name_value
+
+		if self.file_column:
+			extras.append("file_identity(csv_file)")
+			namespace["file_identity"] = self.get_file_identity
 
+		return self.column_map.compile(extras, namespace, self._options.add_missing_columns,
+				"column map of %s" % self._options.pg_table)
+
+	@staticmethod
+	def _compose_row(line: list) -> SQL:
 		return SQL("(") + SQL(",").join((Literal(x) for x in line)) + SQL(")")
 
+	def open_session(self, use_copy: bool) -> PgSession:
+		"""Connect and set up a session for the pool of SQL threads."""
+		log.info("connecting")
+		pg_connection = self.connect_database()
+
+		try:
+			cursor = pg_connection.cursor()
+			asynchronous_commit = self._set_synchronous_commit(pg_connection, cursor)
+			if self.typed_rows or use_copy:
+				# the table may have been altered since the types were cached
+				self.get_column_types(pg_connection, check=True)
+			merge_sql = self._setup_staging_table(pg_connection, cursor) if use_copy else None
+			converters = None
+			encoders = None
+
+			if self.typed_rows:
+				column_types = self.get_column_types(pg_connection)
+				converters = [get_converter(x, self._options.csv_date_format) for x in column_types]
+				if use_copy and self._options.pg_copy_format == "binary":
+					encoding = psycopg2.extensions.encodings[pg_connection.encoding]
+					encoders = [get_binary_encoder(x, encoding) for x in column_types]
+
+		except psycopg2.Error:
+			pg_connection.close()
+			raise
+
+		log.info("connected")
+		return PgSession(pg_connection, cursor, asynchronous_commit, merge_sql, converters, encoders)
+
+	def _convert_rows(self, rows: List[list], convert, converters: list) -> List[list]:
+		"""Convert rows to the column types, skipping the ones failing conversion."""
+		offset_index = len(self.column_map.names)
+		values = []
+
+		for row in rows:
+			try:
+				values.append(convert(row, converters))
+			except (ValueError, TypeError) as e:
+				log.warning("skipping row at offset %s: %s", row[offset_index], e)
+				metrics.inc("fileshovel_rows_skipped_total")
+
+		return values
+
+	def _send_batch(self, session: PgSession, rows: List[list], marks: list, ending: bool, convert):
+		"""Insert a batch of prepared rows and the checkpoints of its marks in one transaction.
+
+		Returns the seconds it took to execute and to commit it, and if the commit waited for the WAL flush."""
+		pg_connection = session.connection
+		cursor = session.cursor
+		use_copy = session.merge_sql is not None
+		started = time.monotonic()
+
+		with profiling.stage("compose"):
+			statements = []
+			for partition, group in self._route_rows(rows):
+				values = self._convert_rows(group, convert, session.converters) if session.converters else group
+				if not values:
+					# every row failed conversion, the checkpoints still move past them
+					continue
+				table = self.table if partition is None else partition.table
+				if use_copy:
+					sql, payload = self._compose_copy(pg_connection, values, session.encoders)
+					statements.append((sql, payload, self._get_merge_sql(session, partition)))
+				else:
+					statements.append(((SQL("INSERT INTO {0} ({1}) VALUES {2}").format(
+						table,
+						SQL(",").join(self.columns),
+						SQL(",").join(self._compose_row(x) for x in values),
+					) + SQL(" ON CONFLICT DO NOTHING")).as_string(pg_connection), None, None))
+		with profiling.stage("execute"):
+			for i, (sql, payload, merge_sql) in enumerate(statements):
+				if payload is None:
+					cursor.execute(sql)
+					continue
+				if i:
+					# rows merged into the previous partition are still staged
+					cursor.execute(SQL("DELETE FROM {0}").format(self.staging_table).as_string(pg_connection))
+				cursor.copy_expert(sql, io.BytesIO(payload))
+				cursor.execute(merge_sql)
+			if self.checkpoint_table:
+				self._write_checkpoints(cursor, self.watermark.peek(marks))
+			durable = not session.asynchronous_commit or ending or \
+					time.monotonic() - session.last_durable_commit >= self._options.pg_durable_commit_interval
+			if session.asynchronous_commit and durable:
+				cursor.execute("SET LOCAL synchronous_commit TO on")
+		executed = time.monotonic()
+		with profiling.stage("commit"):
+			self.pre_commit()
+			pg_connection.commit()
+			if self.watermark:
+				self.watermark.commit(marks)
+			self.post_commit()
+		committed = time.monotonic()
+		if durable:
+			session.last_durable_commit = committed
+
+		return executed - started, committed - executed, durable
+
+	def _send(self, rows: List[list], marks: list, batch_offsets: dict, reason: str, ending: bool, convert):
+		"""Insert a batch from a pooled session, which is closed if it fails."""
+		session = self.pool.get()
+
+		try:
+			execute_time, commit_time, durable = self._send_batch(session, rows, marks, ending, convert)
+		except BaseException as e:
+			self.pool.discard(session, e)
+			raise
+
+		self.pool.put(session)
+		self._record_batch(reason, len(rows), batch_offsets, execute_time, commit_time)
+		log.debug("flushed %d rows on %s, executed in %.3fs, committed in %.3fs%s",
+				len(rows), reason, execute_time, commit_time, "" if durable else " asynchronously")
+
+	def _flush_batch(self, rows: List[list], marks: list, batch_offsets: dict, reason: str, ending: bool, convert,
+			spooling: bool) -> bool:
+		"""Insert a batch, returns False if it was spooled because PostgreSQL is unavailable.
+
+		While spooling, PostgreSQL isn't tried. Without a spool or when it is full, the batch is retried until it
+		is inserted, ON CONFLICT DO NOTHING makes inserting it again harmless if a failed commit succeeded."""
+		if self.spool:
+			if not spooling:
+				try:
+					self._send(rows, marks, batch_offsets, reason, ending, convert)
+					return True
+				except psycopg2.Error as e:
+					if not is_retryable(e):
+						raise
+					metrics.inc("fileshovel_pg_retries_total", error=type(e).__name__)
+					log.warning("PostgreSQL is unavailable, spooling batches: %s", e)
+
+			if self.spool.append(rows, (marks, batch_offsets)):
+				metrics.inc("fileshovel_spooled_rows_total", len(rows))
+				return False
+
+			log.warning("spool %s is full, waiting for PostgreSQL", self.spool.directory)
+
+		self.retry(lambda: self._send(rows, marks, batch_offsets, reason, ending, convert),
+				"inserting %d rows" % len(rows))
+		return True
+
+	def _replay_spool(self, convert, wait=False) -> bool:
+		"""Insert the next spooled batch unless another thread does, returns False if PostgreSQL is unavailable.
+
+		Batches are replayed one at a time in order, with wait the thread waits for its turn."""
+		spool = self.spool
+
+		if not spool.replay_lock.acquire(blocking=wait):
+			return True
+
+		try:
+			batch = spool.peek()
+			if batch is None:
+				return True
+
+			rows, context = batch
+			marks, batch_offsets = context or ([], {})
+
+			try:
+				self._send(rows, marks, batch_offsets, "spool", False, convert)
+			except psycopg2.Error as e:
+				if not is_retryable(e):
+					raise
+				metrics.inc("fileshovel_pg_retries_total", error=type(e).__name__)
+				log.warning("PostgreSQL is unavailable again, spooling batches: %s", e)
+				return False
+
+			spool.remove()
+			log.debug("replayed %d spooled rows, %d batches left", len(rows), spool.batches)
+			return True
+
+		finally:
+			spool.replay_lock.release()
+
 	def _insert_rows(self, row_queue: Queue):
-		columns = self.columns
-		table = self.table
 		rows_per_commit = self._options.pg_rows_per_commit
+		spool = self.spool
+		backoff = self.new_backoff()
+		# while spooling, PostgreSQL isn't tried again before then
+		next_attempt = 0.0
 
 		try:
-			log.info("connecting")
-			pg_connection = self.connect_database()
-			cursor = pg_connection.cursor()
-			insert_format = SQL("INSERT INTO {0} ({1}) VALUES {2}")
-			do_nothing = SQL(" ON CONFLICT DO NOTHING")
 			ending = False
-			log.info("connected")
-			values = []
+
+			get_item = row_queue.get
+			prepare_row = self._prepare_row
+			convert = convert_row
+			timer = profiling.stage_timer
+
+			if timer:
+				get_item = timer.wrap(get_item, "wait")
+				prepare_row = timer.wrap(prepare_row, "prepare")
+				convert = timer.wrap(convert, "prepare")
+
+			rows = []
+			marks = []
+			batch_offsets = {}
+			policy = FlushPolicy(rows_per_commit, self._options.pg_max_batch_bytes, self._options.pg_max_batch_delay)
+			count_bytes = policy.max_bytes > 0
 
 			while True:
-				item = row_queue.get()
+				timeout = policy.timeout()
+
+				if spool and spool.pending:
+					attempt_timeout = next_attempt - time.monotonic()
+
+					if attempt_timeout > 0:
+						timeout = attempt_timeout if timeout is None else min(timeout, attempt_timeout)
+					elif not row_queue.full():
+						# spooled batches go first while the readers aren't waiting
+						if self._replay_spool(convert):
+							backoff.reset()
+						else:
+							next_attempt = time.monotonic() + backoff.next()
+						timeout = 0
+
+				try:
+					item = get_item(timeout=timeout)
+					got_item = True
+				except Empty:
+					item = False
+					got_item = False
 
 				if item is None:
 					ending = True
-				else:
-					values.append(self._prepare_row(item))
-
-				if len(values) > 0 and (len(values) > rows_per_commit or ending is True or self.insert_queue.qsize() == 0):
-					composed = insert_format.format(
-						table,
-						SQL(",").join(columns),
-						SQL(",").join(values),
-					) + do_nothing
-					sql = composed.as_string(pg_connection)
-					log.debug("inserting %d rows", len(values))
-					cursor.execute(sql)
-					values.clear()
-					self.pre_commit()
-					pg_connection.commit()
-					self.post_commit()
+				elif item is not False:
+					if item[4]:
+						marks.append(item[4])
+					batch_offsets[item[3]] = item[2]
+					row = prepare_row(item)
+					rows.append(row)
+					policy.add(estimate_row_size(row) if count_bytes else 0)
+
+				reason = policy.flush_reason(row_queue.qsize() == 0, ending)
+
+				if reason:
+					spooling = time.monotonic() < next_attempt
+					if self._flush_batch(rows, marks, batch_offsets, reason, ending, convert, spooling):
+						backoff.reset()
+					elif not spooling:
+						next_attempt = time.monotonic() + backoff.next()
+					# spooled batches keep their marks and offsets
+					rows = []
+					marks = []
+					batch_offsets = {}
+					policy.reset()
 					time.sleep(self._options.wait_time)
 
-				row_queue.task_done()
+				if got_item:
+					row_queue.task_done()
 
 				if ending:
 					break
 
+			if spool:
+				while spool.pending and self._replay_spool(convert, wait=True):
+					pass
+
 		finally:
 			self.sql_thread_dead.set()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import json
+import logging
+import os
+import re
+import struct
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+log = logging.getLogger("fileshovel.pgtypes")
+
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_DATE = PG_EPOCH.date()
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+_type_modifier = re.compile(r"\([0-9, ]+\)")
+_true_values = frozenset(("t", "true", "y", "yes", "on", "1"))
+_false_values = frozenset(("f", "false", "n", "no", "off", "0"))
+
+
+def base_type(type_name: str) -> str:
+	"""Return the type without its modifier, 'timestamp(3) without time zone' becomes 'timestamp without time zone'."""
+	return _type_modifier.sub("", type_name)
+
+
+def parse_bool(value: str) -> bool:
+	value = value.lower()
+
+	if value in _true_values:
+		return True
+	elif value in _false_values:
+		return False
+	else:
+		raise ValueError("invalid boolean %r" % value)
+
+
+def get_converter(type_name: str, date_format: str) -> Callable[[Any], Any]:
+	"""Return a function converting a CSV field to the Python value of type_name, str for unknown types."""
+	type_name = base_type(type_name)
+
+	if type_name in ("smallint", "integer", "bigint"):
+		return int
+	elif type_name in ("real", "double precision"):
+		return float
+	elif type_name == "boolean":
+		return parse_bool
+	elif type_name == "uuid":
+		return UUID
+	elif type_name == "timestamp without time zone":
+		return lambda x: x if isinstance(x, datetime) else datetime.strptime(x, date_format)
+	elif type_name == "date":
+		return lambda x: x if isinstance(x, date) else datetime.strptime(x, "%Y-%m-%d").date()
+	else:
+		return str
+
+
+def _binary_struct(fmt: str) -> Callable[[Any], bytes]:
+	pack = struct.Struct("!i" + fmt).pack
+	size = struct.calcsize("!" + fmt)
+	return lambda x: pack(size, x)
+
+
+def _binary_text(encoding: str) -> Callable[[Any], bytes]:
+	pack_length = struct.Struct("!i").pack
+
+	def encode(value) -> bytes:
+		value = str(value).encode(encoding)
+		return pack_length(len(value)) + value
+
+	return encode
+
+
+_binary_encoders = {
+	"smallint": lambda: _binary_struct("h"),
+	"integer": lambda: _binary_struct("i"),
+	"bigint": lambda: _binary_struct("q"),
+	"real": lambda: _binary_struct("f"),
+	"double precision": lambda: _binary_struct("d"),
+	"boolean": lambda: _binary_struct("?"),
+	"uuid": lambda: (lambda x: b"\0\0\0\x10" + x.bytes),
+	"timestamp without time zone": lambda: (lambda x, e=_binary_struct("q"): e((x - PG_EPOCH) // ONE_MICROSECOND)),
+	"date": lambda: (lambda x, e=_binary_struct("i"): e((x - PG_EPOCH_DATE).days)),
+}
+
+
+def get_binary_encoder(type_name: str, encoding: str) -> Callable[[Any], bytes]:
+	"""Return a function encoding a converted value as a length prefixed COPY binary field."""
+	encoder = _binary_encoders.get(base_type(type_name))
+	return encoder() if encoder else _binary_text(encoding)
+
+
+def get_staging_type(type_name: str) -> str:
+	"""Type of the staging column receiving binary fields of type_name, text when fields are sent as text."""
+	type_name = base_type(type_name)
+	return type_name if type_name in _binary_encoders else "text"
+
+
+def load_column_types(filename: str, table: str) -> Optional[Dict[str, str]]:
+	"""Return the column types of table cached in filename."""
+	try:
+		with open(filename, "r") as types_file:
+			return json.load(types_file).get(table)
+	except FileNotFoundError:
+		return None
+	except (OSError, ValueError) as e:
+		log.warning("ignoring column types cache %s: %s", filename, e)
+		return None
+
+
+def save_column_types(filename: str, table: str, column_types: Dict[str, str]):
+	"""Cache the column types of table in filename, keeping the ones of other tables."""
+	try:
+		with open(filename, "r") as types_file:
+			tables = json.load(types_file)
+	except (OSError, ValueError):
+		tables = {}
+
+	tables[table] = column_types
+	temp_filename = filename + ".tmp"
+
+	try:
+		with open(temp_filename, "w") as types_file:
+			json.dump(tables, types_file, indent=1, sort_keys=True)
+		os.replace(temp_filename, filename)
+	except OSError as e:
+		log.warning("can't cache column types in %s: %s", filename, e)
+
+
+def convert_row(row: List, converters: List[Callable[[Any], Any]]) -> List:
+	return [None if x is None else c(x) for x, c in zip(row, converters)]
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import cProfile
+import json
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from fileshovel.metrics import metrics
+
+log = logging.getLogger("fileshovel.profiling")
+
+
+class StageTimer:
+
+	def __init__(self):
+		"""Seconds spent by each thread in each pipeline stage.
+
+		Stages nest, the time of a stage excludes the stages timed while it runs, like parse calling read.
+		"""
+		self.started = time.monotonic()
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._threads = {}
+
+	def _stack(self) -> list:
+		stack = getattr(self._local, "stack", None)
+
+		if stack is None:
+			stack = self._local.stack = []
+			self._local.seconds = Counter()
+			thread = threading.current_thread()
+			with self._lock:
+				self._threads["%s:%d" % (thread.name, thread.ident)] = self._local.seconds
+
+		return stack
+
+	def _enter(self) -> float:
+		self._stack().append(0.0)
+		return time.perf_counter()
+
+	def _leave(self, stage: str, started: float):
+		elapsed = time.perf_counter() - started
+		stack = self._local.stack
+		self._local.seconds[stage] += elapsed - stack.pop()
+		if stack:
+			stack[-1] += elapsed
+
+	def add(self, stage: str, seconds: float):
+		"""Add seconds measured outside of any other stage, like an awaited query."""
+		self._stack()
+		self._local.seconds[stage] += seconds
+
+	@contextmanager
+	def stage(self, stage: str):
+		started = self._enter()
+		try:
+			yield
+		finally:
+			self._leave(stage, started)
+
+	def wrap(self, function: Callable, stage: str) -> Callable:
+		"""Return function timing each of its calls as stage."""
+		enter = self._enter
+		leave = self._leave
+
+		def timed(*args, **kwargs):
+			started = enter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				leave(stage, started)
+
+		return timed
+
+	def timed(self, iterable: Iterable, stage: str) -> Iterator:
+		"""Iterate over iterable timing each step as stage."""
+		return iter(self.wrap(iter(iterable).__next__, stage), _END)
+
+	def seconds(self) -> Dict[str, Dict[str, float]]:
+		with self._lock:
+			return {k: dict(v) for k, v in self._threads.items()}
+
+	def write(self, output):
+		threads = self.seconds()
+		totals = Counter()
+
+		for seconds_by_stage in threads.values():
+			totals.update(seconds_by_stage)
+
+		json.dump({
+			"elapsed": round(time.monotonic() - self.started, 6),
+			"stages": {k: round(v, 6) for k, v in sorted(totals.items())},
+			"threads": {k: {s: round(x, 6) for s, x in sorted(v.items())} for k, v in threads.items()},
+		}, output, indent=1, sort_keys=True)
+		output.write("\n")
+
+	def collect(self):
+		"""Metrics collector of the seconds spent in each stage."""
+		totals = Counter()
+
+		for seconds_by_stage in self.seconds().values():
+			totals.update(seconds_by_stage)
+
+		for name, seconds in sorted(totals.items()):
+			yield "fileshovel_stage_seconds_total", {"stage": name}, seconds
+
+
+# StopIteration ends iter(callable, sentinel), the sentinel is never returned
+_END = object()
+
+# set while --profile-format=stages runs, the pipeline checks it once per thread or file instead of per row
+stage_timer: Optional[StageTimer] = None
+_no_stage = nullcontext()
+
+
+def stage(name: str):
+	"""Time a block as a pipeline stage when profiling stages, a no-op context manager otherwise."""
+	if stage_timer is None:
+		return _no_stage
+	return stage_timer.stage(name)
+
+
+def frame_name(frame) -> str:
+	code = frame.f_code
+	return "%s:%s" % (frame.f_globals.get("__name__", "?"), getattr(code, "co_qualname", code.co_name))
+
+
+class StackSampler(threading.Thread):
+
+	def __init__(self, interval: float):
+		"""Count the stacks of every thread each interval seconds, nothing runs in the sampled threads.
+
+		Other threads only release the GIL between some bytecodes, loops and calls get more samples than
+		the C functions they call.
+		"""
+		super().__init__(name="profiler", daemon=True)
+		self.interval = interval
+		self.stacks = Counter()
+		self.samples = 0
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			self.sample()
+
+	def stop(self):
+		self._stopped.set()
+		if self.is_alive():
+			self.join()
+
+	def sample(self):
+		names = {x.ident: x.name for x in threading.enumerate()}
+		frames = sys._current_frames()
+		own = threading.get_ident()
+
+		with self._lock:
+			self.samples += 1
+
+			for ident, frame in frames.items():
+				if ident == own:
+					continue
+
+				stack = []
+				while frame is not None:
+					stack.append(frame_name(frame))
+					frame = frame.f_back
+				stack.append(names.get(ident, str(ident)).replace(";", ":"))
+				self.stacks[";".join(reversed(stack))] += 1
+
+	def write(self, output):
+		"""Write one "thread;frame;frame count" line per stack, as read by flamegraph.pl and speedscope."""
+		with self._lock:
+			for stack, count in sorted(self.stacks.items()):
+				output.write("%s %d\n" % (stack, count))
+
+
+class _ProfileSnapshot:
+
+	def __init__(self, profile: cProfile.Profile):
+		"""Stats of a running profile, pstats would otherwise disable it from the wrong thread."""
+		profile.snapshot_stats()
+		self.stats = profile.stats
+
+	def create_stats(self):
+		pass
+
+
+class ThreadProfiles:
+
+	def __init__(self):
+		"""cProfile the calling thread and every thread started after it.
+
+		Python 3.12 and later run a single profiler for the whole process, the profile of the calling thread
+		then also sees the other threads.
+		"""
+		self.profiles = []
+		self._lock = threading.Lock()
+
+	def _profile_thread(self, *_):
+		# the first profiling event of a new thread replaces this hook with its own profile
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError as e:
+			# another profiler is active, only one profiler may run at a time since Python 3.12
+			sys.setprofile(None)
+			threading.setprofile(None)
+			with self._lock:
+				if self.profiles:
+					log.debug("profiling threads with the process-wide profiler: %s", e)
+					return
+			raise
+		with self._lock:
+			self.profiles.append(profile)
+
+	def start(self):
+		threading.setprofile(self._profile_thread)
+		self._profile_thread()
+
+	def stop(self):
+		threading.setprofile(None)
+		with self._lock:
+			self.profiles[0].disable()
+
+	def write(self, filename: str):
+		with self._lock:
+			profiles = list(self.profiles)
+
+		pstats.Stats(*(_ProfileSnapshot(x) for x in profiles)).dump_stats(filename)
+
+
+class Profiler:
+
+	def __init__(self, filename: str, profile_format: str = "stages", interval: float = 0.005):
+		"""Profile the pipeline until stopped, write filename on stop and on SIGUSR1."""
+		self.filename = filename
+		self.profile_format = profile_format
+		self.interval = interval
+		self.stage_timer = None
+		self.sampler = None
+		self.profiles = None
+		self._previous_handler = None
+		self._dump_lock = threading.Lock()
+
+	def start(self):
+		global stage_timer
+
+		if self.profile_format == "pstats":
+			self.profiles = ThreadProfiles()
+			self.profiles.start()
+		elif self.profile_format == "folded":
+			self.sampler = StackSampler(self.interval)
+			self.sampler.start()
+		else:
+			self.stage_timer = stage_timer = StageTimer()
+
+		if threading.current_thread() is threading.main_thread():
+			self._previous_handler = signal.signal(signal.SIGUSR1, self._dump_on_signal)
+
+		log.info("profiling to %s as %s, send SIGUSR1 to pid %d to write it", self.filename, self.profile_format,
+				os.getpid())
+
+	def _dump_on_signal(self, *_):
+		# the signal may interrupt a dump of the main thread
+		self.dump(blocking=False)
+
+	def dump(self, blocking=True):
+		if not self._dump_lock.acquire(blocking):
+			return
+
+		try:
+			temp_filename = self.filename + ".tmp"
+			if self.profiles:
+				self.profiles.write(temp_filename)
+			else:
+				with open(temp_filename, "w") as output:
+					(self.sampler or self.stage_timer).write(output)
+			os.replace(temp_filename, self.filename)
+			log.info("profile written to %s", self.filename)
+		except OSError as e:
+			log.warning("can't write profile to %s: %s", self.filename, e)
+		finally:
+			self._dump_lock.release()
+
+	def stop(self):
+		global stage_timer
+
+		if self.sampler:
+			self.sampler.stop()
+		if self.profiles:
+			self.profiles.stop()
+		if self.stage_timer is not None and stage_timer is self.stage_timer:
+			stage_timer = None
+		if self._previous_handler is not None:
+			signal.signal(signal.SIGUSR1, self._previous_handler)
+		self.dump()
+
+
+def start_profiler(options) -> Optional[Profiler]:
+	"""Start the profiler enabled by --profile, nothing is hooked into the pipeline otherwise."""
+	if not options.profile:
+		return None
+
+	profiler = Profiler(options.profile, options.profile_format, options.profile_interval)
+	profiler.start()
+
+	if profiler.stage_timer:
+		metrics.add_collector(profiler.stage_timer.collect)
+
+	return profiler
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import fcntl
+import json
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from threading import Lock
+from typing import List, Optional, Tuple
+
+log = logging.getLogger("fileshovel.spool")
+
+SEGMENT_SUFFIX = ".spool"
+SEGMENT_BYTES = 64 << 20
+
+
+def encode_batch(rows: List[list]) -> bytes:
+	return zlib.compress(json.dumps(rows, separators=(",", ":")).encode("ascii"), 1)
+
+
+def decode_batch(payload: bytes) -> List[list]:
+	return json.loads(zlib.decompress(payload))
+
+
+class Spool:
+	RECORD = struct.Struct("<II")
+
+	def __init__(self, directory: str, max_bytes: int = 0, batch_rows: int = 1000, segment_bytes: int = SEGMENT_BYTES):
+		"""Batches of prepared rows appended to segment files of directory and read back in order.
+
+		Each record is its length, its CRC32 and the batch as compressed JSON. Segments are deleted once read,
+		the ones left by a previous run are read first. Rows added one by one are grouped by batch_rows.
+		Only one process may use a directory at a time.
+		"""
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.batch_rows = batch_rows
+		self.segment_bytes = segment_bytes
+		self.replay_lock = Lock()
+		self._lock = Lock()
+		self._lock_file = open(os.path.join(directory, "lock"), "w")
+
+		try:
+			fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			self._lock_file.close()
+			raise RuntimeError("spool %s is used by another process" % directory)
+
+		self._segments = deque(sorted(
+			int(x[:-len(SEGMENT_SUFFIX)]) for x in os.listdir(directory)
+			if x.endswith(SEGMENT_SUFFIX) and x[:-len(SEGMENT_SUFFIX)].isdigit()
+		))
+		self._first_segment = self._segments[-1] + 1 if self._segments else 0
+		self._next_segment = self._first_segment
+		self._read_file = None
+		self._read_segment = None
+		self._write_file = None
+		self._contexts = deque()
+		self._peeked = None
+		self._tail = []
+		self._tail_context = None
+		self.batches = 0
+		self.bytes = 0
+
+		for segment in self._segments:
+			batches, size = self._scan_segment(segment)
+			self.batches += batches
+			self.bytes += size
+
+		if self.batches:
+			log.info("%d batches left in spool %s are inserted first", self.batches, directory)
+
+	def _segment_filename(self, segment: int) -> str:
+		return os.path.join(self.directory, "%016d%s" % (segment, SEGMENT_SUFFIX))
+
+	def _scan_segment(self, segment: int) -> Tuple[int, int]:
+		"""Count the records of a segment from their headers."""
+		batches = 0
+		size = 0
+
+		with open(self._segment_filename(segment), "rb") as segment_file:
+			while True:
+				header = segment_file.read(self.RECORD.size)
+				if len(header) < self.RECORD.size:
+					break
+				length, _ = self.RECORD.unpack(header)
+				segment_file.seek(length, os.SEEK_CUR)
+				batches += 1
+				size += self.RECORD.size + length
+
+		return batches, size
+
+	@property
+	def pending(self) -> bool:
+		"""Tell if there is a batch or added rows to read."""
+		return self.batches > 0 or self._peeked is not None or bool(self._tail)
+
+	def is_full(self) -> bool:
+		return 0 < self.max_bytes <= self.bytes
+
+	def _write(self, rows: List[list], context: object):
+		payload = encode_batch(rows)
+
+		if self._write_file is None or self._write_file.tell() >= self.segment_bytes:
+			if self._write_file:
+				self._write_file.close()
+			self._segments.append(self._next_segment)
+			self._write_file = open(self._segment_filename(self._next_segment), "ab")
+			self._next_segment += 1
+
+		self._write_file.write(self.RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+		# the reading handle must see the whole record
+		self._write_file.flush()
+		self._contexts.append(context)
+		self.batches += 1
+		self.bytes += self.RECORD.size + len(payload)
+
+	def append(self, rows: List[list], context: object = None) -> bool:
+		"""Write a batch at the end of the spool, returns False without writing it when the spool is full.
+
+		context is kept in memory and returned along with the batch, it is None for batches of a previous run.
+		"""
+		with self._lock:
+			if self.is_full():
+				return False
+			self._write(rows, context)
+			return True
+
+	def add(self, row: list, mark: Optional[list], csv_file: str, current_line_offset: int) -> bool:
+		"""Add a row to the batch being grouped, returns False when the spool is full.
+
+		The context of grouped rows is the list of their marks and the last offset of each file.
+		"""
+		with self._lock:
+			if self.is_full():
+				return False
+
+			if not self._tail:
+				self._tail_context = ([], {})
+
+			self._tail.append(row)
+			if mark:
+				self._tail_context[0].append(mark)
+			self._tail_context[1][csv_file] = current_line_offset
+
+			if len(self._tail) >= self.batch_rows:
+				self._write(self._tail, self._tail_context)
+				self._tail = []
+				self._tail_context = None
+
+			return True
+
+	def _read(self) -> Optional[Tuple[List[list], object, int]]:
+		"""Return the next record and its size, or None at the end of the last segment."""
+		while self._segments:
+			if self._read_file is None:
+				self._read_segment = self._segments[0]
+				self._read_file = open(self._segment_filename(self._read_segment), "rb")
+
+			position = self._read_file.tell()
+			header = self._read_file.read(self.RECORD.size)
+			record = None
+
+			if len(header) == self.RECORD.size:
+				length, crc = self.RECORD.unpack(header)
+				size = os.fstat(self._read_file.fileno()).st_size
+				payload = self._read_file.read(length) if position + self.RECORD.size + length <= size else b""
+				if len(payload) == length and zlib.crc32(payload) == crc:
+					record = payload
+				else:
+					log.warning("dropping the end of spool segment %s from offset %d, it is corrupted",
+							self._segment_filename(self._read_segment), position)
+
+			if record is not None:
+				context = self._contexts.popleft() if self._read_segment >= self._first_segment else None
+				return decode_batch(record), context, self.RECORD.size + length
+
+			if self._write_file and self._read_segment == self._segments[-1]:
+				if position < self._write_file.tell():
+					return None
+				# everything written is read, start over from an empty segment
+				self._write_file.close()
+				self._write_file = None
+
+			self._read_file.close()
+			self._read_file = None
+			self._segments.popleft()
+			os.remove(self._segment_filename(self._read_segment))
+
+		return None
+
+	def peek(self) -> Optional[Tuple[List[list], object]]:
+		"""Return the next batch and its context, the same one until it is removed.
+
+		Written batches come first, then the rows being grouped.
+		"""
+		with self._lock:
+			if self._peeked is None:
+				record = self._read() if self.batches else None
+
+				if record is None and not self._segments:
+					# everything written is read, counts of corrupted segments are wrong
+					self.batches = 0
+					self.bytes = 0
+
+				if record is None and self._tail:
+					record = self._tail, self._tail_context, 0
+					self._tail = []
+					self._tail_context = None
+					# removing it doesn't remove a written batch
+					self.batches += 1
+
+				self._peeked = record
+
+			return self._peeked[:2] if self._peeked else None
+
+	def remove(self):
+		"""Remove the batch returned by peek once it is inserted, segments are deleted once every batch is."""
+		with self._lock:
+			if self._peeked:
+				self.batches -= 1
+				self.bytes -= self._peeked[2]
+				self._peeked = None
+
+			if self.batches == 0:
+				self._remove_segments()
+
+	def _remove_segments(self):
+		for spool_file in (self._read_file, self._write_file):
+			if spool_file:
+				spool_file.close()
+
+		self._read_file = None
+		self._write_file = None
+
+		while self._segments:
+			os.remove(self._segment_filename(self._segments.popleft()))
+
+	def close(self):
+		"""Write the batch being grouped and release the directory."""
+		with self._lock:
+			if self._peeked and self._peeked[2] == 0:
+				self.batches -= 1
+				self._write(self._peeked[0], None)
+				self._peeked = None
+			if self._tail:
+				self._write(self._tail, None)
+				self._tail = []
+
+			for spool_file in (self._read_file, self._write_file):
+				if spool_file:
+					spool_file.close()
+
+			self._read_file = None
+			self._write_file = None
+			self._lock_file.close()
+
+		if self.batches:
+			log.warning("%d batches are left in spool %s, they will be inserted on the next start",
+					self.batches, self.directory)
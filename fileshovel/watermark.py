@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+from collections import deque
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+
+class OffsetWatermark:
+	"""Line, offset, inode and sequence of each file below which every dispatched row is committed.
+
+	Rows are marked in the order they are dispatched to the SQL threads, which commit them in any order.
+	The watermark of a file only moves past a row once it and every row dispatched before it are committed,
+	so offsets restarting after a rotation are handled like any other. The inode tells which file the offset
+	belongs to once the file has been rotated. The sequence numbers the rows of a file in dispatch order, it
+	orders checkpoints when offsets and inodes can't.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._pending = {}
+		self._committed = {}
+		self._sequences = {}
+
+	def resume(self, csv_file: str, sequence: int):
+		"""Number the rows of csv_file after sequence, the one of the checkpoint it resumes from."""
+		with self._lock:
+			self._sequences[csv_file] = max(sequence, self._sequences.get(csv_file, 0))
+
+	def dispatch(self, csv_file: str, current_line: int, current_line_offset: int, inode: int = None) -> list:
+		"""Mark a row sent to the SQL threads, the returned mark goes along with the row."""
+		with self._lock:
+			sequence = self._sequences[csv_file] = self._sequences.get(csv_file, 0) + 1
+			mark = [current_line, current_line_offset, False, csv_file, inode, sequence]
+
+			pending = self._pending.get(csv_file)
+			if pending is None:
+				pending = self._pending[csv_file] = deque()
+			pending.append(mark)
+
+		return mark
+
+	def peek(self, marks: List[list]) -> Dict[str, Tuple[int, int, Optional[int], int]]:
+		"""Return the watermark of the files of marks as it would be once they are committed.
+
+		Written in the same transaction as the rows of marks, it never covers a row which isn't committed.
+		"""
+		in_batch = {id(x) for x in marks}
+		watermarks = {}
+
+		with self._lock:
+			for csv_file in {x[3] for x in marks}:
+				last = None
+
+				for mark in self._pending[csv_file]:
+					if mark[2] or id(mark) in in_batch:
+						last = mark
+					else:
+						break
+
+				if last is not None:
+					watermarks[csv_file] = (last[0], last[1], last[4], last[5])
+
+		return watermarks
+
+	def commit(self, marks: List[list]):
+		"""Mark rows as committed and move the watermark of their files."""
+		with self._lock:
+			for mark in marks:
+				mark[2] = True
+
+			for csv_file in {x[3] for x in marks}:
+				pending = self._pending[csv_file]
+				while pending and pending[0][2]:
+					mark = pending.popleft()
+					self._committed[csv_file] = (mark[0], mark[1], mark[4], mark[5])
+
+	def get(self, csv_file: str) -> Optional[Tuple[int, int, Optional[int], int]]:
+		with self._lock:
+			return self._committed.get(csv_file)
+
+	def items(self) -> List[Tuple[str, Tuple[int, int, Optional[int], int]]]:
+		with self._lock:
+			return list(self._committed.items())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+from tempfile import mktemp
+from unittest import TestCase
+
+from fileshovel.backfill import count_lines, split_ranges
+
+
+class BackfillTest(TestCase):
+
+	def setUp(self):
+		self.csv_file_name = mktemp()
+		self.lines = [b"header\n"] + [b"%d,%s\n" % (x, b"x" * (x % 13)) for x in range(1000)]
+
+		with open(self.csv_file_name, "wb") as csv_file:
+			csv_file.writelines(self.lines)
+			csv_file.write(b"incomplete")
+
+	def tearDown(self):
+		os.remove(self.csv_file_name)
+
+	def _line_starts(self) -> set:
+		starts = set()
+		offset = 0
+		for line in self.lines:
+			starts.add(offset)
+			offset += len(line)
+		return starts
+
+	def test_wholeFile_splitRanges_rangesAreContiguousAndStartOnLines(self):
+		ranges = split_ranges(self.csv_file_name, 0, 8, min_size=100)
+		size = os.path.getsize(self.csv_file_name)
+
+		self.assertEqual(8, len(ranges))
+		self.assertEqual((0, size), (ranges[0][0], ranges[-1][1]))
+		for (_, end), (start, _) in zip(ranges, ranges[1:]):
+			self.assertEqual(end, start)
+			self.assertIn(start, self._line_starts())
+
+	def test_resumedFile_splitRanges_startsAfterLineAtOffset(self):
+		offset = len(self.lines[0]) + len(self.lines[1])
+		ranges = split_ranges(self.csv_file_name, offset, 4, min_size=100)
+		self.assertEqual(offset + len(self.lines[2]), ranges[0][0])
+
+	def test_smallFile_splitRanges_returnsOneRange(self):
+		self.assertEqual(1, len(split_ranges(self.csv_file_name, 0, 8)))
+
+	def test_ranges_countLines_addsUpToAllLines(self):
+		ranges = split_ranges(self.csv_file_name, 0, 8, min_size=100)
+		counts = [count_lines(self.csv_file_name, x, y, block_size=64) for x, y in ranges]
+		self.assertEqual(len(self.lines), sum(counts))
+
+	def test_quotedFieldsSpanningLines_splitRanges_neverSplitsThem(self):
+		records = [b"header\n"] + [b'%d,"note\n""%s""\nend"\n' % (x, b"x" * (x % 13)) for x in range(1000)]
+		with open(self.csv_file_name, "wb") as csv_file:
+			csv_file.writelines(records)
+		record_starts = {sum(len(x) for x in records[:i]) for i in range(len(records))}
+
+		ranges = split_ranges(self.csv_file_name, len(records[0]) + len(records[1]), 8, min_size=100)
+
+		self.assertEqual(8, len(ranges))
+		self.assertEqual(sum(len(x) for x in records[:3]), ranges[0][0])
+		for start, _ in ranges:
+			self.assertIn(start, record_starts)
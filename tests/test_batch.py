@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileshovel.batch import FlushPolicy, estimate_row_size
+
+
+class FlushPolicyTest(TestCase):
+
+	def test_emptyBatch_flushReason_returnsNone(self):
+		policy = FlushPolicy(10)
+		self.assertIsNone(policy.flush_reason(queue_empty=True, ending=True))
+		self.assertIsNone(policy.timeout())
+
+	def test_noDelay_queueEmpty_flushesIdleBatch(self):
+		policy = FlushPolicy(10)
+		policy.add()
+		self.assertIsNone(policy.flush_reason(queue_empty=False))
+		self.assertEqual("idle", policy.flush_reason(queue_empty=True))
+
+	def test_maxRows_reached_flushesOnRows(self):
+		policy = FlushPolicy(2, max_delay=60)
+		policy.add()
+		self.assertIsNone(policy.flush_reason(queue_empty=True))
+		policy.add()
+		self.assertEqual("rows", policy.flush_reason(queue_empty=True))
+
+	def test_maxBytes_reached_flushesOnBytes(self):
+		policy = FlushPolicy(10, max_bytes=100, max_delay=60)
+		policy.add(60)
+		self.assertIsNone(policy.flush_reason(queue_empty=False))
+		policy.add(60)
+		self.assertEqual("bytes", policy.flush_reason(queue_empty=False))
+
+	@patch("fileshovel.batch.time.monotonic")
+	def test_maxDelay_elapsed_flushesOnDelay(self, monotonic):
+		monotonic.return_value = 100.0
+		policy = FlushPolicy(10, max_delay=0.2)
+		policy.add()
+		monotonic.return_value = 100.15
+		self.assertAlmostEqual(0.05, policy.timeout())
+		self.assertIsNone(policy.flush_reason(queue_empty=True))
+		monotonic.return_value = 100.25
+		self.assertEqual(0.0, policy.timeout())
+		self.assertEqual("delay", policy.flush_reason(queue_empty=True))
+
+	def test_reset_afterFlush_startsNewBatch(self):
+		policy = FlushPolicy(1, max_bytes=10)
+		policy.add(20)
+		policy.reset()
+		self.assertEqual((0, 0), (policy.rows, policy.bytes))
+		self.assertIsNone(policy.flush_reason(queue_empty=True, ending=True))
+
+	def test_mixedRow_estimateRowSize_countsTextLengthAndSeparators(self):
+		self.assertEqual(3 + 8 + 4, estimate_row_size(["abc", 42, None, None]))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from fileshovel.benchmark import main
+
+
+class BenchmarkTest(TestCase):
+
+	def test_smallFile_runEveryStage_writesOneResultPerStage(self):
+		with tempfile.TemporaryDirectory() as directory:
+			output = os.path.join(directory, "results.jsonl")
+			main(["--rows", "200", "--repeat", "1", "--quoting", "minimal", "--output", output])
+
+			with open(output) as results_file:
+				results = [json.loads(x) for x in results_file]
+
+		self.assertEqual(["lineio", "csvreader", "prepare_row", "indexer"],
+				[x["benchmark"] for x in results])
+		self.assertTrue(all(x["rows"] == 200 for x in results))
+		self.assertTrue(all(x["rows_per_second"] > 0 for x in results))
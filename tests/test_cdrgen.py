@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import csv
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from fileshovel.cdrgen import CdrGenerator, cdr_columns, generate_cdr_file
+
+
+class CdrGeneratorTest(TestCase):
+
+	def _generate(self, rows: int, **kwargs) -> str:
+		output = io.StringIO()
+		CdrGenerator(kwargs.pop("seed", 0), kwargs.pop("extra_columns", 0)).write(output, rows, **kwargs)
+		return output.getvalue()
+
+	def test_sameSeed_write_returnsSameRows(self):
+		self.assertEqual(self._generate(50, seed=3), self._generate(50, seed=3))
+		self.assertNotEqual(self._generate(50, seed=3), self._generate(50, seed=4))
+
+	def test_extraColumns_write_everyRowHasHeaderWidth(self):
+		rows = list(csv.reader(io.StringIO(self._generate(100, extra_columns=5))))
+		self.assertEqual(cdr_columns(5), rows[0])
+		self.assertEqual(101, len(rows))
+		self.assertTrue(all(len(x) == 20 for x in rows))
+
+	def test_noQuoting_write_hasNoQuoteOrEmbeddedDelimiter(self):
+		data = self._generate(200, quoting="none")
+		self.assertNotIn('"', data)
+		self.assertTrue(all(x.count(",") == 14 for x in data.splitlines()))
+
+	def test_allQuoting_write_quotesEveryField(self):
+		line = self._generate(1, quoting="all").splitlines()[1]
+		self.assertTrue(line.startswith('"') and line.endswith('"'))
+
+	def test_size_generateCdrFile_reachesSize(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "Master.csv")
+			rows = generate_cdr_file(filename, size=50000)
+			self.assertGreaterEqual(os.path.getsize(filename), 50000)
+			with open(filename, newline="") as csv_file:
+				self.assertEqual(rows + 1, sum(1 for _ in csv.reader(csv_file)))
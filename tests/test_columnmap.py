@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import tempfile
+from unittest import TestCase
+
+from fileshovel.columnmap import ColumnMap
+
+csv_columns = ["uuid", "caller_id_number", "billsec", "hangup_cause"]
+a_row = ["a-uuid", " 5551234 ", "0", "NORMAL_CLEARING"]
+
+
+def item(line: list, current_line: int = 3, current_line_offset: int = 120, csv_file: str = "a.csv") -> tuple:
+	return line, current_line, current_line_offset, csv_file, None
+
+
+class ColumnMapTest(TestCase):
+
+	def test_everyColumn_fromColumns_keepsRowAndReplacesNullText(self):
+		transform = ColumnMap.from_columns(csv_columns, "0").compile(["current_line_offset"])
+		self.assertEqual(["a-uuid", " 5551234 ", None, "NORMAL_CLEARING", 120], transform(item(list(a_row))))
+
+	def test_renameDropReorderConstant_compile_returnsMappedValues(self):
+		column_map = ColumnMap.from_config({
+			"columns": [
+				{"name": "caller", "source": "caller_id_number", "trim": True},
+				"uuid",
+				{"name": "billsec", "null": ["0"]},
+				{"name": "site", "value": "montreal"},
+			],
+		}, csv_columns)
+		transform = column_map.compile(["current_line", "file_identity(csv_file)"], {"file_identity": str.upper})
+		self.assertEqual(["caller", "uuid", "billsec", "site"], column_map.names)
+		self.assertEqual(["5551234", "a-uuid", None, "montreal", 3, "A.CSV"], transform(item(list(a_row))))
+
+	def test_defaultNullAndTrim_fromConfig_appliesToEveryColumn(self):
+		column_map = ColumnMap.from_config({"null": ["", "0"], "trim": True, "columns": ["billsec", "caller_id_number"]},
+				csv_columns)
+		self.assertEqual([None, "5551234"], column_map.compile()(item(list(a_row))))
+
+	def test_shortRow_compile_raisesIndexError(self):
+		transform = ColumnMap.from_columns(csv_columns).compile(["current_line_offset"])
+		with self.assertRaisesRegex(IndexError, "Row has 2 columns while table has 5"):
+			transform(item(a_row[:2]))
+
+	def test_shortRowAddingMissingColumns_compile_returnsNoneForMissingFields(self):
+		transform = ColumnMap.from_columns(csv_columns, "").compile(add_missing_columns=True)
+		self.assertEqual(["a-uuid", " 5551234 ", None, None], transform(item(a_row[:2])))
+		self.assertEqual(list(a_row), transform(item(list(a_row))))
+
+	def test_unknownSource_fromConfig_raisesValueError(self):
+		with self.assertRaisesRegex(ValueError, "missing of caller is not a CSV column"):
+			ColumnMap.from_config({"columns": [{"name": "caller", "source": "missing"}]}, csv_columns)
+
+	def test_duplicateName_fromConfig_raisesValueError(self):
+		with self.assertRaisesRegex(ValueError, "columns uuid are mapped more than once"):
+			ColumnMap.from_config({"columns": ["uuid", {"name": "uuid", "value": "x"}]}, csv_columns)
+
+	def test_yamlFile_load_readsColumns(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "map.yaml")
+			with open(filename, "w") as map_file:
+				map_file.write("columns:\n  - hangup_cause\n  - {name: site, value: 12}\n")
+			column_map = ColumnMap.load(filename, csv_columns)
+		self.assertEqual(["NORMAL_CLEARING", "12"], column_map.compile()(item(list(a_row))))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import gzip
+import lzma
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from fileshovel import compressed
+from fileshovel.compressed import GzipSeekIndex, SEEK_INDEX_SUFFIX, count_seek_points, detect_compression
+from fileshovel.lineio import TellableLineIO
+
+try:
+	import indexed_gzip
+except ImportError:
+	indexed_gzip = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+default_encoding = "utf8"
+csv_lines = b"".join(b'"%d","caller-%d","NORMAL_CLEARING"\n' % (x, x) for x in range(2000))
+
+
+def compress_zstd(data: bytes) -> bytes:
+	return zstandard.ZstdCompressor().compress(data)
+
+
+class CompressedTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+	def _write(self, name: str, data: bytes) -> str:
+		filename = os.path.join(self.directory.name, name)
+		with open(filename, "wb") as output:
+			output.write(data)
+		return filename
+
+	def _read(self, filename: str, offset: int = 0, **kwargs) -> list:
+		lines = TellableLineIO(filename, "rb", default_encoding, **kwargs)
+		try:
+			if offset:
+				lines.seek(offset)
+			return [(x, lines.current_line_offset) for x in lines]
+		finally:
+			lines.close()
+
+	def _assert_reads_like_plain_file(self, filename: str):
+		plain_lines = self._read(self._write("plain.csv", csv_lines))
+		resume_offset = plain_lines[1500][1]
+
+		self.assertEqual(plain_lines, self._read(filename))
+		self.assertEqual(plain_lines[1501:], self._read(filename, resume_offset))
+
+	def test_magicBytes_detectCompression_returnsCompression(self):
+		self.assertEqual("gzip", detect_compression(gzip.compress(b"a")))
+		self.assertEqual("xz", detect_compression(lzma.compress(b"a")))
+		self.assertEqual("zstd", detect_compression(b"\x28\xb5\x2f\xfd\x00"))
+		self.assertIsNone(detect_compression(b'"1","a"\n'))
+
+	def test_gzipFile_readFromOffset_offsetsAreUncompressed(self):
+		self._assert_reads_like_plain_file(self._write("a.csv.1.gz", gzip.compress(csv_lines)))
+
+	def test_xzFile_readFromOffset_offsetsAreUncompressed(self):
+		self._assert_reads_like_plain_file(self._write("a.csv.1.xz", lzma.compress(csv_lines)))
+
+	@skipUnless(zstandard, "zstandard is not installed")
+	def test_zstdFile_readFromOffset_offsetsAreUncompressed(self):
+		self._assert_reads_like_plain_file(self._write("a.csv.1.zst", compress_zstd(csv_lines)))
+
+	@skipUnless(zstandard, "zstandard is not installed")
+	def test_zstdFile_seekBackward_restartsStream(self):
+		with compressed.open_file(self._write("a.csv.1.zst", compress_zstd(csv_lines))) as zstd_file:
+			zstd_file.seek(1000)
+			zstd_file.read(100)
+			zstd_file.seek(10)
+			self.assertEqual(csv_lines[10:20], zstd_file.read(10))
+
+	def test_compressedFile_watch_readsOnce(self):
+		lines = TellableLineIO(self._write("a.csv.1.gz", gzip.compress(csv_lines)), "rb", default_encoding,
+				watch=True, use_inotify=True)
+		self.assertFalse(lines.watch)
+		self.assertEqual(2000, len(list(lines)))
+		lines.close()
+
+	def test_compressedSibling_resumePastEndOfNewFile_resumesFromRotatedFile(self):
+		rotated_file = self._write("a.csv.1.gz", gzip.compress(csv_lines))
+		filename = self._write("a.csv", b"new\n")
+		offset = csv_lines.index(b'"1999"') - 1
+
+		lines = self._read(filename, offset, rotated_glob=filename + ".*")
+
+		self.assertEqual([('"1999","caller-1999","NORMAL_CLEARING"\n', offset + 1), ("new\n", 0)], lines)
+
+	@skipUnless(indexed_gzip, "indexed_gzip is not installed")
+	@patch("fileshovel.compressed.SEEK_POINT_SPACING", 1 << 16)
+	def test_gzipFile_close_savesSeekPointsReusedOnOpen(self):
+		filename = self._write("a.csv.1.gz", gzip.compress(csv_lines * 20))
+		self._read(filename)
+		self.assertTrue(os.path.isfile(filename + SEEK_INDEX_SUFFIX))
+
+		seek_index = GzipSeekIndex(filename)
+		with seek_index.open() as gzip_file:
+			self.assertGreater(seek_index.points, 1)
+			self.assertEqual(seek_index.points, count_seek_points(gzip_file))
+			gzip_file.seek(len(csv_lines) * 19)
+			self.assertEqual(csv_lines[:100], gzip_file.read(100))
+
+	@skipUnless(indexed_gzip, "indexed_gzip is not installed")
+	def test_staleSeekIndex_open_ignoresIt(self):
+		filename = self._write("a.csv.1.gz", gzip.compress(csv_lines))
+		index_file = self._write("a.csv.1.gz" + SEEK_INDEX_SUFFIX, b"garbage")
+		os.utime(index_file, (0, 0))
+
+		seek_index = GzipSeekIndex(filename)
+		with seek_index.open() as gzip_file:
+			self.assertEqual(0, seek_index.points)
+			self.assertEqual(csv_lines, gzip_file.read())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import csv
+import io
+import os
+from tempfile import mktemp
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from fileshovel.csvreader import CsvReader
+from fileshovel.lineio import TellableLineIO
+
+a_filename = "/nonexistent/file.csv"
+default_encoding = "utf8"
+mixed_lines = b"".join([
+	b"a,b,c\n",
+	b'"a","b","c"\r\n',
+	b'"a",,"c"\n',
+	b'"say ""hi""","b","c"\n',
+	b'"multi\nline","b","c"\n',
+	b'"a,b",c,""\n',
+	b"\n",
+	b'"","",""\n',
+])
+
+
+class CsvReaderTest(TestCase):
+
+	def _read(self, data: bytes, **kwargs) -> list:
+		mock_file = MagicMock()
+		mock_file.return_value = io.BytesIO(initial_bytes=data)
+
+		with patch("builtins.open", mock_file):
+			reader = CsvReader(TellableLineIO(a_filename, "rb", default_encoding), **kwargs)
+			return list(reader)
+
+	def test_mixedQuoting_readRows_sameRowsAsCsvModule(self):
+		expected = list(csv.reader(io.StringIO(mixed_lines.decode(default_encoding), newline="")))
+		rows = self._read(mixed_lines, delimiter=",")
+		self.assertEqual(expected, [x for x, _, _ in rows])
+
+	def test_multiLineField_readRows_offsetIsLastLineOfRow(self):
+		rows = self._read(b'"a","b"\n"multi\nline","c"\nd,e\n', delimiter=",")
+		self.assertEqual([0, 15, 25], [x for _, _, x in rows])
+
+	def test_quotedRecordFollowedByPlainLines_readRows_onlyParsesQuotedRecordWithCsvModule(self):
+		mock_file = MagicMock()
+		mock_file.return_value = io.BytesIO(initial_bytes=b'a,b\n"multi\nline","c"\nd,e\nf,g\n')
+
+		with patch("builtins.open", mock_file):
+			reader = CsvReader(TellableLineIO(a_filename, "rb", default_encoding), delimiter=",")
+			rows = [x for x, _, _ in reader]
+
+		self.assertEqual([["a", "b"], ["multi\nline", "c"], ["d", "e"], ["f", "g"]], rows)
+		self.assertEqual(2, reader.reader.line_num)
+
+	def test_selectColumns_readRows_returnsOnlySelectedColumns(self):
+		rows = self._read(b'a,b,c\n"d","e","f"\n"g,h",i,j\nk\n', delimiter=",", select_columns=[2, 0])
+		self.assertEqual([["c", "a"], ["f", "d"], ["j", "g,h"], ["k"]], [x for x, _, _ in rows])
+
+	def test_columnFiltersOnUnselectedColumn_readRows_dropsRowsBeforeSelecting(self):
+		rows = self._read(b"a,1,x,y\nb,2,z,w\nc,1,x,v\n", delimiter=",", select_columns=[0],
+				column_filters=[(1, "1", True), (3, "v", False)])
+		self.assertEqual([(["a"], 1, 0)], rows)
+
+	def test_otherDialect_readRows_usesCsvModuleOnly(self):
+		rows = self._read(rb"a;b\;c" + b"\n", delimiter=";", escapechar="\\")
+		self.assertEqual([["a", "b;c"]], [x for x, _, _ in rows])
+
+	def test_nonblockingFile_multiLineFieldSplitByEndOfFile_yieldsNoneThenWholeRow(self):
+		test_file_name = mktemp()
+
+		try:
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b'a,b\n"multi\n')
+			reader = CsvReader(TellableLineIO(test_file_name, "rb", default_encoding, watch=True, nonblocking=True),
+					delimiter=",")
+			rows = iter(reader)
+			self.assertEqual((["a", "b"], 1, 0), next(rows))
+			self.assertIsNone(next(rows))
+			with open(test_file_name, "ab") as test_file:
+				test_file.write(b'line",c\nd,e\n')
+			self.assertEqual((["multi\nline", "c"], 3, 11), next(rows))
+			self.assertEqual((["d", "e"], 4, 19), next(rows))
+			self.assertIsNone(next(rows))
+
+		finally:
+			os.remove(test_file_name)
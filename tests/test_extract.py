@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+from datetime import datetime
+from tempfile import mktemp
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileshovel import extract
+from fileshovel.extract import extract_rows, find_extract_span
+from fileshovel.indexer import CsvIndex, CsvIndexer
+from fileshovel.options import FileShovelOptions
+
+
+class FindExtractSpanTest(TestCase):
+
+	def setUp(self):
+		self.index = CsvIndex(["start_stamp"], 0, "%Y-%m-%d %H:%M:%S")
+
+		for day in range(1, 11):
+			self.index.add_index(day, day * 100, datetime(2020, 1, day))
+
+	def test_rangeInsideIndex_findSpan_includesNeighbourEntries(self):
+		self.assertEqual((300, 700), find_extract_span(self.index, datetime(2020, 1, 4), datetime(2020, 1, 6)))
+
+	def test_rangeBetweenSampledEntries_findSpan_returnsSurroundingEntries(self):
+		span = find_extract_span(self.index, datetime(2020, 1, 4, 1), datetime(2020, 1, 4, 2))
+		self.assertEqual((400, 500), span)
+
+	def test_rangeAfterLastEntry_findSpan_readsUntilEndOfFile(self):
+		self.assertEqual((1000, None), find_extract_span(self.index, datetime(2020, 1, 10, 1), datetime(2020, 2, 1)))
+
+	def test_rangeBeforeFirstEntry_findSpan_returnsNone(self):
+		self.assertIsNone(find_extract_span(self.index, datetime(2019, 1, 1), datetime(2019, 2, 1)))
+
+
+class ExtractRowsTest(TestCase):
+
+	def setUp(self):
+		self.csv_file_name = mktemp()
+
+		with open(self.csv_file_name, "w") as csv_file:
+			csv_file.write("start_stamp,caller\n")
+			for day in range(1, 11):
+				csv_file.write("2020-01-%02d 00:00:00,55500%02d\n" % (day, day))
+
+		self.arguments = ["-w", "no", self.csv_file_name]
+
+	def tearDown(self):
+		for filename in (self.csv_file_name, self.csv_file_name + ".index", self.csv_file_name + ".index.log"):
+			if os.path.isfile(filename):
+				os.remove(filename)
+
+	def test_indexedFile_extractRows_keepsLineNumbersOfFile(self):
+		options = FileShovelOptions(self.arguments)
+		indexer = CsvIndexer(options)
+
+		try:
+			rows = list(extract_rows(options, datetime(2020, 1, 5), datetime(2020, 1, 6), indexer))
+		finally:
+			indexer.close()
+
+		self.assertEqual([(["2020-01-05 00:00:00", "5550005"], 5), (["2020-01-06 00:00:00", "5550006"], 6)],
+				[(x[0], x[1]) for x in rows])
+
+	def test_sampledIndex_extractRows_returnsEveryRowInRange(self):
+		options = FileShovelOptions(["--csv-index-every-nth-line", "2"] + self.arguments)
+		indexer = CsvIndexer(options)
+
+		try:
+			self.assertEqual(5, len(indexer.index))
+			rows = list(extract_rows(options, datetime(2020, 1, 5), datetime(2020, 1, 7), indexer))
+		finally:
+			indexer.close()
+
+		self.assertEqual([5, 6, 7], [x[1] for x in rows])
+
+	def test_noIndex_main_leavesIndexFilesAlone(self):
+		with patch("sys.stdout"):
+			extract.main(["--from", "2020-01-02 00:00:00", "--to", "2020-01-02 00:00:00"] + self.arguments)
+
+		self.assertFalse(os.path.exists(self.csv_file_name + ".index"))
+		self.assertFalse(os.path.exists(self.csv_file_name + ".index.log"))
+
+	def test_pgsqlOutput_main_doesNotWriteCheckpoints(self):
+		CsvIndexer(FileShovelOptions(self.arguments)).close()
+
+		with patch("fileshovel.pgsql.PgLineInserter") as inserter:
+			extract.main(["--from", "2020-01-02 00:00:00", "--to", "2020-01-02 00:00:00", "--output", "pgsql"] +
+					self.arguments)
+
+		self.assertEqual({"write_checkpoints": False}, inserter.call_args[1])
+		inserter.return_value.add_row.assert_called_once_with(["2020-01-02 00:00:00", "5550002"], 2, 47)
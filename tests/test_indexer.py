@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+from datetime import datetime
+from tempfile import mktemp
+from unittest import TestCase
+from unittest.mock import patch
+from uuid import UUID
+
+from fileshovel.indexer import CsvIndex, CsvIndexer, CsvUuidIndex
+from fileshovel.options import FileShovelOptions
+
+columns = ["start_stamp", "uuid"]
+date_format = "%Y-%m-%d %H:%M:%S"
+
+
+def a_uuid(n: int) -> UUID:
+	return UUID(int=n + 1)
+
+
+class CsvIndexTest(TestCase):
+
+	def setUp(self):
+		self.index_file_name = mktemp()
+		self.index = CsvIndex(columns, 0, date_format)
+
+		for line, day in enumerate([3, 1, 2, 5, 4]):
+			self.index.add_index(line, line * 10, datetime(2020, 1, day), a_uuid(line))
+
+	def tearDown(self):
+		self.index.close()
+		if os.path.isfile(self.index_file_name):
+			os.remove(self.index_file_name)
+
+	def _save_and_load(self) -> CsvIndex:
+		self.index.save(self.index_file_name)
+		self.index = CsvIndex.load(self.index_file_name)
+		return self.index
+
+	def test_unsortedEntries_saveAndLoad_entriesSortedByDate(self):
+		index = self._save_and_load()
+		dates = [x.date.day for x in index.find_range()]
+		self.assertEqual([1, 2, 3, 4, 5], dates)
+		self.assertEqual(5, len(index))
+
+	def test_savedIndex_findExactDate_returnsOffset(self):
+		index = self._save_and_load()
+		entry = index.find_offset_from_datetime(datetime(2020, 1, 2))
+		self.assertEqual((2, 20), (entry.line, entry.offset))
+		with self.assertRaises(KeyError):
+			index.find_offset_from_datetime(datetime(2020, 1, 2, 1))
+
+	def test_savedIndex_findNearestDate_returnsClosestEntry(self):
+		index = self._save_and_load()
+		self.assertEqual(2, index.find_offset_from_datetime(datetime(2020, 1, 2, 11), exact=False).date.day)
+		self.assertEqual(3, index.find_offset_from_datetime(datetime(2020, 1, 2, 13), exact=False).date.day)
+		self.assertEqual(5, index.find_offset_from_datetime(datetime(2021, 1, 1), exact=False).date.day)
+
+	def test_savedIndex_findRange_returnsEntriesInRange(self):
+		index = self._save_and_load()
+		offsets = [x.offset for x in index.find_range(datetime(2020, 1, 2), datetime(2020, 1, 4))]
+		self.assertEqual([20, 0, 40], offsets)
+
+	def test_savedIndex_findUuid_returnsEntry(self):
+		index = self._save_and_load()
+		self.assertEqual(30, index.find_offset_from_uuid(a_uuid(3)).offset)
+		with self.assertRaises(KeyError):
+			index.find_offset_from_uuid(a_uuid(42))
+
+	def test_loadedIndex_addEntry_keepsExistingEntries(self):
+		index = self._save_and_load()
+		index.add_index(5, 50, datetime(2020, 1, 1, 12))
+		dates = [(x.date.day, x.uuid) for x in index.find_range(end=datetime(2020, 1, 2))]
+		self.assertEqual([(1, a_uuid(1)), (1, None), (2, a_uuid(2))], dates)
+
+	def test_manyUuids_buildHashIndex_findsEveryUuid(self):
+		for line in range(5, 200):
+			self.index.add_index(line, line * 10, datetime(2020, 2, 1), a_uuid(line))
+		self.index.add_index(200, 2000, datetime(2020, 2, 2))
+		index = self._save_and_load()
+
+		CsvUuidIndex.build(self.index_file_name + ".uuid", index)
+		uuid_index = CsvUuidIndex.load(self.index_file_name + ".uuid")
+
+		try:
+			self.assertEqual(2000, uuid_index.resume_offset)
+			for line in range(200):
+				self.assertEqual((line, line * 10), uuid_index.find(a_uuid(line)))
+			self.assertIsNone(uuid_index.find(a_uuid(4242)))
+		finally:
+			uuid_index.close()
+			os.remove(self.index_file_name + ".uuid")
+
+	def test_notAnIndexFile_load_raisesValueError(self):
+		with open(self.index_file_name, "wb") as index_file:
+			index_file.write(b"\0" * 64)
+
+		with self.assertRaises(ValueError):
+			CsvIndex.load(self.index_file_name)
+
+
+class CsvIndexerTest(TestCase):
+
+	def setUp(self):
+		self.csv_file_name = mktemp()
+		self._append_rows(0, 3, header=True)
+
+		with patch("sys.argv", ["fileshovel", "-w", "no", "--uuid-column", "uuid", self.csv_file_name]):
+			self.options = FileShovelOptions()
+
+	def tearDown(self):
+		for filename in (self.csv_file_name, self.csv_file_name + ".index", self.csv_file_name + ".index.log",
+				self.csv_file_name + ".index.uuid"):
+			if os.path.isfile(filename):
+				os.remove(filename)
+
+	def _append_rows(self, first: int, last: int, header=False):
+		with open(self.csv_file_name, "a") as csv_file:
+			if header:
+				csv_file.write("start_stamp,uuid\n")
+			for n in range(first, last):
+				csv_file.write("2020-01-%02d 00:00:00,%s\n" % (n + 1, a_uuid(n)))
+
+	def test_indexedFile_appendRowsAndUpdate_indexesOnlyNewRows(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 5)
+		indexer = CsvIndexer(self.options)
+
+		try:
+			self.assertEqual(5, len(indexer.index))
+			self.assertEqual(a_uuid(4), indexer.index.find_offset_from_datetime(datetime(2020, 1, 5)).uuid)
+		finally:
+			indexer.close()
+
+	def test_indexedFile_appendRowsAndUpdate_numbersNewRowsAfterIndexedOnes(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 5)
+		indexer = CsvIndexer(self.options)
+
+		try:
+			self.assertEqual(5, indexer.find_offset_from_uuid(a_uuid(4))[0])
+			self.assertEqual(5, indexer.index.resume_line)
+		finally:
+			indexer.close()
+
+		self._append_rows(5, 8)
+		indexer = CsvIndexer(self.options)
+
+		try:
+			self.assertEqual(8, indexer.find_offset_from_uuid(a_uuid(7))[0])
+		finally:
+			indexer.close()
+
+	def test_indexedFile_getLineAt_countsFromLastIndexedRow(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 5)
+		indexer = CsvIndexer(self.options, build=False)
+
+		try:
+			_, second_offset = indexer.find_offset_from_uuid(a_uuid(1))
+			with open(self.csv_file_name, "rb") as csv_file:
+				fifth_offset = csv_file.read().index(str(a_uuid(4)).encode()) - len("2020-01-05 00:00:00,")
+
+			self.assertEqual(0, indexer.get_line_at(0))
+			self.assertEqual(2, indexer.get_line_at(second_offset))
+			self.assertEqual(5, indexer.get_line_at(fifth_offset))
+		finally:
+			indexer.close()
+
+	def test_followedFile_addRowsThenCrashMidRecord_logIsReplayed(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 30)
+		indexer = CsvIndexer(self.options, build=False)
+		indexer.add_row(["2020-01-04 00:00:00", str(a_uuid(3))], 4, 1000)
+		indexer.add_row(["2020-01-05 00:00:00", str(a_uuid(4))], 5, 1100)
+		indexer.index_log.flush()
+		indexer.index_log.close()
+
+		with open(indexer.index_log.filename, "ab") as index_log:
+			index_log.write(b"\0" * 10)
+
+		indexer = CsvIndexer(self.options, build=False)
+
+		try:
+			self.assertEqual(5, len(indexer.index))
+			self.assertEqual(1100, indexer.index.resume_offset)
+			self.assertEqual(1000, indexer.index.find_offset_from_uuid(a_uuid(3)).offset)
+			self.assertIsNone(indexer.add_row(["2020-01-05 00:00:00", str(a_uuid(4))], 5, 1100))
+		finally:
+			indexer.close()
+
+		self.assertFalse(os.path.isfile(indexer.index_log.filename))
+		index = CsvIndex.load(self.options.index_file)
+		self.assertEqual(5, len(index))
+		index.close()
+
+	def test_followerWritingLog_openReadOnly_findsLoggedRowsWithoutTouchingFiles(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 30)
+		follower = CsvIndexer(self.options, build=False)
+		follower.add_row(["2020-01-04 00:00:00", str(a_uuid(3))], 4, 1000)
+		follower.index_log.flush()
+		with open(follower.index_log.filename, "ab") as index_log:
+			index_log.write(b"\0" * 10)
+
+		files = {}
+		for filename in (self.options.index_file, follower.index_log.filename):
+			with open(filename, "rb") as index_file:
+				files[filename] = index_file.read()
+
+		indexer = CsvIndexer(self.options, build=False, read_only=True)
+		try:
+			self.assertEqual((4, 1000), indexer.find_offset_from_uuid(a_uuid(3)))
+		finally:
+			indexer.close()
+			follower.index_log.close()
+
+		for filename, data in files.items():
+			with open(filename, "rb") as index_file:
+				self.assertEqual(data, index_file.read())
+
+	def test_indexedFile_lookupUuid_returnsRawRow(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 4)
+		indexer = CsvIndexer(self.options, build=False)
+
+		try:
+			indexer.update()
+			self.assertIsNotNone(indexer.uuid_index)
+			line, offset = indexer.find_offset_from_uuid(a_uuid(1))
+			self.assertEqual(b"2020-01-02 00:00:00,%s\n" % str(a_uuid(1)).encode(), indexer.read_row(offset))
+			line, offset = indexer.find_offset_from_uuid(a_uuid(3))
+			self.assertEqual(str(a_uuid(3)).encode(), indexer.read_row(offset).split(b",")[1].strip())
+			with self.assertRaises(KeyError):
+				indexer.find_offset_from_uuid(a_uuid(42))
+		finally:
+			indexer.close()
+
+	def test_loadedIndex_saveNewRows_extendsUuidIndexInPlace(self):
+		CsvIndexer(self.options).close()
+		self._append_rows(3, 5)
+
+		with patch.object(CsvUuidIndex, "build", wraps=CsvUuidIndex.build) as build:
+			indexer = CsvIndexer(self.options)
+			try:
+				indexer.save()
+				self.assertEqual(5, len(indexer.uuid_index))
+				self.assertEqual(indexer.index.resume_offset, indexer.uuid_index.resume_offset)
+				self.assertEqual(5, indexer.uuid_index.find(a_uuid(4))[0])
+			finally:
+				indexer.close()
+
+		build.assert_not_called()
+
+	def _rotate(self, first: int, last: int):
+		os.rename(self.csv_file_name, self.csv_file_name + ".1")
+		self._append_rows(first, last, header=True)
+
+	def test_followedFileRotated_followRow_startsNewIndexAndKeepsOldOneForRotatedFile(self):
+		with patch("sys.argv", ["fileshovel", "-w", "no", "--uuid-column", "uuid", "--csv-rotated-suffix", ".*",
+				self.csv_file_name]):
+			options = FileShovelOptions()
+		CsvIndexer(options).close()
+		old_inode = os.stat(self.csv_file_name).st_ino
+		self._rotate(3, 5)
+		new_inode = os.stat(self.csv_file_name).st_ino
+		indexer = CsvIndexer(options, build=False)
+
+		try:
+			# the reader resumed in the rotated file, its rows belong to the old index
+			self.assertIsNone(indexer.follow_row(["2020-01-03 00:00:00", str(a_uuid(2))], 1, 90, old_inode))
+			with open(self.csv_file_name, "rb") as csv_file:
+				offset = csv_file.read().index(b"2020-01-05")
+			entry = indexer.follow_row(["2020-01-05 00:00:00", str(a_uuid(4))], 3, offset, new_inode)
+
+			self.assertEqual((2, offset), (entry.line, entry.offset))
+			self.assertEqual(new_inode, indexer.index.inode)
+			with self.assertRaises(KeyError):
+				indexer.find_offset_from_uuid(a_uuid(1))
+		finally:
+			indexer.close()
+
+		rotated_index = CsvIndex.load(self.csv_file_name + ".1.index")
+		try:
+			self.assertEqual(old_inode, rotated_index.inode)
+			self.assertEqual(3, len(rotated_index))
+		finally:
+			rotated_index.close()
+			for suffix in (".1", ".1.index", ".1.index.uuid"):
+				os.remove(self.csv_file_name + suffix)
+
+	def test_indexOfReplacedFile_open_startsNewIndex(self):
+		CsvIndexer(self.options).close()
+		self._rotate(3, 4)
+		indexer = CsvIndexer(self.options)
+
+		try:
+			self.assertEqual(1, len(indexer.index))
+			self.assertEqual(1, indexer.find_offset_from_uuid(a_uuid(3))[0])
+		finally:
+			indexer.close()
+			os.remove(self.csv_file_name + ".1")
+
+	def test_followedFileTruncated_followRow_indexesItAgain(self):
+		CsvIndexer(self.options).close()
+		inode = os.stat(self.csv_file_name).st_ino
+		indexer = CsvIndexer(self.options, build=False)
+
+		try:
+			self._append_rows(3, 4)
+			with open(self.csv_file_name, "rb") as csv_file:
+				offset = csv_file.read().index(b"2020-01-04")
+			self.assertEqual(4, indexer.follow_row(["2020-01-04 00:00:00", str(a_uuid(3))], 1, offset, inode).line)
+
+			with open(self.csv_file_name, "w") as csv_file:
+				csv_file.write("start_stamp,uuid\n2020-02-01 00:00:00,%s\n" % a_uuid(9))
+			entry = indexer.follow_row(["2020-02-01 00:00:00", str(a_uuid(9))], 2, 17, inode)
+
+			self.assertEqual((1, 17), (entry.line, entry.offset))
+			self.assertEqual(1, len(indexer.index))
+		finally:
+			indexer.close()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import io
+import os
+from tempfile import mktemp
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from fileshovel.linefilter import compile_line_filter, compile_rewrite_rules, compile_row_filter, \
+		required_substrings
+from fileshovel.lineio import TellableLineIO
+from fileshovel.options import FileShovelOptions
+
+a_filename = "/nonexistent/file.csv"
+cdr_lines = b"".join([
+	b'"1001","default","NORMAL_CLEARING"\n',
+	b'"1002","public","NO_ANSWER"\n',
+	b'"1003","default","USER_BUSY"\n',
+	b'"1004","default","NORMAL_CLEARING"\n',
+])
+
+
+class LineFilterTest(TestCase):
+
+	def _read(self, data: bytes, **kwargs) -> list:
+		mock_file = MagicMock()
+		mock_file.return_value = io.BytesIO(initial_bytes=data)
+
+		with patch("builtins.open", mock_file):
+			lines = TellableLineIO(a_filename, "rb", "utf8", **kwargs)
+			result = [(x, lines.current_line, lines.current_line_offset) for x in lines]
+			return result, lines.lines_filtered
+
+	def test_noCondition_compileLineFilter_returnsNone(self):
+		self.assertIsNone(compile_line_filter())
+
+	def test_singleInclude_compileLineFilter_returnsRegexSearch(self):
+		line_filter = compile_line_filter([b"NORMAL_CLEARING", b"USER_BUSY"])
+		self.assertEqual([True, False, True, True], [bool(line_filter(x)) for x in cdr_lines.splitlines()])
+
+	def test_includeExcludeRequired_compileLineFilter_keepsLinesMatchingAll(self):
+		line_filter = compile_line_filter([b"default"], [b"USER_BUSY"], [b'"1004"'])
+		self.assertEqual([False, False, False, True], [line_filter(x) for x in cdr_lines.splitlines()])
+
+	def test_filteredLines_iterate_keepsOffsetsAndLineNumbers(self):
+		lines, filtered = self._read(cdr_lines, line_filter=compile_line_filter([b"NORMAL_CLEARING"]))
+		self.assertEqual([1, 4], [x[1] for x in lines])
+		self.assertEqual([0, cdr_lines.rindex(b'"1004"')], [x[2] for x in lines])
+		self.assertEqual(2, filtered)
+
+	def test_columnFilters_compileRowFilter_comparesFields(self):
+		row_filter = compile_row_filter([(1, "default", True), (2, "USER_BUSY", False), (5, "x", False)])
+		self.assertTrue(row_filter(["1001", "default", "NORMAL_CLEARING"]))
+		self.assertFalse(row_filter(["1003", "default", "USER_BUSY"]))
+		self.assertFalse(row_filter(["1002", "public", "NO_ANSWER"]))
+
+	def test_escapableValues_requiredSubstrings_onlyKeepsPlainEqualValues(self):
+		column_filters = [(0, "default", True), (1, "a,b", True), (2, 'say "hi"', True), (3, "x", False), (4, "", True)]
+		self.assertEqual([b"default"], required_substrings(column_filters, "utf8", ","))
+
+	def test_singleRule_compileRewriteRules_returnsRegexAndTemplate(self):
+		search, replace = compile_rewrite_rules([(b"(a)", b"<\\1>")])
+		self.assertEqual(b"<a>bc", search.sub(replace, b"abc"))
+
+	def test_manyRules_compileRewriteRules_appliesEachRuleWithItsGroups(self):
+		search, replace = compile_rewrite_rules([
+			(b"(\\d+)-(\\d+)", b"\\2-\\1"),
+			(b"((N)O)_ANSWER", b"\\g<1>\\2"),
+			(b"public", b"external"),
+			(b"\\d", b"#"),
+		])
+		self.assertEqual(b'"34-12","external","NON"', search.sub(replace, b'"12-34","public","NO_ANSWER"'))
+		self.assertEqual(b'"#",\\#', search.sub(replace, b'"5",\\1'))
+
+	def test_rewriteRules_iterate_rewritesBeforeDecoding(self):
+		search, replace = compile_rewrite_rules([(b"public", b"external"), (b"NO_ANSWER", b"MISSED")])
+		lines, _ = self._read(cdr_lines, regex_search=search, regex_replace=replace)
+		self.assertEqual('"1002","external","MISSED"\n', lines[1][0])
+
+	def test_rewriteRulesAndColumnFilter_readRows_filtersRewrittenValues(self):
+		test_file_name = mktemp()
+
+		try:
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"id,context,cause\n" + cdr_lines)
+			options = FileShovelOptions(["-w", "no", "--csv-rewrite", "NO_ANSWER", "MISSED",
+					"--csv-column-filter", "cause=MISSED", test_file_name])
+
+			rows = [x for x, _, _ in options.get_csv_file_reader(csv_file=test_file_name, watch=False)]
+
+			self.assertEqual([["1002", "public", "MISSED"]], rows)
+		finally:
+			os.remove(test_file_name)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 # vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import asyncio
 import io
 import os
 import threading
@@ -7,7 +8,7 @@ from tempfile import mktemp
 from unittest import TestCase
 from unittest.mock import patch, mock_open, MagicMock, Mock
 
-from fileshovel.lineio import TellableLineIO
+from fileshovel.lineio import AsyncFileWatcher, TellableLineIO, SharedFileWatcher
 
 a_filename = "/nonexistent/file.txt"
 default_encoding = "utf8"
@@ -237,3 +238,182 @@ class TellableLineIOTest(TestCase):
 
 		self.assertEqual(line_count, 3)
 		mock_file.assert_called_once()
+
+	def test_twoFilesSharingWatcher_appendToSecondFile_secondFileReadsNewLine(self):
+		def append_to_test_file(filename):
+			with open(filename, "ab") as f:
+				f.write(b"second\n")
+				f.flush()
+
+		test_file_names = []
+
+		try:
+			for content in (b"first\n", b"first\n"):
+				test_file_names.append(mktemp())
+				with open(test_file_names[-1], "wb") as test_file:
+					test_file.write(content)
+
+			file_watcher = SharedFileWatcher()
+			t1, t2 = (TellableLineIO(x, "rb", default_encoding, watch=True, use_inotify=True, file_watcher=file_watcher)
+					for x in test_file_names)
+			self.assertEqual("first\n", next(iter(t1)))
+			lines = iter(t2)
+			self.assertEqual("first\n", next(lines))
+			threading.Timer(0.2, append_to_test_file, (test_file_names[1],)).start()
+			self.assertEqual("second\n", next(lines))
+			self.assertEqual(2, len(file_watcher._watches))
+
+		finally:
+			for test_file_name in test_file_names:
+				if os.path.isfile(test_file_name):
+					os.remove(test_file_name)
+
+	def test_twoLinesFileUsingInotify_rotateAndAppendToRotatedFile_drainsRotatedFileFirst(self):
+		def rotate_test_file(filename):
+			os.rename(filename, filename + ".1")
+			with open(filename + ".1", "ab") as f:
+				f.write(b"789\n")
+			with open(filename, "wb") as f:
+				f.write(b"abc\n")
+
+		test_file_name = None
+		lines = []
+
+		try:
+			test_file_name = mktemp()
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"123\n456\n")
+			threading.Timer(0.2, rotate_test_file, (test_file_name,)).start()
+			t = TellableLineIO(test_file_name, "rb", default_encoding, watch=True, use_inotify=True)
+
+			for line in t:
+				lines.append((line, t.current_line_offset))
+				if len(lines) == 4:
+					break
+
+			self.assertEqual([("123\n", 0), ("456\n", 4), ("789\n", 8), ("abc\n", 0)], lines)
+
+		finally:
+			for filename in (test_file_name, test_file_name + ".1"):
+				if filename and os.path.isfile(filename):
+					os.remove(filename)
+
+	def test_rotatedFileLongerThanOffset_seekPastEnd_resumesFromRotatedFile(self):
+		test_file_name = None
+
+		try:
+			test_file_name = mktemp()
+			with open(test_file_name + ".1", "wb") as test_file:
+				test_file.write(b"123\n456\n789\n")
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"ab\n")
+
+			t = TellableLineIO(test_file_name, "rb", default_encoding, rotated_glob=test_file_name + ".*")
+			t.seek(4)
+			self.assertEqual(["789\n", "ab\n"], list(t))
+
+		finally:
+			for filename in (test_file_name, test_file_name + ".1"):
+				if filename and os.path.isfile(filename):
+					os.remove(filename)
+
+	def test_newFileLongerThanOffset_seekWithRotatedInode_drainsRotatedFilesInOrder(self):
+		test_file_name = mktemp()
+		contents = [(".2", b"123\n456\n789\n"), (".1", b"xyz\n"), ("", b"abcdefgh\nijk\n")]
+
+		try:
+			for i, (suffix, data) in enumerate(contents):
+				with open(test_file_name + suffix, "wb") as test_file:
+					test_file.write(data)
+				os.utime(test_file_name + suffix, (1000 + i, 1000 + i))
+			inode = os.stat(test_file_name + ".2").st_ino
+
+			t = TellableLineIO(test_file_name, "rb", default_encoding, rotated_glob=test_file_name + ".*")
+			self.assertEqual(4, t.seek(4, inode=inode))
+			self.assertEqual(["789\n", "xyz\n", "abcdefgh\n", "ijk\n"], list(t))
+
+		finally:
+			for suffix, _ in contents:
+				if os.path.isfile(test_file_name + suffix):
+					os.remove(test_file_name + suffix)
+
+	def test_inodeOfRemovedFile_seek_readsFromStart(self):
+		test_file_name = mktemp()
+
+		try:
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"abcdefgh\nijk\n")
+			t = TellableLineIO(test_file_name, "rb", default_encoding, rotated_glob=test_file_name + ".*")
+
+			with self.assertLogs("fileshovel.lineio", "WARNING"):
+				self.assertEqual(0, t.seek(4, inode=t.inode + 1))
+			self.assertEqual(["abcdefgh\n", "ijk\n"], list(t))
+
+		finally:
+			os.remove(test_file_name)
+
+	@patch("fileshovel.lineio.ROTATED_FILE_TIMEOUT", 0.1)
+	def test_fileNeverRecreated_drainRotatedFile_givesUp(self):
+		test_file_name = mktemp()
+
+		try:
+			with open(test_file_name + ".1", "wb") as test_file:
+				test_file.write(b"123\n456\n789\n")
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"ab\n")
+			t = TellableLineIO(test_file_name, "rb", default_encoding, rotated_glob=test_file_name + ".*")
+			t.seek(4, inode=os.stat(test_file_name + ".1").st_ino)
+			os.remove(test_file_name)
+
+			with self.assertLogs("fileshovel.lineio", "WARNING"):
+				self.assertEqual(["789\n"], list(t))
+
+		finally:
+			for filename in (test_file_name, test_file_name + ".1"):
+				if os.path.isfile(filename):
+					os.remove(filename)
+
+	def test_nonblockingFile_rotateAtEndOfFile_yieldsNoneThenReadsNewFile(self):
+		test_file_name = None
+
+		try:
+			test_file_name = mktemp()
+
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"123\n")
+			t = TellableLineIO(test_file_name, "rb", default_encoding, watch=True, nonblocking=True)
+			lines = iter(t)
+			self.assertEqual("123\n", next(lines))
+			self.assertIsNone(next(lines))
+			with open(test_file_name, "ab") as test_file:
+				test_file.write(b"456\n")
+			self.assertEqual("456\n", next(lines))
+			self.assertIsNone(next(lines))
+			os.rename(test_file_name, test_file_name + ".1")
+			with open(test_file_name, "wb") as test_file:
+				test_file.write(b"abc\n")
+			self.assertEqual(("abc\n", 0), (next(lines), t.current_line_offset))
+
+		finally:
+			for filename in (test_file_name, test_file_name + ".1"):
+				if filename and os.path.isfile(filename):
+					os.remove(filename)
+
+	def test_asyncWatcher_appendToFile_setsItsEvent(self):
+		test_file_name = mktemp()
+
+		async def wait_for_append():
+			watcher = AsyncFileWatcher(asyncio.get_running_loop())
+			try:
+				changed = watcher.add_watch(test_file_name)
+				with open(test_file_name, "ab") as test_file:
+					test_file.write(b"123\n")
+				await asyncio.wait_for(changed.wait(), 5)
+			finally:
+				watcher.close()
+
+		try:
+			asyncio.run(wait_for_append())
+		finally:
+			if os.path.isfile(test_file_name):
+				os.remove(test_file_name)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from fileshovel.metrics import Metrics, reader_collector
+
+
+class MetricsTest(TestCase):
+
+	def test_counterWithLabels_render_returnsTypedSample(self):
+		metrics = Metrics()
+		metrics.inc("fileshovel_batches_total", reason="rows")
+		metrics.inc("fileshovel_batches_total", 2, reason="rows")
+		text = metrics.render()
+		self.assertIn("# TYPE fileshovel_batches_total counter\n", text)
+		self.assertIn('fileshovel_batches_total{reason="rows"} 3\n', text)
+
+	def test_histogram_render_returnsCumulativeBuckets(self):
+		metrics = Metrics()
+		for value in (0.5, 2, 20):
+			metrics.observe("fileshovel_commit_seconds", value, (1, 10))
+		lines = metrics.render().splitlines()
+		self.assertIn('fileshovel_commit_seconds_bucket{le="1.0"} 1', lines)
+		self.assertIn('fileshovel_commit_seconds_bucket{le="10.0"} 2', lines)
+		self.assertIn('fileshovel_commit_seconds_bucket{le="+Inf"} 3', lines)
+		self.assertIn("fileshovel_commit_seconds_sum 22.5", lines)
+		self.assertIn("fileshovel_commit_seconds_count 3", lines)
+
+	def test_failingCollector_render_keepsOtherSamples(self):
+		metrics = Metrics()
+		metrics.add_collector(lambda: [("fileshovel_queue_rows", {}, 4)])
+		metrics.add_collector(lambda: 1 / 0)
+		self.assertIn("fileshovel_queue_rows 4\n", metrics.render())
+
+	def test_readerBehindCommittedRows_readerCollector_returnsLag(self):
+		with tempfile.NamedTemporaryFile() as csv_file:
+			csv_file.write(b"a,b\n" * 10)
+			csv_file.flush()
+			reader = MagicMock(line_num=7)
+			reader.csv_file.bytes_read = 40
+			reader.csv_file.current_line_offset = 36
+			samples = {x: y for x, _, y in reader_collector(csv_file.name, reader, {csv_file.name: 12})()}
+
+		self.assertEqual(7, samples["fileshovel_lines_read_total"])
+		self.assertEqual(40, samples["fileshovel_file_size_bytes"])
+		self.assertEqual(28, samples["fileshovel_lag_bytes"])
+
+	def test_missingFile_readerCollector_returnsOnlyReadProgress(self):
+		reader = MagicMock(line_num=1, rows_filtered=0)
+		reader.csv_file.bytes_read = 4
+		reader.csv_file.lines_filtered = 0
+		reader.csv_file.current_line_offset = 0
+		collector = reader_collector(os.path.join(tempfile.gettempdir(), "nonexistent.csv"), reader, {})
+		self.assertEqual(5, len(list(collector())))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileshovel.options import FileShovelOptions
+
+
+class FileShovelOptionsTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+	def _write(self, name: str, data: bytes) -> str:
+		filename = os.path.join(self.directory.name, name)
+		with open(filename, "wb") as csv_file:
+			csv_file.write(data)
+		return filename
+
+	def _options(self, *arguments) -> FileShovelOptions:
+		return FileShovelOptions(["-w", "no", "--pg-csv-file-column", "csv_file"] + list(arguments))
+
+	def test_filesWithSameHeader_init_keepsHeaderOfFirstFile(self):
+		self._write("a.csv", b"uuid,caller\na-uuid,5551234\n")
+		self._write("b.csv", b"uuid,caller\nb-uuid,5554321\n")
+		self._write("c.csv", b"")
+
+		options = self._options(os.path.join(self.directory.name, "*.csv"))
+
+		self.assertEqual(3, len(options.csv_files))
+		self.assertEqual(["uuid", "caller"], options.columns)
+
+	def test_filesWithOtherHeader_init_raisesValueError(self):
+		first = self._write("a.csv", b"uuid,caller\na-uuid,5551234\n")
+		second = self._write("b.csv", b"uuid,callee,caller\nb-uuid,5550000,5554321\n")
+
+		with self.assertRaisesRegex(ValueError, "header of .*b.csv differs"):
+			self._options(first, second)
+
+	def test_columnsWithoutHeader_init_doesNotCheckFirstRows(self):
+		first = self._write("a.csv", b"a-uuid,5551234\n")
+		second = self._write("b.csv", b"b-uuid,5554321\n")
+
+		options = self._options("--columns", "uuid,caller", first, second)
+
+		self.assertEqual(["uuid", "caller"], options.columns)
+
+	def test_watchDelay_getCsvFile_pollsAtThatDelay(self):
+		csv_file = self._write("a.csv", b"uuid,caller\na-uuid,5551234\n")
+		options = FileShovelOptions(["-w", "5", csv_file])
+
+		reader = options.get_csv_file()
+		reader.close()
+
+		self.assertEqual(5, options.poll_interval)
+		self.assertEqual(5, reader.watch)
+
+	def test_regexSearchWithoutReplace_init_exitsWithError(self):
+		csv_file = self._write("a.csv", b"uuid,caller\na-uuid,5551234\n")
+
+		with patch("sys.stderr"), self.assertRaises(SystemExit):
+			self._options("--csv-regex-search", "a-", csv_file)
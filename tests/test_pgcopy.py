@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import struct
+from unittest import TestCase
+
+from fileshovel.pgcopy import encode_copy_text, encode_copy_binary, COPY_BINARY_HEADER, COPY_BINARY_TRAILER
+
+default_encoding = "utf8"
+
+
+class PgCopyTest(TestCase):
+
+	def test_twoRows_encodeText_returnsTabSeparatedLines(self):
+		payload = encode_copy_text([["a", "b", 1], ["c", None, 2]], default_encoding)
+		self.assertEqual(b"a\tb\t1\nc\t\\N\t2\n", payload)
+
+	def test_specialCharacters_encodeText_escapesThem(self):
+		payload = encode_copy_text([["back\\slash", "tab\there", "new\nline\r"]], default_encoding)
+		self.assertEqual(b"back\\\\slash\ttab\\there\tnew\\nline\\r\n", payload)
+
+	def test_noRows_encodeText_returnsEmptyPayload(self):
+		self.assertEqual(b"", encode_copy_text([], default_encoding).strip())
+
+	def test_oneRow_encodeBinary_returnsFramedFields(self):
+		payload = encode_copy_binary([["é", None]], default_encoding)
+		expected = COPY_BINARY_HEADER + \
+				struct.pack("!h", 2) + \
+				struct.pack("!i", 2) + "é".encode(default_encoding) + \
+				struct.pack("!i", -1) + \
+				COPY_BINARY_TRAILER
+		self.assertEqual(expected, payload)
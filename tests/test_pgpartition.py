@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from psycopg2.sql import Identifier
+
+from fileshovel import pgpartition
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgpartition import Partition, PartitionRouter, is_sortable_format, missing_periods, \
+	next_period, parse_range_bounds, period_start
+from fileshovel.pgsql import PgLineInserter
+
+
+def month_partition(year: int, month: int) -> Partition:
+	lower = datetime(year, month, 1)
+	name = "public.cdr_%s" % lower.strftime("%Y%m")
+	return Partition(name, Identifier("public", name[7:]), lower, next_period(lower, "month"))
+
+
+january = month_partition(2026, 1)
+february = month_partition(2026, 2)
+
+
+class PgPartitionTest(TestCase):
+
+	def test_boundExpressions_parseRangeBounds_returnsNaiveDatetimes(self):
+		self.assertEqual((datetime(2026, 1, 1), datetime(2026, 2, 1)), parse_range_bounds(
+			"FOR VALUES FROM ('2026-01-01 00:00:00') TO ('2026-02-01 00:00:00')"))
+		self.assertEqual((None, datetime(2026, 1, 1, 5)), parse_range_bounds(
+			"FOR VALUES FROM (MINVALUE) TO ('2026-01-01 05:00:00+00')"))
+		self.assertEqual((datetime(2026, 1, 1), None), parse_range_bounds("FOR VALUES FROM ('2026-01-01') TO (MAXVALUE)"))
+		self.assertIsNone(parse_range_bounds("DEFAULT"))
+		with self.assertRaises(ValueError):
+			parse_range_bounds("FOR VALUES IN ('montreal')")
+
+	def test_dateFormats_isSortableFormat_acceptsMostSignificantFieldsFirst(self):
+		self.assertTrue(is_sortable_format("%Y-%m-%d %H:%M:%S"))
+		self.assertTrue(is_sortable_format("%Y%m%dT%H%M%S.%f"))
+		self.assertFalse(is_sortable_format("%d/%m/%Y %H:%M:%S"))
+		self.assertFalse(is_sortable_format("%b %d %Y"))
+
+	def test_periods_nextPeriod_wrapsAroundYear(self):
+		self.assertEqual(datetime(2027, 1, 1), next_period(period_start(datetime(2026, 12, 31, 23), "month"), "month"))
+		self.assertEqual(datetime(2026, 3, 1), next_period(datetime(2026, 2, 28), "day"))
+		self.assertEqual(datetime(2027, 1, 1), next_period(period_start(datetime(2026, 6, 5), "year"), "year"))
+
+	def test_existingPartitions_missingPeriods_returnsUncoveredOnes(self):
+		self.assertEqual(
+			[(datetime(2026, 3, 1), datetime(2026, 4, 1))],
+			missing_periods([january, february], "month", 3, datetime(2026, 1, 15)),
+		)
+
+	def test_rows_route_groupsThemByPartition(self):
+		router = PartitionRouter(1, "%Y-%m-%d %H:%M:%S", lambda: [february, january])
+		rows = [
+			["a", "2026-01-31 23:59:59"],
+			["b", "2026-02-01 00:00:00"],
+			["c", "2026-01-01 00:00:00"],
+			["d", None],
+			["e", "2025-12-31 23:59:59"],
+			["f", "2026-02-03 10:00:00.250"],
+		]
+
+		groups = router.route(rows)
+
+		self.assertEqual([
+			(january, [rows[0], rows[2]]),
+			(february, [rows[1], rows[5]]),
+			(None, [rows[3], rows[4]]),
+		], groups)
+
+	def test_unsortableFormat_route_parsesDates(self):
+		router = PartitionRouter(0, "%d/%m/%Y %H:%M", lambda: [january, february])
+		rows = [["15/02/2026 10:00"], ["31/01/2026 23:59"], ["not a date"]]
+
+		self.assertEqual([(february, rows[:1]), (january, rows[1:2]), (None, rows[2:])], router.route(rows))
+
+	@patch.object(pgpartition, "MISS_REFRESH_SECONDS", 0.0)
+	def test_rowOfNewPartition_route_reloadsPartitions(self):
+		load = MagicMock(side_effect=[[january], [january, february]])
+		router = PartitionRouter(0, "%Y-%m-%d %H:%M:%S", load)
+		rows = [["2026-02-01 10:00:00"], ["2026-01-01 10:00:00"]]
+
+		self.assertEqual([(january, rows[1:]), (february, rows[:1])], router.route(rows))
+		self.assertEqual(2, load.call_count)
+
+
+class PgLineInserterPartitionTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.csv_file = os.path.join(self.directory.name, "a.csv")
+
+		with open(self.csv_file, "w") as csv_file:
+			csv_file.write("uuid,start_stamp\na-uuid,2026-01-05 10:00:00\n")
+
+	def _inserter(self, *arguments, partitions=None) -> PgLineInserter:
+		options = FileShovelOptions([
+			"--pg-table", "cdr",
+			"--pg-csv-offset-column", "csv_offset",
+			"--pg-threads", "0",
+			"--pg-partition-routing",
+			"--watch", "no",
+		] + list(arguments) + [self.csv_file])
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()), \
+				patch.object(PgLineInserter, "_read_partition_key", return_value="start_stamp"), \
+				patch.object(PgLineInserter, "_read_partitions", side_effect=partitions or [[january, february]]):
+			return PgLineInserter(options)
+
+	def test_dateColumn_routeRows_groupsPreparedRowsByPartition(self):
+		inserter = self._inserter("--date-column", "start_stamp")
+		rows = [inserter._prepare_row(inserter.make_item(x, i, i * 10)) for i, x in enumerate([
+			["a-uuid", "2026-02-05 10:00:00"],
+			["b-uuid", "2026-01-05 10:00:00"],
+		])]
+
+		self.assertEqual([(february, rows[:1]), (january, rows[1:])], inserter._route_rows(rows))
+
+	def test_dateColumnNotPartitionKey_init_raisesValueError(self):
+		with self.assertRaisesRegex(ValueError, "partition key"):
+			self._inserter("--date-column", "uuid")
+
+	def test_createPartitions_init_createsMissingPeriods(self):
+		current = period_start(datetime.now(), "month")
+		existing = Partition("public.cdr_current", Identifier("public", "cdr_current"), current,
+				next_period(current, "month"))
+
+		with patch.object(PgLineInserter, "_create_partition") as create_partition:
+			inserter = self._inserter("--date-column", "start_stamp", "--pg-create-partitions", "3",
+					partitions=[[existing], [existing]])
+
+		following = next_period(current, "month")
+		self.assertEqual([
+			(following, next_period(following, "month")),
+			(next_period(following, "month"), next_period(next_period(following, "month"), "month")),
+		], [x[0][1:] for x in create_partition.call_args_list])
+		self.assertEqual((existing,), inserter.router.partitions)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import asyncio
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+from psycopg2.sql import Composed
+
+from fileshovel.aioengine import AsyncPgLineInserter
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgpool import Backoff, SessionPool, is_retryable
+from fileshovel.pgsql import CHECKPOINT_FORWARD, PgLineInserter
+from fileshovel.watermark import OffsetWatermark
+
+
+def server_error(error_class, pgcode: str):
+	error = MagicMock(spec=error_class)
+	error.pgcode = pgcode
+	return error
+
+
+def new_session(closed=0):
+	session = MagicMock()
+	session.connection.closed = closed
+	return session
+
+
+class PgPoolTest(TestCase):
+
+	def test_errors_isRetryable_retriesConnectionAndTransientErrorsOnly(self):
+		self.assertTrue(is_retryable(psycopg2.OperationalError("server closed the connection unexpectedly")))
+		self.assertTrue(is_retryable(psycopg2.InterfaceError("connection already closed")))
+		self.assertTrue(is_retryable(server_error(psycopg2.errors.SerializationFailure, "40001")))
+		self.assertTrue(is_retryable(server_error(psycopg2.errors.AdminShutdown, "57P01")))
+		self.assertTrue(is_retryable(server_error(psycopg2.errors.ReadOnlySqlTransaction, "25006")))
+		self.assertFalse(is_retryable(server_error(psycopg2.errors.UndefinedTable, "42P01")))
+		self.assertFalse(is_retryable(server_error(psycopg2.errors.InvalidTextRepresentation, "22P02")))
+		self.assertFalse(is_retryable(psycopg2.ProgrammingError("syntax error")))
+		self.assertFalse(is_retryable(ValueError("not a database error")))
+
+	def test_attempts_next_doublesUpToMaximumUntilReset(self):
+		backoff = Backoff(0.5, 3.0, jitter=0)
+		self.assertEqual([0.5, 1.0, 2.0, 3.0, 3.0], [backoff.next() for _ in range(5)])
+		backoff.reset()
+		self.assertEqual(0.5, backoff.next())
+
+	def test_jitter_next_shortensDelay(self):
+		delays = [Backoff(1.0, 1.0).next() for _ in range(100)]
+		self.assertTrue(all(0.5 <= x <= 1.0 for x in delays))
+
+	def test_sessionGivenBack_get_reusesItUnlessClosed(self):
+		connect = MagicMock(side_effect=lambda: new_session())
+		pool = SessionPool(connect, 1, 30.0)
+		session = pool.get()
+		pool.put(session)
+		self.assertIs(session, pool.get())
+
+		session.connection.closed = 1
+		pool.put(session)
+		self.assertIsNot(session, pool.get())
+		self.assertEqual(2, connect.call_count)
+
+	def test_idleSessionFailingHealthCheck_get_connectsAgain(self):
+		pool = SessionPool(new_session, 1, 0.0)
+		session = pool.get()
+		pool.put(session)
+		session.connection.cursor.return_value.execute.side_effect = psycopg2.OperationalError("gone")
+
+		self.assertIsNot(session, pool.get())
+		session.close.assert_called_once_with()
+
+	def test_moreSessionsThanSize_put_closesExtraOnes(self):
+		pool = SessionPool(new_session, 1, 30.0)
+		sessions = [pool.get(), pool.get()]
+		for session in sessions:
+			pool.put(session)
+
+		sessions[1].close.assert_called_once_with()
+		self.assertIs(sessions[0], pool.get())
+
+	def test_retryableError_discard_closesIdleSessions(self):
+		pool = SessionPool(new_session, 2, 30.0)
+		failed, idle = pool.get(), pool.get()
+		pool.put(idle)
+
+		pool.discard(failed, psycopg2.OperationalError("server closed the connection unexpectedly"))
+
+		failed.close.assert_called_once_with()
+		idle.close.assert_called_once_with()
+		self.assertIsNot(idle, pool.get())
+
+
+class PgLineInserterRetryTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.csv_file = os.path.join(self.directory.name, "a.csv")
+
+		with open(self.csv_file, "w") as csv_file:
+			csv_file.write("uuid,caller\na-uuid,5551234\n")
+
+		self.arguments = [
+			"--pg-table", "cdr",
+			"--pg-csv-offset-column", "csv_offset",
+			"--pg-threads", "0",
+			"--pg-retry-delay", "0",
+			"--watch", "no",
+		]
+
+	def _insert(self, send_batch, *arguments) -> PgLineInserter:
+		options = FileShovelOptions(self.arguments + list(arguments) + [self.csv_file])
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()), \
+				patch.object(PgLineInserter, "_send_batch", side_effect=send_batch):
+			inserter = PgLineInserter(options)
+			inserter.add_row(["a-uuid", "5551234"], 1, 11)
+			inserter.done()
+
+		return inserter
+
+	def test_connectionLost_done_retriesBatchOnNewSession(self):
+		sessions = []
+
+		def send_batch(session, rows, marks, ending, convert):
+			sessions.append(session)
+			if len(sessions) < 3:
+				raise psycopg2.OperationalError("server closed the connection unexpectedly")
+			return 0.0, 0.0, True
+
+		with self.assertLogs("fileshovel.pgsql", "WARNING") as logs:
+			inserter = self._insert(send_batch)
+
+		self.assertEqual(3, len(sessions))
+		self.assertEqual(3, len(set(map(id, sessions))))
+		self.assertEqual(2, len(logs.records))
+		self.assertEqual({None: 11}, inserter.committed_offsets)
+
+	def test_fatalError_done_raisesWithoutRetry(self):
+		send_batch = MagicMock(side_effect=psycopg2.ProgrammingError("column \"caller\" does not exist"))
+
+		with self.assertRaises(psycopg2.ProgrammingError):
+			self._insert(send_batch)
+
+		self.assertEqual(1, send_batch.call_count)
+
+	def test_retryTimeout_done_givesUp(self):
+		send_batch = MagicMock(side_effect=psycopg2.OperationalError("could not connect to server"))
+
+		with self.assertRaises(psycopg2.OperationalError), self.assertLogs("fileshovel.pgsql", "ERROR"):
+			self._insert(send_batch, "--pg-retry-timeout", "0.05")
+
+		self.assertGreater(send_batch.call_count, 1)
+
+	def test_connectionLost_asyncInsertRows_sendsBatchAgainOnNewConnection(self):
+		options = FileShovelOptions(self.arguments + ["--engine", "asyncio", self.csv_file])
+		connections = []
+		batches = []
+
+		async def connect():
+			pg_connection = MagicMock(closed=0)
+			pg_connection.close.side_effect = lambda: setattr(pg_connection, "closed", 1)
+			connections.append(pg_connection)
+			return pg_connection
+
+		async def execute(pg_connection, sql):
+			batches.append(pg_connection)
+			if len(batches) < 3:
+				raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+		async def insert():
+			row_queue = asyncio.Queue()
+			await row_queue.put(inserter.make_item(["a-uuid", "5551234"], 1, 11, self.csv_file))
+			await row_queue.put(None)
+			await inserter.insert_rows(row_queue)
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()):
+			inserter = AsyncPgLineInserter(options)
+
+		with patch.object(inserter, "connect_database_async", side_effect=connect), \
+				patch.object(inserter, "execute", side_effect=execute), \
+				patch.object(Composed, "as_string", return_value="BEGIN;INSERT;COMMIT"), \
+				self.assertLogs("fileshovel.aioengine", "WARNING") as logs:
+			asyncio.run(insert())
+
+		self.assertEqual(3, len(connections))
+		self.assertEqual(connections, batches)
+		self.assertEqual(2, len(logs.records))
+		self.assertEqual({self.csv_file: 11}, inserter.committed_offsets)
+
+	def _write_checkpoints_in_order(self, *checkpoints: dict) -> tuple:
+		"""Upsert checkpoints in the given order with the guard of the checkpoint table, return the stored row."""
+		options = FileShovelOptions(self.arguments + ["--pg-checkpoint-table", "checkpoints", self.csv_file])
+		cursor = MagicMock()
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()), \
+				patch.object(PgLineInserter, "create_checkpoint_table", MagicMock()):
+			inserter = PgLineInserter(options)
+		for x in checkpoints:
+			inserter._write_checkpoints(cursor, x)
+
+		table = sqlite3.connect(":memory:")
+		self.addCleanup(table.close)
+		table.execute("CREATE TABLE checkpoints (server_name text, csv_file text, csv_offset bigint, csv_line bigint, "
+				"csv_inode bigint, csv_sequence bigint, PRIMARY KEY (server_name, csv_file))")
+		for call in cursor.execute.call_args_list:
+			table.execute(
+				"INSERT INTO checkpoints VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (server_name, csv_file) DO UPDATE SET "
+				"csv_offset = EXCLUDED.csv_offset, csv_line = EXCLUDED.csv_line, csv_inode = EXCLUDED.csv_inode, "
+				"csv_sequence = EXCLUDED.csv_sequence " + CHECKPOINT_FORWARD.format("checkpoints"),
+				call[0][1],
+			)
+
+		return table.execute("SELECT csv_line, csv_offset, csv_inode FROM checkpoints").fetchone()
+
+	def test_lateBatchOfRotatedFile_writeCheckpoints_keepsCheckpointOfNewFile(self):
+		watermark = OffsetWatermark()
+		old_file = [watermark.dispatch(self.csv_file, 5, 500, 1)]
+		new_file = [watermark.dispatch(self.csv_file, 1, 10, 2)]
+		stale = watermark.peek(old_file)
+		watermark.commit(old_file)
+
+		self.assertEqual((1, 10, 2), self._write_checkpoints_in_order(watermark.peek(new_file), stale))
+
+	def test_lateBatchFromBeforeTruncation_writeCheckpoints_keepsCheckpointAfterTruncation(self):
+		watermark = OffsetWatermark()
+		before = [watermark.dispatch(self.csv_file, 5, 500, 1)]
+		after = [watermark.dispatch(self.csv_file, 6, 10, 1)]
+		stale = watermark.peek(before)
+		watermark.commit(before)
+
+		self.assertEqual((6, 10, 1), self._write_checkpoints_in_order(watermark.peek(after), stale))
+
+	def test_batchesInOrderAfterBackfill_writeCheckpoints_movesCheckpointForward(self):
+		watermark = OffsetWatermark()
+		marks = [watermark.dispatch(self.csv_file, x, x * 100, 1) for x in (5, 6)]
+		first = watermark.peek(marks[:1])
+		watermark.commit(marks[:1])
+		backfill = {self.csv_file: (4, 400, 1, None)}
+
+		self.assertEqual((6, 600, 1), self._write_checkpoints_in_order(backfill, first, watermark.peek(marks[1:])))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import struct
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from uuid import UUID
+
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgcopy import encode_copy_binary_typed, COPY_BINARY_HEADER, COPY_BINARY_TRAILER
+from fileshovel.pgtypes import base_type, convert_row, get_binary_encoder, get_converter, get_staging_type, \
+	load_column_types, save_column_types
+from fileshovel.pgsql import PgLineInserter
+
+default_encoding = "utf8"
+date_format = "%Y-%m-%d %H:%M:%S"
+a_uuid = "6f1c1c5e-2d6b-4d9e-9c8a-3b0f2a1d4e5f"
+
+
+class PgTypesTest(TestCase):
+
+	def test_typeWithModifier_baseType_removesModifier(self):
+		self.assertEqual("timestamp without time zone", base_type("timestamp(3) without time zone"))
+		self.assertEqual("character varying", base_type("character varying(20)"))
+
+	def test_knownTypes_convertRow_returnsNativeValues(self):
+		converters = [get_converter(x, date_format) for x in (
+			"bigint", "boolean", "uuid", "timestamp without time zone", "text", "integer")]
+		row = convert_row(["42", "t", a_uuid, "2020-01-02 03:04:05", "abc", None], converters)
+		self.assertEqual([42, True, UUID(a_uuid), datetime(2020, 1, 2, 3, 4, 5), "abc", None], row)
+
+	def test_invalidField_convertRow_raisesValueError(self):
+		converters = [get_converter("integer", date_format), get_converter("boolean", date_format)]
+		self.assertRaises(ValueError, convert_row, ["1", "maybe"], converters)
+		self.assertRaises(ValueError, convert_row, ["x", "t"], converters)
+
+	def test_unknownType_getStagingType_returnsText(self):
+		self.assertEqual("text", get_staging_type("numeric(10,2)"))
+		self.assertEqual("bigint", get_staging_type("bigint"))
+
+	def test_typedRow_encodeBinaryTyped_returnsNativeFields(self):
+		types = ("integer", "timestamp without time zone", "uuid", "text")
+		encoders = [get_binary_encoder(x, default_encoding) for x in types]
+		payload = encode_copy_binary_typed([[7, datetime(2000, 1, 2), UUID(a_uuid), None]], encoders)
+		expected = COPY_BINARY_HEADER + \
+				struct.pack("!h", 4) + \
+				struct.pack("!ii", 4, 7) + \
+				struct.pack("!iq", 8, 86400 * 1000000) + \
+				struct.pack("!i", 16) + UUID(a_uuid).bytes + \
+				struct.pack("!i", -1) + \
+				COPY_BINARY_TRAILER
+		self.assertEqual(expected, payload)
+
+	def test_savedTypes_loadColumnTypes_returnsThemPerTable(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "index.pgtypes")
+			self.assertIsNone(load_column_types(filename, "cdr"))
+			save_column_types(filename, "cdr", {"id": "bigint"})
+			save_column_types(filename, "other", {"id": "uuid"})
+			self.assertEqual({"id": "bigint"}, load_column_types(filename, "cdr"))
+			self.assertEqual({"id": "uuid"}, load_column_types(filename, "other"))
+
+	def test_tableAltered_getColumnTypesWithCheck_replacesCachedTypes(self):
+		with tempfile.TemporaryDirectory() as directory:
+			csv_file = os.path.join(directory, "a.csv")
+			types_file = os.path.join(directory, "a.pgtypes")
+			with open(csv_file, "w") as test_file:
+				test_file.write("uuid,duration\n")
+			save_column_types(types_file, "cdr", {"uuid": "uuid", "duration": "integer", "csv_offset": "bigint"})
+			altered = {"uuid": "uuid", "duration": "bigint", "csv_offset": "bigint"}
+			options = FileShovelOptions(["--pg-table", "cdr", "--pg-csv-offset-column", "csv_offset", "--pg-threads", "0",
+					"--pg-types-file", types_file, "--watch", "no", csv_file])
+
+			with patch.object(PgLineInserter, "connect_database", MagicMock()):
+				inserter = PgLineInserter(options)
+			inserter.table = MagicMock(**{"as_string.return_value": "cdr"})
+
+			with patch.object(inserter, "_read_column_types", return_value=altered) as read_column_types:
+				self.assertEqual(["uuid", "integer", "bigint"], inserter.get_column_types(MagicMock()))
+				read_column_types.assert_not_called()
+				self.assertEqual(["uuid", "bigint", "bigint"], inserter.get_column_types(MagicMock(), check=True))
+
+			self.assertEqual(altered, load_column_types(types_file, "cdr"))
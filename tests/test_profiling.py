@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import cProfile
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from fileshovel import profiling
+from fileshovel.csvreader import CsvReader
+from fileshovel.lineio import TellableLineIO
+from fileshovel.profiling import Profiler, StackSampler, StageTimer
+
+
+def spin(stop: threading.Event):
+	while not stop.is_set():
+		sum(range(100))
+
+
+def wait_for(stop: threading.Event, started: threading.Event):
+	started.set()
+	stop.wait()
+
+
+class SingleProfile(cProfile.Profile):
+	"""Profiler of Python 3.12 and later, only one may be enabled at a time."""
+	active = False
+
+	def enable(self, *args, **kwargs):
+		if SingleProfile.active:
+			raise ValueError("Another profiling tool is already active")
+		SingleProfile.active = True
+		super().enable(*args, **kwargs)
+
+	def disable(self):
+		SingleProfile.active = False
+		super().disable()
+
+
+class StageTimerTest(TestCase):
+
+	def test_nestedStages_stage_excludesInnerStage(self):
+		timer = StageTimer()
+		with timer.stage("parse"):
+			with timer.stage("read"):
+				time.sleep(0.02)
+		seconds = next(iter(timer.seconds().values()))
+		self.assertGreaterEqual(seconds["read"], 0.02)
+		self.assertLess(seconds["parse"], 0.01)
+
+	def test_raisingFunction_wrap_timesCallAndRaises(self):
+		timer = StageTimer()
+		with self.assertRaises(ValueError):
+			timer.wrap(int, "prepare")("x")
+		self.assertIn("prepare", next(iter(timer.seconds().values())))
+
+	def test_iterable_timed_yieldsEveryItem(self):
+		timer = StageTimer()
+		self.assertEqual([1, 2, 3], list(timer.timed([1, 2, 3], "read")))
+
+	def test_csvReaderWhileProfiling_iterate_timesReadDecodeRegexAndParse(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "a.csv")
+			with open(filename, "w") as csv_file:
+				csv_file.write("a,b\n" * 10)
+			profiling.stage_timer = timer = StageTimer()
+			try:
+				lines = TellableLineIO(filename, "rb", "utf-8", regex_search=b"a", regex_replace=b"c")
+				rows = [x[0] for x in CsvReader(lines)]
+				lines.close()
+			finally:
+				profiling.stage_timer = None
+		self.assertEqual([["c", "b"]] * 10, rows)
+		stages = next(iter(timer.seconds().values()))
+		self.assertEqual({"read", "regex", "decode", "parse"}, set(stages))
+
+	def test_stages_collect_yieldsTotalPerStage(self):
+		timer = StageTimer()
+		timer.add("execute", 1.5)
+		self.assertEqual([("fileshovel_stage_seconds_total", {"stage": "execute"}, 1.5)], list(timer.collect()))
+
+
+class ProfilerTest(TestCase):
+
+	def test_threadWaiting_writeFolded_writesStackFromThreadName(self):
+		stop = threading.Event()
+		started = threading.Event()
+		thread = threading.Thread(name="worker", target=wait_for, args=(stop, started), daemon=True)
+		sampler = StackSampler(0.001)
+		thread.start()
+		started.wait()
+		try:
+			for _ in range(5):
+				sampler.sample()
+		finally:
+			stop.set()
+			thread.join()
+		output = io.StringIO()
+		sampler.write(output)
+		lines = [x for x in output.getvalue().splitlines() if x.startswith("worker;")]
+		self.assertEqual(1, len(lines))
+		stack, count = lines[0].rsplit(" ", 1)
+		self.assertEqual("5", count)
+		self.assertIn(";tests.test_profiling:wait_for;", stack)
+
+	def test_stagesFormat_stop_writesStagesAndDisablesTimer(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "profile.json")
+			profiler = Profiler(filename, "stages")
+			profiler.start()
+			with profiling.stage("commit"):
+				pass
+			profiler.stop()
+			with open(filename) as profile_file:
+				profile = json.load(profile_file)
+		self.assertIsNone(profiling.stage_timer)
+		self.assertEqual(["commit"], list(profile["stages"]))
+
+	def test_pstatsFormat_stop_includesOtherThreads(self):
+		with tempfile.TemporaryDirectory() as directory:
+			filename = os.path.join(directory, "profile.pstats")
+			profiler = Profiler(filename, "pstats")
+			profiler.start()
+			stop = threading.Event()
+			thread = threading.Thread(target=spin, args=(stop,), daemon=True)
+			try:
+				thread.start()
+				stop.set()
+				thread.join()
+			finally:
+				profiler.stop()
+			functions = {x[2] for x in pstats.Stats(filename).stats}
+		self.assertIn("spin", functions)
+
+	def test_singleProfilerPerProcess_pstatsFormat_keepsProfilingWithFirstProfile(self):
+		with tempfile.TemporaryDirectory() as directory, patch("cProfile.Profile", SingleProfile):
+			filename = os.path.join(directory, "profile.pstats")
+			profiler = Profiler(filename, "pstats")
+			profiler.start()
+			stop = threading.Event()
+			thread = threading.Thread(target=spin, args=(stop,), daemon=True)
+			try:
+				thread.start()
+				stop.set()
+				thread.join()
+			finally:
+				profiler.stop()
+			self.assertTrue(os.path.isfile(filename))
+		self.assertEqual(1, len(profiler.profiles.profiles))
+		self.assertFalse(SingleProfile.active)
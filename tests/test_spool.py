@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+import os
+import tempfile
+from typing import Tuple
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+
+from fileshovel.options import FileShovelOptions
+from fileshovel.pgsql import PgLineInserter
+from fileshovel.spool import SEGMENT_SUFFIX, Spool
+
+a_batch = [["a-uuid", "5551234", None, 120], ["b-uuid", "été", "0", 180]]
+
+
+class SpoolTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.spool_dir = os.path.join(self.directory.name, "spool")
+
+	def _segments(self) -> list:
+		return sorted(x for x in os.listdir(self.spool_dir) if x.endswith(SEGMENT_SUFFIX))
+
+	def test_appendedBatches_peekAndRemove_returnsThemInOrderWithContext(self):
+		spool = Spool(self.spool_dir, segment_bytes=1)
+		spool.append(a_batch, "first")
+		spool.append(a_batch[:1], "second")
+		self.assertEqual(2, len(self._segments()))
+
+		self.assertEqual((a_batch, "first"), spool.peek())
+		self.assertEqual((a_batch, "first"), spool.peek())
+		spool.remove()
+		self.assertEqual((a_batch[:1], "second"), spool.peek())
+		spool.remove()
+
+		self.assertIsNone(spool.peek())
+		self.assertFalse(spool.pending)
+		self.assertEqual((0, 0), (spool.batches, spool.bytes))
+		self.assertEqual([], self._segments())
+		spool.close()
+
+	def test_addedRows_peek_groupsThemByBatchRows(self):
+		spool = Spool(self.spool_dir, batch_rows=2)
+		for i, row in enumerate(a_batch + a_batch[:1]):
+			spool.add(row, "mark%d" % i, "a.csv", row[3])
+
+		self.assertEqual((a_batch, (["mark0", "mark1"], {"a.csv": 180})), spool.peek())
+		spool.remove()
+		self.assertEqual((a_batch[:1], (["mark2"], {"a.csv": 120})), spool.peek())
+		spool.remove()
+		self.assertFalse(spool.pending)
+		spool.close()
+
+	def test_batchesLeftByPreviousRun_open_readsThemFirstWithoutContext(self):
+		spool = Spool(self.spool_dir, batch_rows=10)
+		spool.append(a_batch, "context")
+		spool.add(a_batch[0], None, "a.csv", 120)
+		spool.close()
+
+		spool = Spool(self.spool_dir)
+		spool.append(a_batch[1:], "new")
+		self.assertEqual(3, spool.batches)
+		batches = []
+		while spool.pending:
+			batches.append(spool.peek())
+			spool.remove()
+		spool.close()
+
+		self.assertEqual([(a_batch, None), (a_batch[:1], None), (a_batch[1:], "new")], batches)
+		self.assertEqual([], self._segments())
+
+	def test_truncatedRecord_peek_dropsEndOfSegment(self):
+		spool = Spool(self.spool_dir)
+		spool.append(a_batch)
+		spool.append(a_batch)
+		spool.close()
+		segment = os.path.join(self.spool_dir, self._segments()[0])
+		os.truncate(segment, os.path.getsize(segment) - 1)
+
+		with self.assertLogs("fileshovel.spool", "WARNING"):
+			spool = Spool(self.spool_dir)
+			self.assertEqual((a_batch, None), spool.peek())
+			spool.remove()
+			self.assertIsNone(spool.peek())
+		self.assertFalse(spool.pending)
+		spool.close()
+
+	def test_writerAheadOfReader_peek_keepsBatchCount(self):
+		spool = Spool(self.spool_dir)
+		spool.append(a_batch, "first")
+
+		with patch.object(spool, "_read", return_value=None):
+			self.assertIsNone(spool.peek())
+		self.assertEqual(1, spool.batches)
+		self.assertEqual((a_batch, "first"), spool.peek())
+		spool.close()
+
+	def test_fullSpool_append_returnsFalse(self):
+		spool = Spool(self.spool_dir, max_bytes=1)
+		self.assertTrue(spool.append(a_batch))
+		self.assertFalse(spool.append(a_batch))
+		self.assertFalse(spool.add(a_batch[0], None, "a.csv", 120))
+		spool.close()
+
+	def test_directoryInUse_open_raisesRuntimeError(self):
+		spool = Spool(self.spool_dir)
+		with self.assertRaisesRegex(RuntimeError, "used by another process"):
+			Spool(self.spool_dir)
+		spool.close()
+
+
+class PgLineInserterSpoolTest(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+		self.csv_file = os.path.join(self.directory.name, "a.csv")
+		self.spool_dir = os.path.join(self.directory.name, "spool")
+
+		with open(self.csv_file, "w") as csv_file:
+			csv_file.write("uuid,caller\na-uuid,5551234\nb-uuid,5555678\n")
+
+		self.arguments = [
+			"--pg-table", "cdr",
+			"--pg-csv-offset-column", "csv_offset",
+			"--pg-threads", "0",
+			"--pg-spool-dir", self.spool_dir,
+			"--pg-retry-delay", "0",
+			"--watch", "no",
+		]
+		self.options = FileShovelOptions(self.arguments + [self.csv_file])
+
+	def test_unavailableDatabase_done_spoolsBatchThenInsertsItOnceBack(self):
+		sent = []
+
+		def send_batch(session, rows, marks, ending, convert):
+			sent.append([list(x) for x in rows])
+			if len(sent) == 1:
+				raise psycopg2.OperationalError("server closed the connection unexpectedly")
+			return 0.0, 0.0, True
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()), \
+				patch.object(PgLineInserter, "_send_batch", side_effect=send_batch), \
+				self.assertLogs("fileshovel.pgsql", "WARNING"):
+			inserter = PgLineInserter(self.options)
+			inserter.add_row(["a-uuid", "5551234"], 1, 11)
+			inserter.add_row(["b-uuid", "5555678"], 2, 26)
+			inserter.done()
+
+		expected = [["a-uuid", "5551234", 11], ["b-uuid", "5555678", 26]]
+		self.assertEqual([expected, expected], sent)
+		self.assertEqual(0, inserter.spool.batches)
+		self.assertEqual(["lock"], os.listdir(self.spool_dir))
+
+	def _insert_with_checkpoints(self, send_batch, *arguments) -> Tuple[PgLineInserter, MagicMock]:
+		options = FileShovelOptions(self.arguments + ["--pg-checkpoint-table", "checkpoints"] + list(arguments) +
+				[self.csv_file])
+
+		with patch.object(PgLineInserter, "connect_database", MagicMock()), \
+				patch.object(PgLineInserter, "create_checkpoint_table", MagicMock()), \
+				patch.object(PgLineInserter, "_send_batch", autospec=True, side_effect=send_batch), \
+				patch.object(PgLineInserter, "save_checkpoint") as save_checkpoint, \
+				self.assertLogs("fileshovel.pgsql", "WARNING"):
+			inserter = PgLineInserter(options)
+			inserter.add_row(["a-uuid", "5551234"], 1, 11, self.csv_file, 42)
+			inserter.done()
+
+		return inserter, save_checkpoint
+
+	def test_databaseBackBeforeRetryTimeout_done_replaysSpoolAndSavesCheckpoints(self):
+		sent = []
+
+		def send_batch(inserter, session, rows, marks, ending, convert):
+			sent.append(marks)
+			if len(sent) < 4:
+				raise psycopg2.OperationalError("could not connect to server")
+			inserter.watermark.commit(marks)
+			return 0.0, 0.0, True
+
+		inserter, save_checkpoint = self._insert_with_checkpoints(send_batch)
+
+		self.assertEqual(4, len(sent))
+		self.assertEqual(0, inserter.spool.batches)
+		save_checkpoint.assert_called_once_with(self.csv_file, 1, 11, 42, 1)
+
+	def test_databaseDownUntilRetryTimeout_done_leavesSpoolWithoutCheckpoints(self):
+		send_batch = MagicMock(side_effect=psycopg2.OperationalError("could not connect to server"))
+
+		inserter, save_checkpoint = self._insert_with_checkpoints(send_batch, "--pg-retry-timeout", "0.05")
+
+		self.assertGreater(send_batch.call_count, 2)
+		self.assertEqual(1, inserter.spool.batches)
+		save_checkpoint.assert_not_called()
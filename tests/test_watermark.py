@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vim:set noet ts=4 sw=4 fenc=utf-8 ff=unix ft=python:
+from unittest import TestCase
+
+from fileshovel.watermark import OffsetWatermark
+
+a_filename = "/nonexistent/file.csv"
+another_filename = "/nonexistent/other.csv"
+
+
+class OffsetWatermarkTest(TestCase):
+
+	def _dispatch(self, watermark: OffsetWatermark, csv_file: str, count: int, first_line: int = 1,
+			inode: int = None) -> list:
+		return [watermark.dispatch(csv_file, x, x * 10, inode) for x in range(first_line, first_line + count)]
+
+	def test_nothingCommitted_get_returnsNone(self):
+		watermark = OffsetWatermark()
+		self._dispatch(watermark, a_filename, 3)
+		self.assertIsNone(watermark.get(a_filename))
+
+	def test_laterBatchCommittedFirst_get_staysBeforeEarlierBatch(self):
+		watermark = OffsetWatermark()
+		marks = self._dispatch(watermark, a_filename, 6)
+		watermark.commit(marks[3:])
+		self.assertIsNone(watermark.get(a_filename))
+		watermark.commit(marks[:3])
+		self.assertEqual((6, 60, None, 6), watermark.get(a_filename))
+
+	def test_interleavedBatches_peek_coversOnlyCommittedAndOwnRows(self):
+		watermark = OffsetWatermark()
+		marks = self._dispatch(watermark, a_filename, 6)
+		first_batch, second_batch = marks[0::2], marks[1::2]
+		self.assertEqual({a_filename: (1, 10, None, 1)}, watermark.peek(first_batch))
+		watermark.commit(first_batch)
+		self.assertEqual((1, 10, None, 1), watermark.get(a_filename))
+		self.assertEqual({a_filename: (6, 60, None, 6)}, watermark.peek(second_batch))
+
+	def test_offsetsRestartAfterRotation_commit_followsDispatchOrder(self):
+		watermark = OffsetWatermark()
+		marks = self._dispatch(watermark, a_filename, 2, first_line=5, inode=1) + \
+				self._dispatch(watermark, a_filename, 1, inode=2)
+		watermark.commit(marks)
+		self.assertEqual((1, 10, 2, 3), watermark.get(a_filename))
+
+	def test_twoFiles_commitOneFile_otherFileUnchanged(self):
+		watermark = OffsetWatermark()
+		marks = self._dispatch(watermark, a_filename, 2)
+		other_marks = self._dispatch(watermark, another_filename, 2)
+		watermark.commit(other_marks)
+		self.assertIsNone(watermark.get(a_filename))
+		self.assertEqual([(another_filename, (2, 20, None, 2))], watermark.items())
+		self.assertEqual({a_filename: (2, 20, None, 2)}, watermark.peek(marks))
+
+	def test_resumedCheckpoint_dispatch_numbersRowsAfterIt(self):
+		watermark = OffsetWatermark()
+		watermark.resume(a_filename, 41)
+		marks = self._dispatch(watermark, a_filename, 2)
+		watermark.commit(marks)
+		self.assertEqual((2, 20, None, 43), watermark.get(a_filename))